@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+
+"""
+bombench.py: benchmark the phases of bomreader.py processing over a range
+    of data sizes, using synthetic observation files from bomgen.py.
+
+Usage: bombench.py [-h] [-d] [-s sizes] [-e engines] [-j jobs] [-r repeats]
+        [-o results.json] [-c previous.json] [-k datadir]
+Parameters:
+    -h: Print this help
+    -d: Debugging output
+    -s: Comma separated list of data sizes, as stations x days
+        (default 3x30,13x30,13x90)
+    -e: Comma separated list of engines to benchmark, from views (sqlite,
+        the default for bomreader.py), materialise (sqlite, --materialise)
+        and numpy (default views,materialise,numpy)
+    -j: Comma separated list of numbers of processes for parsing
+        (default 1)
+    -r: Number of times to repeat each benchmark, the fastest is kept
+        (default 1)
+    -o: Write results to this file, as json
+    -c: Compare results with those of a previous run, from its json file
+    -k: Keep generated data in this directory, and reuse it if present
+
+Description:
+    Each engine is timed separately for each phase of processing:
+        parse: reading and parsing the json files into observation rows
+        ingest: adding the observation rows to the database (or arrays)
+        views: creating the normalised observation and daily stats views
+            (or tables, or arrays)
+        daily: the day by day report
+        summary: the date range and location summaries
+    Reports are printed to an in-memory buffer, so terminal output isn't
+    included in timings.
+    Results include the git commit and sqlite version, so that results
+    saved from different commits can be compared with -c.
+"""
+
+
+import sys
+import getopt
+import logging
+import json
+import io
+import os
+import sqlite3
+import tempfile
+import shutil
+import subprocess
+import platform
+import time
+
+import bomreader
+import bomgen
+
+PHASES = ['parse', 'ingest', 'views', 'daily', 'summary']
+
+
+# time a single phase, adding elapsed seconds to timings
+# returns the result of fn
+def timePhase(timings, phase, fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    timings[phase] = time.perf_counter() - start
+    return result
+
+
+# run bomreader's sqlite processing on files, phase by phase
+# returns dict of phase -> seconds, and number of observations
+def benchSqlite(filenames, jobs, materialise):
+    timings = {}
+    out = io.StringIO()
+    writer = bomreader.openReportWriter(out=out)
+    parsed = timePhase(timings, 'parse', lambda: list(bomreader.parseFiles(filenames, jobs=jobs)))
+
+    conn = sqlite3.connect('')
+    conn.row_factory = sqlite3.Row
+    dbc = conn.cursor()
+    bomreader.initDB(dbc)
+    def ingest():
+        dbc.execute("BEGIN")
+        for fn, p in parsed:
+            bomreader.storeObservations(dbc, p['prepared'])
+        conn.commit()
+    timePhase(timings, 'ingest', ingest)
+
+    def views():
+        if materialise:
+            bomreader.materialiseDailyStats(dbc)
+        else:
+            bomreader.create_date_normalised_observations(dbc)
+            bomreader.createDailyTODStats(dbc)
+        bomreader.calcDayToDayTODAvgTempDiffs(dbc)
+    timePhase(timings, 'views', views)
+
+    def daily():
+        bomreader.writeDailyObservations(writer, bomreader.getDailyObservations(dbc))
+    timePhase(timings, 'daily', daily)
+
+    def summary():
+        obs_range = bomreader.getObservationDateRange(dbc)
+        locations = bomreader.getLocations(dbc)
+        summaries = bomreader.calcLocationSummaries(dbc)
+        bomreader.writeReportSummary(writer, obs_range, locations, summaries)
+    timePhase(timings, 'summary', summary)
+
+    dbc.execute("SELECT COUNT(*) FROM observation")
+    nobs = dbc.fetchone()[0]
+    conn.close()
+    return timings, nobs
+
+
+# run bomreader's numpy processing on files, phase by phase
+# returns dict of phase -> seconds, and number of observations
+def benchNumpy(filenames, jobs):
+    timings = {}
+    out = io.StringIO()
+    writer = bomreader.openReportWriter(out=out)
+    parsed = timePhase(timings, 'parse', lambda: list(bomreader.parseFiles(filenames, jobs=jobs)))
+
+    def ingest():
+        chunks = []
+        locations = {}
+        for fn, p in parsed:
+            if p['prepared'] is not None:
+                locations.setdefault(p['prepared']['id'], p['prepared']['name'])
+                chunks.append(bomreader.rowsToColumnarChunk(p['prepared']['rows']))
+        return bomreader.loadColumnarObservations(chunks, locations)
+    cols = timePhase(timings, 'ingest', ingest)
+
+    def views():
+        bomreader.normaliseColumnarDates(cols)
+        return bomreader.calcColumnarDailyStats(cols)
+    daily_stats = timePhase(timings, 'views', views)
+
+    def daily():
+        bomreader.writeDailyObservations(writer, bomreader.getColumnarDailyObservations(cols, daily_stats))
+    timePhase(timings, 'daily', daily)
+
+    def summary():
+        obs_range = bomreader.getColumnarObservationDateRange(cols)
+        locations = [{'id': locid, 'name': name} for locid, name in cols['locations']]
+        summaries = bomreader.calcColumnarLocationSummaries(cols, daily_stats)
+        bomreader.writeReportSummary(writer, obs_range, locations, summaries)
+    timePhase(timings, 'summary', summary)
+
+    return timings, len(cols['minutes'])
+
+
+# benchmark an engine on files, keeping the fastest time of each phase
+# returns a result dict, for saving as json
+def benchmark(engine, filenames, jobs, repeats):
+    best = None
+    for i in range(repeats):
+        if engine == 'numpy':
+            timings, nobs = benchNumpy(filenames, jobs)
+        else:
+            timings, nobs = benchSqlite(filenames, jobs, engine == 'materialise')
+        if best is None:
+            best = timings
+        else:
+            best = {phase: min(best[phase], timings[phase]) for phase in PHASES}
+    total = sum(best.values())
+    result = {
+            'engine': engine,
+            'jobs': jobs,
+            'files': len(filenames),
+            'observations': nobs,
+            'phases': best,
+            'total': total,
+            'obs_per_sec': nobs / total if total > 0 else None
+    }
+    return result
+
+
+# get the current git commit of the bomreader source, if available
+def getGitCommit():
+    srcdir = os.path.dirname(os.path.abspath(bomreader.__file__))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=srcdir,
+                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return commit
+
+
+# parse a data size given as stations x days, eg. 13x90
+def parseSize(sizestr):
+    stations, days = sizestr.lower().split('x')
+    return int(stations), int(days)
+
+
+# generate (or reuse) the synthetic data for a size
+# returns sorted list of json filenames
+def getSizeData(datadir, stations, days):
+    sizedir = os.path.join(datadir, '{}x{}'.format(stations, days))
+    if not os.path.isdir(sizedir):
+        os.makedirs(sizedir)
+        bomgen.generate(stations, days, sizedir)
+    return sorted(os.path.join(sizedir, fn) for fn in os.listdir(sizedir) if fn.endswith('.json'))
+
+
+# print a result as a line of phase timings
+def printResult(size, result):
+    phasestrs = ' '.join("{} {:.3f}".format(phase, result['phases'][phase]) for phase in PHASES)
+    print("{} {} j{}: {} total {:.3f}s ({} obs, {:.0f} obs/s)".format(
+        size, result['engine'], result['jobs'], phasestrs, result['total'],
+        result['observations'], result['obs_per_sec'] or 0))
+
+
+# print a comparison of results with those of a previous run
+# phases are compared as ratios of new / previous time
+def printComparison(results, previous):
+    prev = {(r['size'], r['engine'], r['jobs']): r for r in previous['results']}
+    print("Compared with commit {} (ratio of new/previous times):".format(previous['meta'].get('commit')))
+    for result in results:
+        key = (result['size'], result['engine'], result['jobs'])
+        if key not in prev:
+            continue
+        ratios = []
+        for phase in PHASES + ['total']:
+            if phase == 'total':
+                old, new = prev[key]['total'], result['total']
+            else:
+                old, new = prev[key]['phases'][phase], result['phases'][phase]
+            ratios.append("{} {:.2f}".format(phase, new/old if old > 0 else float('nan')))
+        print("{} {} j{}: {}".format(key[0], key[1], key[2], ' '.join(ratios)))
+
+
+def main(argv):
+    debug = 0
+    sizes = ['3x30', '13x30', '13x90']
+    engines = ['views', 'materialise', 'numpy']
+    jobs_list = [1]
+    repeats = 1
+    outfile = None
+    comparefile = None
+    datadir = None
+    usagestr = "Usage: {} [-h] [-d] [-s sizes] [-e engines] [-j jobs] [-r repeats] [-o results.json] [-c previous.json] [-k datadir]".format(argv[0])
+
+    try:
+        options, remainder = getopt.gnu_getopt(argv[1:], "hds:e:j:r:o:c:k:")
+    except getopt.GetoptError:
+        print(usagestr, file=sys.stderr)
+        sys.exit(2)
+
+    for opt, arg in options:
+        if opt == '-h':
+            print(__doc__, file=sys.stderr)
+            sys.exit()
+        elif opt == '-d':
+            debug = 1
+        elif opt == '-s':
+            sizes = arg.split(',')
+        elif opt == '-e':
+            engines = arg.split(',')
+        elif opt == '-j':
+            jobs_list = [int(j) for j in arg.split(',')]
+        elif opt == '-r':
+            repeats = int(arg)
+        elif opt == '-o':
+            outfile = arg
+        elif opt == '-c':
+            comparefile = arg
+        elif opt == '-k':
+            datadir = arg
+        else:
+            assert False, "unhandled option"
+
+    # bomreader logs skipped (invalid) observations as warnings
+    if debug > 0:
+        logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.DEBUG)
+    else:
+        logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.ERROR)
+
+    for engine in engines:
+        if engine not in ('views', 'materialise', 'numpy'):
+            print(usagestr, file=sys.stderr)
+            sys.exit(2)
+        if engine == 'numpy' and bomreader.np is None:
+            print("numpy isn't installed, skipping the numpy engine", file=sys.stderr)
+    engines = [e for e in engines if e != 'numpy' or bomreader.np is not None]
+
+    keep = datadir is not None
+    if not keep:
+        datadir = tempfile.mkdtemp(prefix='bombench')
+
+    results = []
+    try:
+        for size in sizes:
+            stations, days = parseSize(size)
+            filenames = getSizeData(datadir, stations, days)
+            for engine in engines:
+                for jobs in jobs_list:
+                    result = benchmark(engine, filenames, jobs, repeats)
+                    result['size'] = size
+                    result['stations'] = stations
+                    result['days'] = days
+                    printResult(size, result)
+                    results.append(result)
+    finally:
+        if not keep:
+            shutil.rmtree(datadir)
+
+    meta = {
+            'commit': getGitCommit(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'numpy': bomreader.np.__version__ if bomreader.np is not None else None,
+            'cpus': os.cpu_count(),
+            'repeats': repeats
+    }
+    if outfile:
+        with open(outfile, 'w') as f:
+            json.dump({'meta': meta, 'results': results}, f, indent=1)
+
+    if comparefile:
+        with open(comparefile, 'r') as f:
+            previous = json.load(f)
+        printComparison(results, previous)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+
+"""
+bomgen.py: generate synthetic BoM-shaped JSON observation files, for
+    benchmarking and testing bomreader.py without downloading real data.
+
+Usage: bomgen.py [-h] [-n stations] [-m days] [-s seed] [-o outdir] [-e enddate]
+Parameters:
+    -h: Print this help
+    -n: Number of stations to generate (default 13)
+    -m: Number of days of observations per station (default 30)
+    -s: Random seed, for reproducible output (default 1)
+    -o: Directory to write json files to (default current directory)
+    -e: Date of last download, as YYYY-MM-DD (default 2018-03-01)
+
+Description:
+    Files are written as they would be by the example crontab, ie. every
+    second day at 22:15, each containing 72 hours of half-hourly readings
+    (newest first) and named <Loc>-YYYY-MM-DD.json, so consecutive files
+    overlap by roughly half.
+    Readings follow a diurnal cycle with day to day drift, and include
+    the occasional missing (null) value and off-the-half-hour reading, as
+    found in real data.
+"""
+
+
+import sys
+import getopt
+import json
+import math
+import os
+import random
+from datetime import datetime, timedelta
+
+# the stations downloaded by getallobs.sh, extra stations are made up
+STATIONS = [
+        ('Brisbane_AP', 94578, 'Brisbane Airport', 25.5),
+        ('Rockhampton', 94374, 'Rockhampton', 27.0),
+        ('Mackay_AP', 95367, 'Mackay', 26.5),
+        ('Proserpine', 94365, 'Proserpine Airport', 26.5),
+        ('Bowen_AP', 94383, 'Bowen Airport', 27.0),
+        ('Townsville_AP', 94294, 'Townsville', 27.5),
+        ('Townsville_MS', 94272, 'Mount Stuart (Defence)', 25.0),
+        ('Innisfail_AP', 94280, 'Innisfail', 26.5),
+        ('Cairns', 94287, 'Cairns', 27.5),
+        ('Cairns_RC', 94288, 'Cairns Racecourse', 27.5),
+        ('Mareeba', 95286, 'Mareeba', 25.0),
+        ('Cooktown', 95283, 'Cooktown', 27.5),
+        ('Darwin_AP', 94120, 'Darwin Airport', 29.0),
+]
+
+WIND_DIRS = ['N', 'NNE', 'NE', 'ENE', 'E', 'ESE', 'SE', 'SSE',
+        'S', 'SSW', 'SW', 'WSW', 'W', 'WNW', 'NW', 'NNW', 'CALM']
+
+# hours of data in each downloaded file, and days between downloads
+FILE_HOURS = 72
+DOWNLOAD_EVERY_DAYS = 2
+
+
+# list of (file prefix, wmo, name, mean temp) for the requested stations
+def getStations(nstations):
+    stations = list(STATIONS[:nstations])
+    for i in range(len(stations), nstations):
+        stations.append(('Station{:03d}'.format(i), 90000 + i,
+                'Synthetic Station {}'.format(i), 20.0 + (i % 10)))
+    return stations
+
+
+# format a reading as BoM does, None for missing
+def maybeNull(rng, value, null_rate):
+    if rng.random() < null_rate:
+        return None
+    return value
+
+
+# generate a chronologically ordered list of observation records
+# for a single station, from start until end (datetimes)
+def generateStationObservations(rng, station, start, end):
+    prefix, wmo, name, mean_t = station
+    obs = []
+    rain_trace = 0.0
+    drift = 0.0
+    t = start
+    while t <= end:
+        # drift the daily mean temperature a little each reading
+        drift = max(-4.0, min(4.0, drift + rng.gauss(0, 0.08)))
+        hour = t.hour + t.minute/60.0
+        # warmest mid afternoon, coolest just before dawn
+        diurnal = 4.0 * math.cos((hour - 15.0) * math.pi / 12.0)
+        air_temp = round(mean_t + drift + diurnal + rng.gauss(0, 0.4), 1)
+        rel_hum = int(max(20, min(100, 75 - 3*diurnal + rng.gauss(0, 5))))
+        dewpt = round(air_temp - (100 - rel_hum)/5.0, 1)
+        wind_spd = max(0, int(rng.gauss(12, 6)))
+        apparent_t = round(air_temp + 0.33*(rel_hum/100.0*6.105) - 0.7*wind_spd/3.6 - 4.0, 1)
+        # rain_trace is cumulative since 9am, reset at 9am
+        if t.hour == 9 and t.minute == 0:
+            rain_trace = 0.0
+        if rng.random() < 0.05:
+            rain_trace += round(rng.expovariate(2.0), 1)
+        record = {
+            'sort_order': 0,
+            'wmo': wmo,
+            'name': name,
+            'history_product': 'IDQ60801',
+            'local_date_time': t.strftime('%d/%I:%M%p').lower(),
+            'local_date_time_full': t.strftime('%Y%m%d%H%M%S'),
+            'aifstime_utc': (t - timedelta(hours=10)).strftime('%Y%m%d%H%M%S'),
+            'lat': -19.3,
+            'lon': 146.8,
+            'apparent_t': maybeNull(rng, apparent_t, 0.01),
+            'cloud': '-',
+            'cloud_base_m': None,
+            'cloud_oktas': maybeNull(rng, rng.randint(0, 8), 0.3),
+            'cloud_type': '-',
+            'cloud_type_id': None,
+            'delta_t': round((air_temp - dewpt)/2.0, 1),
+            'gust_kmh': wind_spd + rng.randint(0, 10),
+            'gust_kt': None,
+            'air_temp': maybeNull(rng, air_temp, 0.005),
+            'dewpt': maybeNull(rng, dewpt, 0.01),
+            'press': None,
+            'press_qnh': None,
+            'press_msl': maybeNull(rng, round(1012 + 3*math.sin(hour*math.pi/6.0) + rng.gauss(0, 0.5), 1), 0.02),
+            'press_tend': '-',
+            'rain_trace': '{:.1f}'.format(rain_trace) if rng.random() > 0.01 else '-',
+            'rel_hum': maybeNull(rng, rel_hum, 0.01),
+            'sea_state': '-',
+            'swell_dir_worded': '-',
+            'swell_height': None,
+            'swell_period': None,
+            'vis_km': '10',
+            'weather': '-',
+            'wind_dir': WIND_DIRS[rng.randrange(len(WIND_DIRS))] if wind_spd else 'CALM',
+            'wind_spd_kmh': wind_spd,
+            'wind_spd_kt': int(wind_spd/1.852),
+        }
+        obs.append(record)
+        # mostly half-hourly, with the occasional special reading
+        if rng.random() < 0.03:
+            t += timedelta(minutes=rng.randint(1, 29))
+        else:
+            t = t.replace(minute=0 if t.minute >= 30 else 30) \
+                    + timedelta(hours=1 if t.minute >= 30 else 0)
+    return obs
+
+
+# write the files for a station that the crontab would have downloaded
+def writeStationFiles(station, obs, first_dl, last_dl, outdir):
+    prefix, wmo, name, mean_t = station
+    fnames = []
+    dl = first_dl
+    keys = [o['local_date_time_full'] for o in obs]
+    while dl <= last_dl:
+        latest = dl.replace(hour=22, minute=0)
+        earliest = latest - timedelta(hours=FILE_HOURS)
+        lo = earliest.strftime('%Y%m%d%H%M%S')
+        hi = latest.strftime('%Y%m%d%H%M%S')
+        data = [o for o, k in zip(obs, keys) if lo < k <= hi]
+        data.reverse() # BoM lists newest first
+        for i, o in enumerate(data):
+            o['sort_order'] = i
+        doc = {
+            'observations': {
+                'notice': [],
+                'header': [{'refresh_message': 'Issued at 10:05 pm EST',
+                    'ID': 'IDQ60801.{}'.format(wmo), 'name': name,
+                    'state_time_zone': 'QLD', 'time_zone': 'EST'}],
+                'data': data,
+            }
+        }
+        fname = os.path.join(outdir, '{}-{}.json'.format(prefix, dl.strftime('%Y-%m-%d')))
+        with open(fname, 'w') as f:
+            json.dump(doc, f)
+        fnames.append(fname)
+        dl += timedelta(days=DOWNLOAD_EVERY_DAYS)
+    return fnames
+
+
+# generate files for nstations over ndays ending on the end date
+# returns list of filenames written
+def generate(nstations, ndays, outdir, seed=1, end='2018-03-01'):
+    rng = random.Random(seed)
+    last_dl = datetime.strptime(end, '%Y-%m-%d').replace(hour=22, minute=15)
+    first_dl = last_dl - timedelta(days=max(ndays - FILE_HOURS//24, 0))
+    start = (first_dl - timedelta(hours=FILE_HOURS)).replace(minute=0)
+    end_obs = last_dl.replace(minute=0)
+    fnames = []
+    for station in getStations(nstations):
+        obs = generateStationObservations(rng, station, start, end_obs)
+        fnames.extend(writeStationFiles(station, obs, first_dl, last_dl, outdir))
+    return fnames
+
+
+def main(argv):
+    nstations = 13
+    ndays = 30
+    seed = 1
+    outdir = '.'
+    end = '2018-03-01'
+    usagestr = "Usage: {} [-h] [-n stations] [-m days] [-s seed] [-o outdir] [-e enddate]".format(argv[0])
+
+    try:
+        options, remainder = getopt.gnu_getopt(argv[1:], "hn:m:s:o:e:")
+    except getopt.GetoptError:
+        print(usagestr, file=sys.stderr)
+        sys.exit(2)
+
+    for opt, arg in options:
+        if opt == '-h':
+            print(__doc__, file=sys.stderr)
+            sys.exit()
+        elif opt == '-n':
+            nstations = int(arg)
+        elif opt == '-m':
+            ndays = int(arg)
+        elif opt == '-s':
+            seed = int(arg)
+        elif opt == '-o':
+            outdir = arg
+        elif opt == '-e':
+            end = arg
+        else:
+            assert False, "unhandled option"
+
+    os.makedirs(outdir, exist_ok=True)
+    fnames = generate(nstations, ndays, outdir, seed, end)
+    print("wrote {} files to {}".format(len(fnames), outdir), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
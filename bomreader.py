@@ -5,11 +5,100 @@ bomreader.py: process and present BoM weather observation data as typical
     temperature & humidity for periods of day, for each location, day
     and summarised for entire date range.
 
-Usage: bomreader.py [-h] [-d] [-s] jsonfile1 [jsonfile 2 ...]
+Usage: bomreader.py [-h] [-d] [-s] [-x] [-p] [-j jobs] [--db dbfile]
+        [--shards sharddir] [--shard-key key] [--materialise]
+        [--engine sqlite|numpy] [--profile] [--profile-out file]
+        [--summary-jobs jobs] [--format text|csv|jsonl] [--no-cache]
+        [--cache-dir dir] [--from date] [--to date] [--station station]
+        [--storage fast-ephemeral|durable|low-memory] [--rollup range|seasons]
+        jsonfile1 [jsonfile 2 ...]
+       bomreader.py compact [-h] [-d] [-j jobs] [-o archivedir]
+        jsonfile1 [jsonfile 2 ...]
+       bomreader.py read [--help] [--debug] [-tahdwrcp] [-j jobs] [--db dbfile]
+        [file ...]
+       bomreader.py fetch [-h] [-d] [-j jobs] [-o outdir] [-t stations.csv]
+        [-u baseurl] [--db dbfile] [station ...]
+       bomreader.py watch [-h] [-d] [-j jobs] [-i interval] [-p port | -u socket]
+        [--db dbfile] [--storage profile] directory
+       bomreader.py partial [-h] [-d] [-s] [-j jobs] [-o file] [--from date]
+        [--to date] [--station station] sharddir [shard ...]
+       bomreader.py merge [-h] [-d] [-s] [--format text|csv|jsonl]
+        partialfile1 [partialfile 2 ...]
 Parameters:
     -h: Print this help
     -d: Debugging output
     -s: Print summary only
+    -x: Also summarise rainfall, wind, pressure and dew point for each
+          location and period of day
+    -p: Also summarise the median, 10th and 90th percentile temperatures
+          for each location and period of day
+    -j: Number of processes to read and parse json files with (default 1)
+    --db: Keep observations in a persistent database file, only ingesting
+          files (and observations) not already in it
+    --shards: Keep observations in a directory of databases (shards), one
+          for each station and year (by default), only ingesting files (and
+          observations) not already in them, and report on the shards
+          needed, not with --db, --materialise, -x, -p or --rollup
+    --shard-key: Key the shards of a new shards directory by station-year
+          (default), station, year or station-month
+    --materialise: Store daily stats in indexed tables rather than views,
+          with a persistent database these are refreshed incrementally
+    --engine: Processing engine, sqlite (default) or numpy, which processes
+          the json files in memory, without a database (requires numpy)
+    --profile: Report time taken by each phase of processing, and the
+          slowest queries with their query plans (to stderr)
+    --profile-out: With --profile, also write the profile to this file, as
+          json if it ends with .json, otherwise as cProfile stats
+    --summary-jobs: Number of threads to calculate location summaries with,
+          each with its own read-only connection (requires a database file,
+          so --db or -d, a --db database is switched to WAL mode), best
+          used with --materialise, or with --shards, to calculate the
+          results of shards with
+    --format: Report format, text (default), csv or jsonl (a json object
+          per line), csv and jsonl have a record for each daily and summary
+          value, with a record field of daily or summary
+    --no-cache: Don't use (or add to) the cache of reports, which are
+          otherwise cached by the contents of the files and the options,
+          except with --db, -d or --profile
+    --cache-dir: Directory of the report cache (default ~/.cache/bomreader)
+    --from: Only report on dates from this date (YYYY-MM-DD)
+    --to: Only report on dates up to and including this date (YYYY-MM-DD)
+    --station: Only report on this station, a wmo id, name as in stations.csv
+          or location name (can be given more than once, or comma separated)
+    --storage: SQLite storage settings (journal, syncing, cache and memory
+          mapping), fast-ephemeral for bulk ingest into a database that's
+          discarded (or can be rebuilt), durable for a --db database that's
+          added to and queried repeatedly, or low-memory for small hosts
+          (default is sqlite's own settings)
+    --rollup: Report the mean, standard deviation and range of temperatures
+          for each location and period of day from rollups (rather than
+          the daily report and summaries), over the whole date range
+          (range), or for each season and compared with the year before
+          (seasons), not with --engine numpy
+    compact -o: Directory to write archives to (default current directory)
+    read -t, -a: Air and apparent temperature, which are always printed
+    read -h, -d, -w, -r, -c, -p: Also print humidity, dew point, wind
+          direction & speed, rain since 9am, cloud and pressure (in the
+          order given), as for readweatherobs.sh
+    read -j: Number of processes to read files with (default 1)
+    read --db: Read the observations in this database, rather than files
+    fetch -j: Number of concurrent downloads (default 4)
+    fetch -o: Directory to download json files to (default current directory)
+    fetch -t: Station table, csv of name, product and wmo (default
+          stations.csv, alongside bomreader.py)
+    fetch -u: Server to download from (default http://www.bom.gov.au)
+    fetch --db: Also add the downloaded observations to this database
+    watch -i: Seconds between checks for new files (default 60)
+    watch -p: Port to serve reports on, from localhost (default 8765)
+    watch -u: Unix socket to serve reports on, instead of a port
+    watch --db: Keep observations in this database (default temporary)
+    watch --storage: SQLite storage settings, as for --storage
+    partial -s: Leave out the day by day results, for a summary only report
+    partial -j: Number of threads to calculate the results of shards with
+    partial -o: Write the partial results to this file (default stdout)
+    partial --from, --to, --station: As for the report
+    merge -s: Print summary only
+    merge --format: Report format, as for --format
 
 Description:
     bomreader.py is used to process JSON files of weather observations
@@ -20,6 +109,46 @@ Description:
     over the time period contained in the provided data.
     This gives a more accurate reflection of weather & climate (for comparison),
     as opposed to just maximum and minimum temperatures.
+    By default all of the provided files are processed from scratch. With
+    --db, observations are accumulated in the given database between runs,
+    files that have already been ingested are skipped, as are observations
+    older than the latest already stored for a location, so subsequent runs
+    only need to process newly downloaded data. As the latest observation is
+    tracked, files older than those already ingested won't add any data.
+    The compact command merges json files into compact archives, one for
+    each location and month (named <wmo>-YYYY-MM.bomc) without duplicated
+    observations, adding to any existing archives. Archives can be given
+    instead of (or as well as) json files, and are read much faster, in
+    particular by the numpy engine which maps them directly into memory.
+    The read command prints the given fields of each observation in json
+    files or archives (or standard input), a line per observation, as
+    readweatherobs.sh does, without starting jq for each file.
+    The fetch command downloads the latest observations for the stations
+    in the station table (or just those named), only if changed since they
+    were last downloaded, as <name>-YYYY-MM-DD.json files.
+    The watch command keeps running, ingesting new files in a directory as
+    they appear, and serves the report over http, as /summary and /daily
+    (optionally ?station=name or id, and &format=text, csv or jsonl), and
+    /stations. Reports are cached until a station has new observations.
+    With --shards, observations are kept in a database for each station and
+    year (or as per --shard-key), with a manifest of the shards and the
+    files ingested, new observations only open the shards they're in,
+    and reports only read the shards with selected observations. Each
+    shard's results are calculated on its own, and merged into the report.
+    The partial command calculates the results of shards (all those
+    needed, or just those named), and the merge command merges partial
+    results into the report, so shards (with a copy of the manifest) can be
+    processed on different hosts.
+    Files too big to load at once (over 16MB), gzipped files and files of
+    more than one json document (concatenated, or newline delimited json of
+    documents or of observation records) are streamed, with observations
+    decoded one at a time and added in batches, so memory use doesn't grow
+    with the size of the file.
+    With --from, --to or --station, files without any selected observations
+    are skipped unread (going by their names, or their first and last
+    observations) and other observations are dropped as they're read. With
+    --db, new files are still ingested in full, and only the report is
+    restricted.
 
 Author: Justin Lee, July 2017.
 """
@@ -33,7 +162,39 @@ import sqlite3
 import textwrap
 import os
 import tempfile
-from datetime import datetime
+import hashlib
+import multiprocessing
+import multiprocessing.pool
+import threading
+import urllib.request
+import urllib.parse
+import http.client
+import gzip
+import csv
+import io
+import collections
+import http.server
+import socketserver
+import signal
+import shutil
+import time
+import contextlib
+import cProfile
+import struct
+import mmap
+import array
+import bisect
+import datetime
+import re
+import functools
+import itertools
+import heapq
+
+# numpy is optional, only required for the columnar engine
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 # define parts of day intervals (morn, day, eve, night)
 MORNING_HOUR_START="06:00"
@@ -45,126 +206,243 @@ EVENING_HOUR_END="22:00"
 OVERNIGHT_HOUR_START="22:00"
 OVERNIGHT_HOUR_END="06:00"
 
+# window functions (eg. LAG) were added to sqlite in version 3.25
+SQLITE_HAS_WINDOW_FUNCTIONS = sqlite3.sqlite_version_info >= (3, 25, 0)
 
-# build the desired set of queries for morn, day, eve, night intervals
-# return a dictionary of strings (keys as per intervals listed above)
-# arguments:
-#     select_str will be like: AVG(air_temp)
-#     locid will be like: 94287
-#     extra_conditions will be like: AND cloud_oktas >= 0
-#     group_by will be like: GROUP BY date
-#     aggregate will be like: AVG(t_spread)
-# note: an aggregate query will perform a query on the results of the
-# main query, which will be within parentheses and named with AS, eg:
-#     SELECT AVG(t_spread) FROM (SELECT (MAX(air_temp)-MIN(air_temp)) AS t_spread FROM observation WHERE location_id=94294 AND (time BETWEEN "10:00" AND "18:00") GROUP BY date)
-def buildDailyIntervalQueries(select_str, locid, extra_conditions='', group_by='', aggregate=''):
-
-    dstr = "buildDailyIntervalQueries(select_str={}, locid={}, extra_conditions={}, group_by={}, aggregate={})".format(select_str, locid, extra_conditions, group_by, aggregate)
-    logging.debug(dstr)
+# rows fetched at a time when streaming query results, see fetchRows()
+FETCH_BATCH_ROWS = 1000
 
-    if len(aggregate) > 0:
-        aggregate = 'SELECT ' + aggregate + ' FROM ('
-        group_by = group_by + ')'
 
-    # build the common query string template, time specific parts added later
-    qtemplate = "{} SELECT {} FROM datenorm_observation WHERE location_id={} {} AND ({{}}) {}".format(aggregate, select_str, locid, extra_conditions, group_by)
-    dstr = "buildDailyIntervalQueries() query template is: {}".format(qtemplate)
-    logging.debug(dstr)
+# SQL CASE expression converting an observation's bucket (see
+# observationKeys()) to its time of day, as used for tod in daily_tod_stats
+def buildBucketTODExpr():
+    case_str = "CASE bucket {} END".format(
+            ' '.join("WHEN {} THEN '{}'".format(code, tod) for code, tod in enumerate(TOD_NAMES)))
+    return case_str
 
-    # the time section of the query is specific to each interval
-    mornstr = "time BETWEEN \"{}\" and \"{}\"".format(MORNING_HOUR_START, MORNING_HOUR_END)
-    daystr = "time BETWEEN \"{}\" and \"{}\"".format(DAYTIME_HOUR_START, DAYTIME_HOUR_END)
-    evestr = "time BETWEEN \"{}\" and \"{}\"".format(EVENING_HOUR_START, EVENING_HOUR_END)
-    nightstr = "time BETWEEN \"{}\" and \"{}\" OR time BETWEEN \"{}\" and \"{}\"".format(OVERNIGHT_HOUR_START, "24:00:00", "00:00:00", OVERNIGHT_HOUR_END)
-
-    # the resulting complete query strings
-    qry_strs = {
-            'morn': qtemplate.format(mornstr),
-            'day': qtemplate.format(daystr),
-            'eve': qtemplate.format(evestr),
-            'night': qtemplate.format(nightstr)
-    }
-    dstr = "buildDailyIntervalQueries() built query strings:\n{}\n{}\n{}\n{}".format(qry_strs['morn'], qry_strs['day'], qry_strs['eve'], qry_strs['night'])
+
+# dict to convert daily_tod_stats tod to the keys used by calc*() results
+TOD_KEYS = {
+        '0-night': 'night',
+        '1-morn': 'morn',
+        '2-day': 'day',
+        '3-eve': 'eve',
+}
+
+
+# calculate the results of all the calc*() functions, for all locations
+# at once, using two grouped queries rather than a set per location
+# if locid is given, results are only calculated for that location
+# if extras, rainfall, wind, pressure and dew point are also summarised
+# (see calcExtraSummaries())
+# if percentiles, the SUMMARY_PERCENTILES of temperatures are found from
+# the sketches of each date (see calcTODPercentiles())
+# returns dict of location id -> dict of results, keyed as per the
+# printLocationSummary() arguments (temps, tranges, spread, ...)
+def calcLocationSummaries(dbc, locid=None, extras=False, percentiles=False):
+    if locid is None:
+        obs_condition = ''
+        obs_params = ()
+    else:
+        obs_condition = 'AND location_id = ?'
+        obs_params = (locid,)
+    # per observation averages, for each time of day, in order of date and
+    # time (as for dailyTODStatsSelect())
+    extra_aggregates = ''
+    extra_columns = ''
+    if extras:
+        extra_aggregates = """,
+           SUM(rain) / COUNT(DISTINCT date) AS avrain,
+           AVG(wind_spd_kmh) AS avw,
+           AVG(press_msl) AS avp,
+           AVG(dewpt) AS avdp"""
+        extra_columns = ", rain, wind_spd_kmh, press_msl, dewpt"
+    obs_qrystr = """
+    SELECT location_id, {} AS tod,
+           AVG(air_temp) AS avt,
+           AVG(CASE WHEN relative_humidity >= 0 THEN relative_humidity END) AS avr,
+           AVG(CASE WHEN cloud_oktas >= 0 THEN cloud_oktas END) AS avc{}
+    FROM (
+        SELECT location_id, bucket, date, air_temp, relative_humidity, cloud_oktas{}
+        FROM datenorm_observation
+        WHERE bucket IS NOT NULL {}
+        ORDER BY location_id, bucket, date, time
+    )
+    GROUP BY location_id, bucket
+    """.format(buildBucketTODExpr(), extra_aggregates, extra_columns, obs_condition)
+    # averages and ranges of daily values, for each time of day
+    daily_qrystr = """
+    SELECT daily_tod_stats.location_id AS location_id,
+           daily_tod_stats.tod AS tod,
+           MIN(ava) AS min_ava,
+           MAX(ava) AS max_ava,
+           AVG(tspread) AS avs,
+           AVG(ABS(tdiff)) AS avd
+    FROM daily_tod_stats
+    NATURAL LEFT OUTER JOIN daytoday_avgt_diffs
+    GROUP BY daily_tod_stats.location_id, daily_tod_stats.tod
+    """
+    daily_params = ()
+    if locid is not None:
+        if SQLITE_HAS_WINDOW_FUNCTIONS:
+            # the diffs view is over all locations, so calculate just this
+            # location's diffs (by name, as in daytoday_avgt_diffs) here
+            daily_qrystr = """
+            SELECT location_id, tod,
+                   MIN(ava) AS min_ava,
+                   MAX(ava) AS max_ava,
+                   AVG(tspread) AS avs,
+                   AVG(ABS(tdiff)) AS avd
+            FROM (
+                SELECT location_id, tod, ava, tspread,
+                       ava - LAG(ava) OVER (PARTITION BY tod ORDER BY date) AS tdiff
+                FROM daily_tod_stats
+                WHERE name = (SELECT name FROM location WHERE id = ?)
+            )
+            WHERE location_id = ?
+            GROUP BY location_id, tod
+            """
+            daily_params = (locid, locid)
+        else:
+            daily_qrystr = daily_qrystr.replace("GROUP BY", "WHERE daily_tod_stats.location_id = ?\n    GROUP BY")
+            daily_params = (locid,)
+
+    dstr = "calcLocationSummaries() executing query strings: {}\n{}".format(obs_qrystr, daily_qrystr)
     logging.debug(dstr)
 
-    return qry_strs
+    summaries = {}
+    def locationSummary(row_locid):
+        if row_locid not in summaries:
+            summaries[row_locid] = {
+                    'temps': {},
+                    'tranges': {},
+                    'spread': {},
+                    'diffs': {},
+                    'humidity': {},
+                    'cloud': {}
+            }
+            if extras:
+                summaries[row_locid].update({key: {} for key in EXTRA_SUMMARY_KEYS})
+            if percentiles:
+                summaries[row_locid].update({key: {} for key in PERCENTILE_SUMMARY_KEYS})
+        return summaries[row_locid]
 
+    dbc.execute(obs_qrystr, obs_params)
+    for row in dbc.fetchall():
+        summary = locationSummary(row[0])
+        tod = TOD_KEYS[row[1]]
+        summary['temps'][tod] = float(row[2])
+        summary['humidity'][tod] = float(row[3])
+        cloudiness = row[4]
+        if cloudiness is None:
+            cloudiness = '-1'
+        summary['cloud'][tod] = int(float(cloudiness))
+        if extras:
+            summary['rain'][tod] = row[5]
+            summary['wind_spd'][tod] = row[6]
+            summary['pressure'][tod] = row[7]
+            summary['dewpt'][tod] = row[8]
+            summary['wind_dir'][tod] = None
 
-# AVG/MAX/MIN temps within the daily intervals, across all samples for loc
-# returns a dict of temps, keys are night, morn, day, eve
-def calcTypicalTemps(dbc, locid, fn):
-    qryfn = "{}(air_temp)".format(fn) # fn is AVG, MIN or MAX
-    qry_strs = buildDailyIntervalQueries(qryfn, locid)
-    result = {}
-    for qry in qry_strs:
-        dbc.execute(qry_strs[qry])
-        result[qry] = float(dbc.fetchone()[0])
-    return result
+    if extras:
+        calcPrevailingWinds(dbc, summaries, obs_condition, obs_params)
+    if percentiles:
+        calcTODPercentiles(dbc, summaries, obs_condition, obs_params)
 
+    dbc.execute(daily_qrystr, daily_params)
+    for row in dbc.fetchall():
+        summary = locationSummary(row[0])
+        tod = TOD_KEYS[row[1]]
+        summary['tranges'][tod] = {
+                'min': float(row[2]),
+                'max': float(row[3])
+        }
+        summary['spread'][tod] = float(row[4])
+        summary['diffs'][tod] = float(row[5])
 
-# this is done slightly differently to the other calcTypical.. functions
-# it uses the daytoday_avgt_diffs view, instead of directly accessing
-# datenorm_observation, which it is derived from
-def calcTypicalTempDiff(dbc, locname):
+    return summaries
 
-    qtemplate = "SELECT AVG(ABS(tdiff)) FROM daytoday_avgt_diffs WHERE name = '{}' AND tod = '{}'"
-    # the resulting complete query strings
-    qry_strs = {
-            'morn': qtemplate.format(locname, '1-morn'),
-            'day': qtemplate.format(locname, '2-day'),
-            'eve': qtemplate.format(locname, '3-eve'),
-            'night': qtemplate.format(locname, '0-night')
-    }
 
-    dstr = "calcTypicalTempDiff() built query strings:\n{}\n{}\n{}\n{}".format(qry_strs['morn'], qry_strs['day'], qry_strs['eve'], qry_strs['night'])
+# keys of the extra summary results, see calcLocationSummaries(), each is
+# a dict by time of day, with None for no readings:
+#     rain: average rainfall (mm) for each day
+#     wind_dir: prevailing (most frequent) wind direction
+#     wind_spd: average wind speed (km/h)
+#     pressure: average mean sea level pressure (hPa)
+#     dewpt: average dew point
+EXTRA_SUMMARY_KEYS = ['rain', 'wind_dir', 'wind_spd', 'pressure', 'dewpt']
+
+
+# set the prevailing wind direction of each location and time of day in
+# summaries (from calcLocationSummaries()), from a grouped count of wind
+# directions, the most frequent (and earliest in alphabetical order, when
+# as frequent) is prevailing
+# obs_condition and obs_params restrict the observations, as for
+# calcLocationSummaries()
+def calcPrevailingWinds(dbc, summaries, obs_condition='', obs_params=()):
+    qrystr = """
+    SELECT location_id, {} AS tod, wind_dir, COUNT(*) AS n
+    FROM datenorm_observation
+    WHERE bucket IS NOT NULL AND wind_dir IS NOT NULL {}
+    GROUP BY location_id, bucket, wind_dir
+    ORDER BY location_id, bucket, n DESC, wind_dir
+    """.format(buildBucketTODExpr(), obs_condition)
+
+    dstr = "calcPrevailingWinds() executing query string: {}".format(qrystr)
     logging.debug(dstr)
 
-    result = {}
-    for qry in qry_strs:
-        dbc.execute(qry_strs[qry])
-        result[qry] = float(dbc.fetchone()[0])
-    return result
+    dbc.execute(qrystr, obs_params)
+    for row in dbc.fetchall():
+        if row[0] not in summaries:
+            continue
+        winds = summaries[row[0]]['wind_dir']
+        tod = TOD_KEYS[row[1]]
+        if winds.get(tod) is None:
+            winds[tod] = row[2]
 
 
-# determine average of the temperature spread within a daily interval for loc
-# returns a dict of temp spreads, keys are night, morn, day, eve
-def calcTypicalTempSpread(dbc, locid):
-    qry_strs = buildDailyIntervalQueries('(MAX(air_temp)-MIN(air_temp)) as t_spread', locid, '', 'GROUP BY date', 'AVG(t_spread)')
-    result = {}
-    for qry in qry_strs:
-        dbc.execute(qry_strs[qry])
-        result[qry] = float(dbc.fetchone()[0])
-    return result
+# read-only database connection for each summary worker thread
+_summary_worker_state = threading.local()
 
 
-# average humidity within daily intervals, across all samples for given loc
-# returns a dict of humidity, keys are night, morn, day, eve
-def calcTypicalHumidity(dbc, locid):
-    qry_strs = buildDailyIntervalQueries('AVG(relative_humidity)', locid, 'AND relative_humidity >= 0')
-    result = {}
-    for qry in qry_strs:
-        dbc.execute(qry_strs[qry])
-        result[qry] = float(dbc.fetchone()[0])
-    return result
+# initialise a summary worker thread, with its own read-only connection
+def _initSummaryWorker(dbfile, extras=False, storage=None, percentiles=False):
+    uri = 'file:{}?mode=ro'.format(urllib.request.pathname2url(os.path.abspath(dbfile)))
+    _summary_worker_state.conn = sqlite3.connect(uri, uri=True)
+    applyStorageProfile(_summary_worker_state.conn, storage, readonly=True)
+    _summary_worker_state.extras = extras
+    _summary_worker_state.percentiles = percentiles
 
 
-# determine typical cloudiness (0-8) within a daily interval for given loc
-# returns a dict of cloud oktas, keys are night, morn, day, eve
-def calcCloudiness(dbc, locid):
-    #qry_strs = buildDailyIntervalQueries('COUNT(cloud)', locid, "AND cloud LIKE '%cloudy'")
-    qry_strs = buildDailyIntervalQueries('AVG(cloud_oktas)', locid, 'AND cloud_oktas >= 0')
-    result = {}
-    for qry in qry_strs:
-        dbc.execute(qry_strs[qry])
-        cloudiness = dbc.fetchone()[0]
-        if cloudiness is None:
-            cloudiness = '-1'
-        result[qry] = int(cloudiness)
-    return result
+# as per calcLocationSummaries() for a single location, for Pool.imap()
+# returns tuple of location id and its summary (None if no observations)
+def _calcLocationSummaryWorker(locid):
+    dbc = _summary_worker_state.conn.cursor()
+    summary = calcLocationSummaries(dbc, locid, _summary_worker_state.extras,
+            _summary_worker_state.percentiles).get(locid)
+    dbc.close()
+    return locid, summary
+
+
+# calculate location summaries, as per calcLocationSummaries(), for each
+# location in a pool of threads, each with its own read-only connection to
+# the database file (sqlite releases the GIL while running queries)
+# the views (or tables) queried must already be committed to the file
+# connections use the per connection settings of the storage profile
+def calcLocationSummariesParallel(dbfile, locids, jobs, extras=False, storage=None, percentiles=False):
+    dstr = "calculating summaries for {} locations with {} threads".format(len(locids), jobs)
+    logging.info(dstr)
+    summaries = {}
+    with multiprocessing.pool.ThreadPool(jobs, _initSummaryWorker, (dbfile, extras, storage, percentiles)) as pool:
+        for locid, summary in pool.imap_unordered(_calcLocationSummaryWorker, locids):
+            if summary is not None:
+                summaries[locid] = summary
+    return summaries
 
 
 # print the results obtained from calc*() queries for a given location
-def printLocationSummary(locname, temps, tranges, spread, diffs, humidity, cloud):
+# to out (a file, default stdout)
+def printLocationSummary(locname, temps, tranges, spread, diffs, humidity, cloud, out=None):
     # Note: cloud oktas doesn't appear useful, to print, use for eg:
     #       print("{}/8".format(cloud['morn']))
 
@@ -181,12 +459,55 @@ def printLocationSummary(locname, temps, tranges, spread, diffs, humidity, cloud
             temps[tod], (spread[tod]/2),
             tranges[tod]['min'], tranges[tod]['max'],
             diffs[tod],
-            humidity[tod]))
+            humidity[tod]), file=out)
 
     #dstr = "{}: evening {:.1f} +/-{:.1f} (d {:.1f}) {:.0f}%".format(locname, temps['night'], (spread['night']/2), diffs['night'], humidity['night'], temps['morn'], (spread['morn']/2), diffs['morn'], humidity['morn'], temps['day'], (spread['day']/2), diffs['day'], humidity['day'], temps['eve'], (spread['eve']/2), diffs['eve'], humidity['eve'])
     #logging.debug(dstr)
 
 
+# print the extra results (rainfall, wind, pressure and dew point) for a
+# given location, as from calcLocationSummaries() with extras, to out
+# (a file, default stdout), readings that are all missing are shown as -
+def printLocationExtras(locname, summary, out=None):
+    tod_strs = {
+            'morn': 'morning',
+            'day': 'daytime',
+            'eve': 'evening',
+            'night': 'overnight'
+    }
+
+    def fmt(value, spec):
+        return '-' if value is None else spec.format(value)
+
+    for tod in ('night', 'morn', 'day', 'eve'):
+        print("{}: {} rain {}mm/day, wind {} {}km/h, {}hPa, dew point {}".format(
+            locname, tod_strs[tod],
+            fmt(summary['rain'][tod], '{:.1f}'),
+            fmt(summary['wind_dir'][tod], '{}'), fmt(summary['wind_spd'][tod], '{:.0f}'),
+            fmt(summary['pressure'][tod], '{:.1f}'),
+            fmt(summary['dewpt'][tod], '{:.1f}')), file=out)
+
+
+# print the percentiles (as from calcLocationSummaries() with percentiles)
+# of a given location's temperatures, to out (a file, default stdout)
+def printLocationPercentiles(locname, summary, out=None):
+    tod_strs = {
+            'morn': 'morning',
+            'day': 'daytime',
+            'eve': 'evening',
+            'night': 'overnight'
+    }
+
+    def fmt(value):
+        return '-' if value is None else '{:.1f}'.format(value)
+
+    for tod in ('night', 'morn', 'day', 'eve'):
+        print("{}: {} median {} [10% {}, 90% {}]".format(
+            locname, tod_strs[tod],
+            fmt(summary['median'].get(tod)),
+            fmt(summary['p10'].get(tod)), fmt(summary['p90'].get(tod))), file=out)
+
+
 # return a list of location id, name records
 def getLocations(dbc):
     dbc.execute("SELECT * FROM location")
@@ -214,96 +535,114 @@ def getObservationDateRange(dbc, locid=None):
 
 
 # print details of the dates/range being covered
-# as provided by getObservationDateRange()
-def printObservationDatesSummary(obs_range):
-    print("Observations cover {} days, from {} to {}".format(obs_range['days'], obs_range['first'], obs_range['last']))
+# as provided by getObservationDateRange(), to out (a file, default stdout)
+def printObservationDatesSummary(obs_range, out=None):
+    print("Observations cover {} days, from {} to {}".format(obs_range['days'], obs_range['first'], obs_range['last']), file=out)
+
+
+# drop a view or table, whichever the named relation currently is
+# (a persistent database may have either, from an earlier run)
+def dropRelation(dbc, name):
+    dbc.execute("SELECT type FROM sqlite_master WHERE name = ?", (name,))
+    row = dbc.fetchone()
+    if row is not None and row[0] in ('view', 'table'):
+        dbc.execute("DROP {} {}".format(row[0].upper(), name))
 
 
 # calculate the change in avg temps from one day to next
-# ideally this would be done with a SQL LAG function
-# but sqlite doesn't support it
-# ref: https://stackoverflow.com/questions/10003313/create-a-sqlite-view-where-a-row-depends-on-the-previous-row
-def calcDayToDayTODAvgTempDiffs(dbc):
+# this is done with the SQL LAG window function, if sqlite supports it,
+# otherwise by a single pass over the daily stats, into a table
+# if temp, the view (or table) is temporary, see createFilteredViews()
+def calcDayToDayTODAvgTempDiffs(dbc, temp=False):
+    if not temp:
+        dropRelation(dbc, 'daytoday_avgt_diffs')
+
+    if not SQLITE_HAS_WINDOW_FUNCTIONS:
+        calcDayToDayTODAvgTempDiffsTable(dbc, temp)
+        return
+
     view_str = """
-    DROP VIEW IF EXISTS daytoday_avgt_diffs;
-    CREATE VIEW daytoday_avgt_diffs AS
-    SELECT d1.date as date, d1.tod as tod, d1.name as name,
-        d1.ava-d2.ava as tdiff
-    FROM
-        daily_tod_stats d1, daily_tod_stats d2,
-        (SELECT t2.date AS date1, MAX(t1.date) AS date2,
-            t1.tod AS tod, t1.name AS name
-        FROM daily_tod_stats t1, daily_tod_stats t2
-        WHERE t1.date < t2.date
-            AND t1.tod = t2.tod
-            AND t1.name = t2.name
-        GROUP BY t2.date, t2.tod, t2.name) AS prev
-    WHERE d1.date = prev.date1 AND d2.date = prev.date2
-        AND d1.tod = prev.tod AND d2.tod = prev.tod
-        AND d1.name = prev.name AND d2.name = prev.name
+    CREATE {}VIEW daytoday_avgt_diffs AS
+    SELECT date, tod, name, tdiff
+    FROM (
+        SELECT date, tod, name,
+            LAG(date) OVER win AS prev_date,
+            ava - LAG(ava) OVER win AS tdiff
+        FROM daily_tod_stats
+        WINDOW win AS (PARTITION BY name, tod ORDER BY date)
+    )
+    WHERE prev_date IS NOT NULL
     ORDER BY date, tod, name
     ;
-    """
+    """.format('TEMP ' if temp else '')
     dstr = "calcDayToDayTODAvgTempDiffs() creating view with: {}".format(view_str)
     logging.debug(dstr)
 
     dbc.executescript(view_str)
 
 
-# create view of date, time of day stats
-def createDailyTODStats(dbc):
+# as per calcDayToDayTODAvgTempDiffs(), for sqlite versions without LAG
+# the first date for each location and time of day has no previous date,
+# so like the view has no diff
+def calcDayToDayTODAvgTempDiffsTable(dbc, temp=False):
+    dbc.executescript("""
+    CREATE {}TABLE daytoday_avgt_diffs(
+        date TEXT,
+        tod TEXT,
+        name TEXT,
+        tdiff REAL
+    );
+    """.format('TEMP ' if temp else ''))
+    dbc.execute("SELECT date, tod, name, ava FROM daily_tod_stats ORDER BY name, tod, date")
+    rows = []
+    prev = None
+    for row in dbc.fetchall():
+        if prev is not None and prev[1] == row[1] and prev[2] == row[2]:
+            rows.append((row[0], row[1], row[2], row[3]-prev[3]))
+        prev = row
+    dbc.executemany("INSERT INTO daytoday_avgt_diffs VALUES(?, ?, ?, ?)", rows)
+    dstr = "calcDayToDayTODAvgTempDiffsTable() added {} rows".format(len(rows))
+    logging.debug(dstr)
+
+
+# the select statement for daily_tod_stats, from datenorm_observation
+# extra conditions (eg. AND date > '2018-01-01') restrict the dates used
+def dailyTODStatsSelect(conditions=''):
     # note use of digit prefix on tod for desired ordering
     # will use a dict to convert results for printing:
     # eg: '1-morn' to 'morning'
-    view_str = """
-    DROP VIEW IF EXISTS daily_tod_stats;
-    CREATE VIEW daily_tod_stats AS
-    SELECT date, tod, name, ava, tspread, avr
+    # observations are averaged in order of time (as the index on bucket
+    # gives them), whichever index is used, for consistent rounding
+    select_str = """
+    SELECT date, tod, name, ava, tspread, avr, location_id
     FROM (
         SELECT AVG(air_temp) AS ava,
                (MAX(air_temp)-MIN(air_temp)) as tspread,
                AVG(relative_humidity) as avr,
-               '0-night' AS tod,
-               date, location_id
-        FROM datenorm_observation
-        WHERE time BETWEEN \"{}\" AND \"24:00\"
-           OR time BETWEEN \"00:00\" AND \"{}\"
-        GROUP BY date, location_id
-        UNION
-        SELECT avg(air_temp) AS ava,
-               (MAX(air_temp)-MIN(air_temp)) as tspread,
-               AVG(relative_humidity) as avr,
-               '1-morn' AS tod,
-               date, location_id
-        FROM datenorm_observation
-        WHERE time BETWEEN \"{}\" AND \"{}\"
-        GROUP BY date, location_id
-        UNION
-        SELECT AVG(air_temp) AS ava,
-               (MAX(air_temp)-MIN(air_temp)) as tspread,
-               AVG(relative_humidity) as avr,
-               '2-day' AS tod,
-               date, location_id
-        FROM datenorm_observation
-        WHERE time BETWEEN \"{}\" AND \"{}\"
-        GROUP BY date, location_id
-        UNION
-        SELECT AVG(air_temp) AS ava,
-               (MAX(air_temp)-MIN(air_temp)) as tspread,
-               AVG(relative_humidity) as avr,
-               '3-eve' AS tod,
+               {} AS tod,
                date, location_id
-        FROM datenorm_observation
-        WHERE time BETWEEN \"{}\" AND \"{}\"
-        GROUP BY date, location_id
+        FROM (
+            SELECT location_id, bucket, date, air_temp, relative_humidity
+            FROM datenorm_observation
+            WHERE bucket IS NOT NULL {}
+            ORDER BY location_id, bucket, date, time
+        )
+        GROUP BY location_id, bucket, date
     ) avtable
     INNER JOIN location
     ON location.id = avtable.location_id
     ORDER BY date, tod, name
-    """.format(OVERNIGHT_HOUR_START, OVERNIGHT_HOUR_END,
-            MORNING_HOUR_START, MORNING_HOUR_END,
-            DAYTIME_HOUR_START, DAYTIME_HOUR_END,
-            EVENING_HOUR_START, EVENING_HOUR_END)
+    """.format(buildBucketTODExpr(), conditions)
+    return select_str
+
+
+# create view of date, time of day stats
+def createDailyTODStats(dbc):
+    dropRelation(dbc, 'daily_tod_stats')
+    view_str = """
+    CREATE VIEW daily_tod_stats AS
+    {}
+    """.format(dailyTODStatsSelect())
 
     dstr = "createDailyTODStats() creating view with: {}".format(view_str)
     logging.debug(dstr)
@@ -313,8 +652,14 @@ def createDailyTODStats(dbc):
 
 # run an SQL query to get:
 #     average, daily change and spread of temperature, relative humidity
-# for each date, time interval and location
-def getDailyObservations(dbc):
+# for each date, time interval and location (or just location locid)
+def getDailyObservations(dbc, locid=None):
+    if locid is None:
+        wherestr = ""
+        params = ()
+    else:
+        wherestr = "WHERE daily_tod_stats.location_id = ?"
+        params = (locid,)
     qrystr = """
     SELECT daily_tod_stats.date AS date,
            daily_tod_stats.tod AS tod,
@@ -325,42 +670,31 @@ def getDailyObservations(dbc):
            daily_tod_stats.avr as avr
     FROM daily_tod_stats
     NATURAL LEFT OUTER JOIN daytoday_avgt_diffs
+    {}
     ORDER BY date, tod, name
-    """
+    """.format(wherestr)
 
     dstr = "getDailyObservations() executing query string: {}".format(qrystr)
     logging.debug(dstr)
 
-    dbc.execute(qrystr)
-    rows = dbc.fetchall()
-    return rows
-
-
-# get max and min values for ava for specified loc and tod
-def calcRangeTypicalTemps(dbc, locname, tod):
-    qrystr = """
-    SELECT 
-           MIN(ava) AS min_ava,
-           MAX(ava) AS max_ava
-    FROM daily_tod_stats
-    WHERE name = '{}' AND tod = '{}'
-    """.format(locname, tod)
-
-    dstr = "calcRangeTypicalTemps() executing query string: {}".format(qrystr)
-    logging.debug(dstr)
+    dbc.execute(qrystr, params)
+    # rows are generated as they're fetched, rather than all held at once
+    return fetchRows(dbc)
 
-    dbc.execute(qrystr)
-    row = dbc.fetchone()
 
-    trange = {
-            'min': float(row[0]),
-            'max': float(row[1])
-    }
-    return trange
+# generate the rows of a query, as executed by dbc, fetching in batches
+# (so dbc can't be used for other queries until all rows are generated)
+def fetchRows(dbc, size=FETCH_BATCH_ROWS):
+    while True:
+        rows = dbc.fetchmany(size)
+        if not rows:
+            break
+        yield from rows
 
 
 # print results obtained from getDailyObservations() query
-def printObsByDate(observation_list):
+# observations can be any iterable of rows, to out (a file, default stdout)
+def printObsByDate(observation_list, out=None):
     todname = {
             '0-night': 'overnight',
             '1-morn': 'morning',
@@ -368,9 +702,7 @@ def printObsByDate(observation_list):
             '3-eve': 'evening',
     }
 
-    dstr = "printObsByDate() observation_list contains {} elements".format(len(observation_list))
-    logging.debug(dstr)
-
+    nobs = 0
     for obs in observation_list:
         # the first day won't have a tdiff value, it will be None
         tdiff = obs['tdiff']
@@ -378,23 +710,42 @@ def printObsByDate(observation_list):
             tdiff = 0.0
         print("{} {}: {} {:.1f} +/-{:.1f} (d={:.1f}) {:.0f}%".format(
             obs['date'], todname[obs['tod']], obs['name'],
-            obs['ava'], (obs['tspread']/2), tdiff, obs['avr']))
+            obs['ava'], (obs['tspread']/2), tdiff, obs['avr']), file=out)
+        nobs += 1
 
+    dstr = "printObsByDate() printed {} observations".format(nobs)
+    logging.debug(dstr)
+    return nobs
 
-# returns dict of dict: tod -> max/min -> value
-def getRangeAvgTemps(dbc, loc):
-    obsrange = {}
-    tods = {
-            'night': '0-night',
-            'morn': '1-morn',
-            'day': '2-day',
-            'eve': '3-eve',
-    }
-
-    for tod in tods:
-        obsrange[tod] = calcRangeTypicalTemps(dbc, loc, tods[tod])
 
-    return obsrange
+# the select statement for datenorm_observation
+# overnight observations are moved to the following date (their
+# report_date), except for the last date's, as that date's overnight
+# period isn't complete
+# extra conditions (eg. AND date > '2018-01-01') restrict the observations
+# used, date being the date the observation was made
+# if max_date is given, it's taken as the last date, rather than the last
+# date of the observations (eg. of all shards, see calcShardPartial())
+def dateNormalisedSelect(conditions='', max_date=None):
+    select_str = """
+        SELECT location_id,
+            report_date AS date,
+            time,
+            air_temp,
+            apparent_temp,
+            relative_humidity,
+            cloud_oktas,
+            rain,
+            wind_dir,
+            wind_spd_kmh,
+            press_msl,
+            dewpt,
+            minutes,
+            bucket
+        FROM observation
+        WHERE report_date <= {} {}
+        """.format("(SELECT MAX(date) FROM observation)" if max_date is None else "'{}'".format(max_date), conditions)
+    return select_str
 
 
 # create a view to deal with overnight observations that straddle dates
@@ -402,27 +753,11 @@ def getRangeAvgTemps(dbc, loc):
 # at this time), so first date's overnight readings will be complete,
 # but last won't - so not included
 def create_date_normalised_observations(dbc):
+    dropRelation(dbc, 'datenorm_observation')
     view_str = """
-        DROP VIEW IF EXISTS datenorm_observation;
         CREATE VIEW datenorm_observation AS
-        SELECT location_id,
-            DATE(observation.date, '+1 day') as date,
-            time,
-            air_temp,
-            apparent_temp,
-            relative_humidity,
-            cloud_oktas
-        FROM observation WHERE time >= TIME(\"{}\")
-        AND date < (SELECT MAX(date) FROM observation)
-        UNION SELECT location_id,
-            date,
-            time,
-            air_temp,
-            apparent_temp,
-            relative_humidity,
-            cloud_oktas
-        FROM observation WHERE time < TIME(\"{}\");
-        """.format(OVERNIGHT_HOUR_START, OVERNIGHT_HOUR_START)
+        {};
+        """.format(dateNormalisedSelect())
 
     dstr = "create_date_normalised_observations() creating view with: {}".format(view_str)
     logging.debug(dstr)
@@ -435,63 +770,771 @@ def create_date_normalised_observations(dbc):
     #    logging.debug(row)
 
 
+# create datenorm_observation and daily_tod_stats as indexed tables,
+# rather than views, so reports don't recalculate them on every query
+# if the tables already exist, only the dates of observations ingested
+# since they were last refreshed are recalculated (see refresh_pending)
+def materialiseDailyStats(dbc):
+    dbc.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name IN ('datenorm_observation', 'daily_tod_stats')")
+    # tables from before columns were added to observation are recreated
+    if dbc.fetchone()[0] == 2 and 'bucket' in getTableColumns(dbc, 'datenorm_observation'):
+        refreshMaterialisedDailyStats(dbc)
+        return
+
+    dropRelation(dbc, 'datenorm_observation')
+    dropRelation(dbc, 'daily_tod_stats')
+    table_str = """
+        CREATE TABLE datenorm_observation(
+            location_id INTEGER NOT NULL,
+            date TEXT,
+            time TEXT,
+            air_temp REAL,
+            apparent_temp REAL,
+            relative_humidity REAL,
+            cloud_oktas INTEGER,
+            rain REAL,
+            wind_dir TEXT,
+            wind_spd_kmh REAL,
+            press_msl REAL,
+            dewpt REAL,
+            minutes INTEGER,
+            bucket INTEGER,
+            PRIMARY KEY(location_id, date, time)
+        );
+        CREATE INDEX datenorm_observation_bucket
+            ON datenorm_observation(location_id, bucket, date, time, air_temp, relative_humidity, cloud_oktas);
+        INSERT INTO datenorm_observation {};
+        CREATE TABLE daily_tod_stats(
+            date TEXT,
+            tod TEXT,
+            name TEXT,
+            ava REAL,
+            tspread REAL,
+            avr REAL,
+            location_id INTEGER NOT NULL,
+            PRIMARY KEY(location_id, tod, date)
+        );
+        CREATE INDEX daily_tod_stats_name ON daily_tod_stats(name, tod, date);
+        INSERT INTO daily_tod_stats {};
+        DELETE FROM refresh_pending;
+        """.format(dateNormalisedSelect(), dailyTODStatsSelect())
+
+    dstr = "materialiseDailyStats() creating tables with: {}".format(table_str)
+    logging.debug(dstr)
+
+    dbc.executescript(table_str)
+    setMetadata(dbc, 'materialised_max_date', getObservationDateRange(dbc)['last'])
+    dbc.connection.commit()
+
+
+# recalculate the materialised tables for dates with new observations
+# an observation affects its own date, and the following date's overnight
+# period, if it is after OVERNIGHT_HOUR_START
+# as the last date's overnight observations aren't included in
+# datenorm_observation, when the last date changes, the following date's
+# overnight period also needs refreshing for all locations
+# observations reported for a date were made on it or the date before, which
+# are given as dates so that they're found by the primary key
+def refreshMaterialisedDailyStats(dbc):
+    last_date = getObservationDateRange(dbc)['last']
+    prev_last_date = getMetadata(dbc, 'materialised_max_date')
+    refresh_str = """
+        DROP TABLE IF EXISTS temp.refresh_date;
+        CREATE TEMP TABLE refresh_date(
+            location_id INTEGER NOT NULL,
+            date TEXT,
+            PRIMARY KEY(location_id, date)
+        );
+        INSERT OR IGNORE INTO temp.refresh_date
+            SELECT location_id, date FROM refresh_pending
+            UNION SELECT location_id, DATE(date, '+1 day') FROM refresh_pending;
+        """
+    if prev_last_date is not None and prev_last_date != last_date:
+        refresh_str += """
+        INSERT OR IGNORE INTO temp.refresh_date
+            SELECT id, DATE('{}', '+1 day') FROM location;
+        """.format(prev_last_date)
+    refresh_str += """
+        DELETE FROM datenorm_observation
+            WHERE (location_id, date) IN (SELECT location_id, date FROM temp.refresh_date);
+        INSERT INTO datenorm_observation {};
+        DELETE FROM daily_tod_stats
+            WHERE (location_id, date) IN (SELECT location_id, date FROM temp.refresh_date);
+        INSERT INTO daily_tod_stats {};
+        DELETE FROM refresh_pending;
+        """.format(dateNormalisedSelect("""
+                AND (location_id, date) IN (SELECT location_id, date FROM temp.refresh_date
+                    UNION SELECT location_id, DATE(date, '-1 day') FROM temp.refresh_date)
+                AND (location_id, report_date) IN (SELECT location_id, date FROM temp.refresh_date)"""),
+            dailyTODStatsSelect("AND (location_id, date) IN (SELECT location_id, date FROM temp.refresh_date)"))
+
+    dstr = "refreshMaterialisedDailyStats() refreshing tables with: {}".format(refresh_str)
+    logging.debug(dstr)
+
+    dbc.executescript(refresh_str)
+    dbc.execute("SELECT COUNT(*) FROM temp.refresh_date")
+    dstr = "refreshed {} location dates".format(dbc.fetchone()[0])
+    logging.info(dstr)
+    setMetadata(dbc, 'materialised_max_date', last_date)
+    dbc.connection.commit()
+
+
+# get a value from the metadata table, None if not set
+def getMetadata(dbc, key):
+    dbc.execute("SELECT value FROM metadata WHERE key = ?", (key,))
+    row = dbc.fetchone()
+    if row is None:
+        return None
+    return row[0]
+
+
+# set a value in the metadata table
+def setMetadata(dbc, key, value):
+    dbc.execute("INSERT OR REPLACE INTO metadata(key, value) VALUES(?, ?)", (key, value))
+
+
+# insert statement for observation rows, as built by observationRow()
+# the first of any duplicated observations is kept, except that its rain
+# is filled in if unknown, as the reading before it (see calcRainDeltas())
+# may only be in a later file
+INSERT_OBSERVATION = """
+    INSERT INTO observation(location_id, date, time, air_temp, apparent_temp, relative_humidity, cloud_oktas,
+        rain_trace, rain, wind_dir, wind_spd_kmh, press_msl, dewpt, minutes, report_date, bucket)
+    VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(location_id, date, time) DO UPDATE SET rain = excluded.rain
+    WHERE rain IS NULL AND excluded.rain IS NOT NULL
+    """
+
+# rain_trace is the rainfall (mm) since 9am, when it's reset
+RAIN_RESET_TIME = "09:00:00"
+
+# wind directions, as given by wind_dir, and their codes (index) as used
+# by archives and the columnar engine (-1 for missing)
+WIND_DIRS = ['N', 'NNE', 'NE', 'ENE', 'E', 'ESE', 'SE', 'SSE',
+        'S', 'SSW', 'SW', 'WSW', 'W', 'WNW', 'NW', 'NNW', 'CALM']
+WIND_DIR_CODES = {wind_dir: code for code, wind_dir in enumerate(WIND_DIRS)}
+
+
+# convert a text reading to a float, None if missing (eg. rain_trace of '-')
+def readingToFloat(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+# get the integer keys of an observation's date (YYYY-MM-DD) and time
+# (HH:MM:SS), stored with it so that queries by report date and time of
+# day are range scans of an index, rather than string comparisons:
+#     minutes: minutes since the epoch (local time)
+#     report_date: the date the observation is reported for, which is the
+#         following date from OVERNIGHT_HOUR_START (see dateNormalisedSelect())
+#     bucket: time of day, the index of its tod in TOD_NAMES (as for the
+#         columnar engine), None if not within any interval
+# returns tuple of minutes, report_date and bucket
+def observationKeys(obs_date, obs_time):
+    day_minutes, next_date = getDateKeys(obs_date)
+    mod, late, bucket = getTimeKeys(obs_time)
+    return (day_minutes + mod, next_date if late else obs_date, bucket)
+
+
+# get minutes since the epoch of the start of a date (YYYY-MM-DD), and the
+# following date, as used by observationKeys()
+@functools.lru_cache(maxsize=4096)
+def getDateKeys(obs_date):
+    day = datetime.date.fromisoformat(obs_date)
+    return ((day.toordinal() - EPOCH_ORDINAL) * 1440, (day + datetime.timedelta(days=1)).isoformat())
+
+
+# get minutes since midnight of a time (HH:MM:SS), whether it's reported
+# for the following date and its time of day bucket, as used by
+# observationKeys()
+@functools.lru_cache(maxsize=4096)
+def getTimeKeys(obs_time):
+    mod = int(obs_time[0:2])*60 + int(obs_time[3:5])
+    bucket = None
+    for code, (start, end) in enumerate(getTODIntervalMinutes()):
+        if (start <= mod < end) if start < end else (mod >= start or mod < end):
+            bucket = code
+    return (mod, mod >= hourToMinutes(OVERNIGHT_HOUR_START), bucket)
+
+
 # extract relevant information from observation dictionary
-# and add to database
-def addObservation(dbc, obs):
+# returns a tuple of values for INSERT_OBSERVATION, or None if invalid
+# rain (since the previous observation) isn't known from a single
+# observation, so is None until set by calcRainDeltas()
+# unlike relative humidity and cloud oktas, missing rain, wind, pressure
+# and dew point readings are None (NULL), as -1 is a valid dew point
+# the row ends with the observation's keys, see observationKeys()
+def observationRow(obs):
     # occasionally data is missing for a location/time
     if obs['air_temp'] is None:
         dstr = "Invalid data! Skipping observation {}".format(obs)
-        logging.warn(dstr)
-        return
-    dstr = "adding observation {} to DB".format(obs)
-    logging.debug(dstr)
-    location_id = int(obs['wmo'])
+        logging.warning(dstr)
+        return None
     # local_date_time_full is YYYYMMDDHHMMSS
-    obsdatetime = datetime.strptime(obs['local_date_time_full'],'%Y%m%d%H%M%S')
-    # convert to SQLite date and time compatible string formats
-    obs_date = obsdatetime.strftime('%Y-%m-%d')
-    obs_time = obsdatetime.strftime('%H:%M:%S')
+    # slice into SQLite date and time compatible string formats
+    dtf = obs['local_date_time_full']
+    obs_date = dtf[0:4] + '-' + dtf[4:6] + '-' + dtf[6:8]
+    obs_time = dtf[8:10] + ':' + dtf[10:12] + ':' + dtf[12:14]
     air_temp = float(obs['air_temp'])
     apparent_temp = obs['apparent_t']
     if apparent_temp is None:
-        apparent_temp = obs['air_temp'] # close enough as not used in averages
-    apparent_temp = float(apparent_temp )
+        apparent_temp = air_temp # close enough as not used in averages
     relative_humidity = obs['rel_hum']
     if relative_humidity is None:
-        relative_humidity = '-1' # will ignore in DB select
-    relative_humidity = float(relative_humidity)
+        relative_humidity = -1 # will ignore in DB select
     cloud_oktas = obs['cloud_oktas']
     if cloud_oktas is None:
-        cloud_oktas = '-1' # will ignore in DB select
-    cloud_oktas = int(cloud_oktas)
-    dbc.execute("INSERT OR IGNORE INTO observation(location_id, date, time, air_temp, apparent_temp, relative_humidity, cloud_oktas) VALUES(?, ?, ?, ?, ?, ?, ?)", (location_id, obs_date, obs_time, air_temp, apparent_temp, relative_humidity, cloud_oktas))
+        cloud_oktas = -1 # will ignore in DB select
+    wind_dir = obs.get('wind_dir')
+    if wind_dir not in WIND_DIR_CODES:
+        wind_dir = None
+    # rain_trace is text, the others are numbers (or null)
+    wind_spd_kmh = obs.get('wind_spd_kmh')
+    press_msl = obs.get('press_msl')
+    dewpt = obs.get('dewpt')
+    return (int(obs['wmo']), obs_date, obs_time, air_temp, float(apparent_temp),
+            float(relative_humidity), int(cloud_oktas),
+            readingToFloat(obs.get('rain_trace')), None, wind_dir,
+            None if wind_spd_kmh is None else float(wind_spd_kmh),
+            None if press_msl is None else float(press_msl),
+            None if dewpt is None else float(dewpt)) + observationKeys(obs_date, obs_time)
+
 
+# set the rain of a location's observation rows (as per observationRow()),
+# the rainfall since the previous observation, from the cumulative
+# rain_trace, which is reset at 9am (RAIN_RESET_TIME)
+# rain before the first observation of a 9am to 9am rain day isn't known
+# unless there's an earlier rain day (so it was reset), or the observation
+# is at 9am, and otherwise is left as None
+# a missing rain_trace is treated as unchanged, and a fall (which would be
+# a correction or a missed reset) as a reset
+# returns the list of rows, in their original order
+def calcRainDeltas(rows):
+    ordinals = {}
+    order = sorted(range(len(rows)), key=lambda i: (rows[i][1], rows[i][2]))
+    rain_day = None
+    known = False
+    base = None
+    for i in order:
+        row = rows[i]
+        if row[1] not in ordinals:
+            ordinals[row[1]] = datetime.date.fromisoformat(row[1]).toordinal()
+        day = ordinals[row[1]] - (row[2] < RAIN_RESET_TIME)
+        if day != rain_day:
+            known = rain_day is not None or row[2] == RAIN_RESET_TIME
+            base = 0.0 if known else None
+            rain_day = day
+        trace = row[7]
+        if trace is None:
+            continue
+        if base is None:
+            rain = None
+        elif trace < base:
+            rain = trace
+        else:
+            rain = trace - base
+        base = trace
+        rows[i] = row[:8] + (rain,) + row[9:]
+    return rows
+
+
+# convert a list of a location's observation dictionaries into observation
+# rows in a single pass, invalid observations are skipped
+def buildObservationRows(data):
+    debugging = logging.getLogger().isEnabledFor(logging.DEBUG)
+    rows = []
+    for obs in data:
+        row = observationRow(obs)
+        if row is None:
+            continue
+        if debugging:
+            dstr = "adding observation {} to DB".format(obs)
+            logging.debug(dstr)
+        rows.append(row)
+    return calcRainDeltas(rows)
+
+
+# add a batch of observation rows to the database
+def addObservations(dbc, rows):
+    dbc.executemany(INSERT_OBSERVATION, rows)
 
-def processObservations(dbc, data):
+
+# prepare a location's observations for adding to the database
+# if a watermarks dict (from getWatermarks()) is given, observations at or
+# before the location's watermark are already in the database, so skipped
+# if filters (from makeObservationFilters()) are given, observations that
+# aren't selected are dropped
+# returns a dict of location id & name, latest observation time and rows,
+# or None if there are no observations
+def prepareObservations(data, watermarks=None, filters=None):
     dstr = "data contains {} observations".format(len(data))
     logging.debug(dstr)
     if len(data) < 1:
-        return 0
+        return None
     # location details are in each observation record, take from first
     locid = data[0]['wmo']
-    locname = data[0]['name']
-    dbc.execute("INSERT OR IGNORE INTO location(id, name) VALUES(?, ?)", (locid, locname))
+    first = None
+    if filters is not None:
+        if not isStationSelected(filters, locid, data[0]['name']):
+            return None
+        first = filters['first']
+        if filters['last'] is not None:
+            data = [obs for obs in data if obs['local_date_time_full'] <= filters['last']]
+            if len(data) < 1:
+                return None
+    latest = max(obs['local_date_time_full'] for obs in data)
+    watermark = None
+    if watermarks is not None:
+        watermark = watermarks.get(locid)
+    if watermark is not None or first is not None:
+        # observations from the start of the rain day of the first to keep
+        # are kept until rain is calculated, for the rain of those following
+        bound = max(b for b in (watermark, first) if b is not None)
+        rain_day_start = getRainDayStart(bound)
+        data = [obs for obs in data if obs['local_date_time_full'] >= rain_day_start]
+        rows = buildObservationRows(data)
+        if watermark is not None:
+            wm_key = dateTimeFullToRowKey(watermark)
+            rows = [row for row in rows if (row[1], row[2]) > wm_key]
+            data = [obs for obs in data if obs['local_date_time_full'] > watermark]
+            dstr = "{} observations for {} after watermark {}".format(len(data), locid, watermark)
+            logging.debug(dstr)
+        if first is not None:
+            first_key = dateTimeFullToRowKey(first)
+            rows = [row for row in rows if (row[1], row[2]) >= first_key]
+            data = [obs for obs in data if obs['local_date_time_full'] >= first]
+    else:
+        rows = buildObservationRows(data)
+    prepared = {
+            'id': locid,
+            'name': data[0]['name'] if data else None,
+            'latest': latest,
+            'nobs': len(data),
+            'rows': rows
+    }
+    return prepared
+
+
+# convert a local_date_time_full (YYYYMMDDHHMMSS) to the date and time of
+# observation rows, for comparing with rows
+def dateTimeFullToRowKey(date_time_full):
+    dtf = date_time_full
+    return (dtf[0:4] + '-' + dtf[4:6] + '-' + dtf[6:8], dtf[8:10] + ':' + dtf[10:12] + ':' + dtf[12:14])
+
+
+# get the start of the rain day (9am to 9am, see calcRainDeltas()) of a
+# local_date_time_full (YYYYMMDDHHMMSS), in the same format
+def getRainDayStart(date_time_full):
+    reset = RAIN_RESET_TIME.replace(':', '')
+    rain_date = datetime.datetime.strptime(date_time_full[0:8], '%Y%m%d')
+    if date_time_full[8:] < reset:
+        rain_date -= datetime.timedelta(days=1)
+    return rain_date.strftime('%Y%m%d') + reset
+
+
+# add observations from prepareObservations() to the database
+# the location's watermark is advanced if tracking watermarks
+def storeObservations(dbc, prepared, watermarks=None):
+    if prepared is None:
+        return
+    if prepared['name'] is not None:
+        dbc.execute("INSERT OR IGNORE INTO location(id, name) VALUES(?, ?)", (prepared['id'], prepared['name']))
     # add the ordered list of observations to the DB
-    for obs in data:
-        addObservation(dbc, obs)
+    addObservations(dbc, prepared['rows'])
+    # note dates added, for refreshing materialised daily stats
+    dates = {(row[0], row[1]) for row in prepared['rows']}
+    dbc.executemany("INSERT OR IGNORE INTO refresh_pending(location_id, date) VALUES(?, ?)", dates)
+    # and report dates, for their sketches and rollups (see updateTODSketches()
+    # and updateRollups())
+    dates = {(row[0], row[14]) for row in prepared['rows']}
+    dbc.executemany("INSERT OR IGNORE INTO sketch_pending(location_id, date) VALUES(?, ?)", dates)
+    dbc.executemany("INSERT OR IGNORE INTO rollup_pending(location_id, date) VALUES(?, ?)", dates)
+    if watermarks is not None:
+        updateWatermark(dbc, prepared['id'], prepared['latest'])
+
+
+# read and parse a json observation file (or compacted archive), ready for
+# storeObservations()
+# if known_hashes (set of sha256 hex digests) is given, file content is
+# hashed and not parsed if it has been seen before
+# if filters (from makeObservationFilters()) are given, only selected
+# observations are prepared
+# this is run in worker processes when parsing files in parallel
+# files that are gzipped, larger than STREAM_MIN_BYTES or aren't a single
+# json document aren't parsed here, but flagged to be streamed (see
+# streamObservationBatches()), by parseFiles()
+# returns a dict of sha256, duplicate flag, the prepared observations and
+# stream flag (with batches, set by parseFiles() for streamed files)
+def parseObservationFile(fn, watermarks=None, known_hashes=None, filters=None):
+    dstr = "processing file {}".format(fn)
+    logging.debug(dstr)
+    parsed = {
+            'sha256': None,
+            'duplicate': False,
+            'prepared': None,
+            'stream': False,
+            'batches': None
+    }
+    # read json file into dictionary, unless it's to be streamed
+    with open(fn, 'rb') as f:
+        content = f.read(len(ARCHIVE_MAGIC))
+        if content[:len(GZIP_MAGIC)] == GZIP_MAGIC or (content != ARCHIVE_MAGIC
+                and os.fstat(f.fileno()).st_size > STREAM_MIN_BYTES):
+            parsed['stream'] = True
+        else:
+            content += f.read()
+    if known_hashes is not None:
+        if parsed['stream']:
+            parsed['sha256'] = hashFile(fn)
+        else:
+            parsed['sha256'] = hashlib.sha256(content).hexdigest()
+        if parsed['sha256'] in known_hashes:
+            parsed['duplicate'] = True
+            return parsed
+    if parsed['stream']:
+        return parsed
+    # compacted archives can be given along with json files
+    if content[:len(ARCHIVE_MAGIC)] == ARCHIVE_MAGIC:
+        parsed['prepared'] = prepareArchiveObservations(readArchive(content, fn), watermarks, filters)
+        return parsed
+    try:
+        data = json.loads(content)
+    except ValueError:
+        # eg. newline delimited or concatenated json, which is streamed
+        data = None
+    if not isinstance(data, dict) or 'observations' not in data:
+        parsed['stream'] = True
+        return parsed
+    parsed['prepared'] = prepareObservations(data['observations']['data'], watermarks, filters)
+    return parsed
+
+
+# generate the prepared observations of a parsed file (from parseFiles()),
+# the file's prepared observations, or those of each batch as the file is
+# streamed (so these should be added before the next is generated)
+def getPreparedObservations(parsed):
+    if parsed['batches'] is not None:
+        for prepared in parsed['batches']:
+            if prepared is not None:
+                yield prepared
+    elif parsed['prepared'] is not None:
+        yield parsed['prepared']
+
+
+# watermarks, known hashes and filters, as passed to each parsing worker
+# process
+_worker_state = {}
+
+
+# initialise a parsing worker process, see parseObservationFile()
+def _initParseWorker(watermarks, known_hashes, filters=None):
+    _worker_state['watermarks'] = watermarks
+    _worker_state['known_hashes'] = known_hashes
+    _worker_state['filters'] = filters
+
+
+# as per parseObservationFile(), for use with Pool.imap()
+def _parseObservationFileWorker(fn):
+    return parseObservationFile(fn, _worker_state['watermarks'], _worker_state['known_hashes'], _worker_state['filters'])
+
+
+# get the per location high-watermark of observations in the database
+# returns dict of location id -> local_date_time_full (YYYYMMDDHHMMSS)
+def getWatermarks(dbc):
+    dbc.execute("SELECT location_id, date_time_full FROM watermark")
+    return {row[0]: row[1] for row in dbc.fetchall()}
+
+
+# advance the high-watermark of observations for a location
+def updateWatermark(dbc, locid, date_time_full):
+    dbc.execute("""
+        INSERT INTO watermark(location_id, date_time_full) VALUES(?, ?)
+        ON CONFLICT(location_id) DO UPDATE
+        SET date_time_full = MAX(date_time_full, excluded.date_time_full)
+        """, (locid, date_time_full))
+
+
+# get the details of a file as recorded in the ingest manifest
+# returns a dict with path, size and mtime (sha256 is added on reading)
+def getFileDetails(fn):
+    st = os.stat(fn)
+    fdetails = {
+            'path': os.path.abspath(fn),
+            'size': st.st_size,
+            'mtime': st.st_mtime,
+            'sha256': None
+    }
+    return fdetails
+
+
+# check if a file, as given by getFileDetails(), is unchanged since ingest
+def isFileIngested(dbc, fdetails):
+    dbc.execute("SELECT 1 FROM ingested_file WHERE path = ? AND size = ? AND mtime = ?",
+            (fdetails['path'], fdetails['size'], fdetails['mtime']))
+    return dbc.fetchone() is not None
+
+
+# get the content hashes of all ingested files, used to skip files with
+# the same content as one already ingested (eg. file was copied)
+def getIngestedHashes(dbc):
+    dbc.execute("SELECT sha256 FROM ingested_file")
+    return {row[0] for row in dbc.fetchall()}
+
+
+# add (or update) a file in the ingest manifest
+def recordIngestedFile(dbc, fdetails):
+    dbc.execute("""
+        INSERT OR REPLACE INTO ingested_file(path, size, mtime, sha256, ingested)
+        VALUES(?, ?, ?, ?, DATETIME('now'))
+        """, (fdetails['path'], fdetails['size'], fdetails['mtime'], fdetails['sha256']))
+
+
+# parse json observation files with parseObservationFile()
+# with more than one job, files are read and parsed by a pool of worker
+# processes, results are still generated in order of filenames
+# files to be streamed are read in batches here, as their observations are
+# taken from the parsed file's batches, see getPreparedObservations()
+# generates (filename, parsed file) tuples
+def parseFiles(filenames, watermarks=None, known_hashes=None, jobs=1, filters=None):
+    if jobs > 1 and len(filenames) > 1:
+        dstr = "parsing {} files with {} worker processes".format(len(filenames), jobs)
+        logging.info(dstr)
+        pool = multiprocessing.Pool(jobs, _initParseWorker, (watermarks, known_hashes, filters))
+        results = pool.imap(_parseObservationFileWorker, filenames, chunksize=4)
+    else:
+        pool = None
+        results = (parseObservationFile(fn, watermarks, known_hashes, filters) for fn in filenames)
+    try:
+        for fn, parsed in zip(filenames, results):
+            if parsed['stream'] and not parsed['duplicate']:
+                parsed['batches'] = streamObservationBatches(fn, watermarks, filters)
+            yield fn, parsed
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+# read json observation files and add their observations to the database
+# if persistent, files are recorded in the manifest, already ingested files
+# and observations before each location's watermark are skipped, and the
+# sketches and rollups of dates with new observations are updated
+# with more than one job, files are parsed in parallel (see parseFiles())
+# while their results are added here, in order of filenames
+# all files are added within a single transaction
+# if filters (from makeObservationFilters()) are given, only selected
+# observations are added, these aren't for a persistent database, where
+# files would then be recorded as ingested without all their observations
+# returns the number of files ingested
+def ingestFiles(conn, dbc, filenames, persistent=False, jobs=1, filters=None):
+    watermarks = None
+    known_hashes = None
+    if persistent:
+        # taken once, so files within a run can be in any order
+        watermarks = getWatermarks(dbc)
+        known_hashes = getIngestedHashes(dbc)
+        fdetails = {}
+        changed = []
+        for fn in filenames:
+            fdetails[fn] = getFileDetails(fn)
+            if isFileIngested(dbc, fdetails[fn]):
+                dstr = "skipping file {}, already ingested".format(fn)
+                logging.info(dstr)
+            else:
+                changed.append(fn)
+        filenames = changed
+
+    nfiles = 0
+    dbc.execute("BEGIN")
+    for fn, parsed in parseFiles(filenames, watermarks, known_hashes, jobs, filters):
+        if persistent:
+            fdetails[fn]['sha256'] = parsed['sha256']
+            # also catches duplicates within this run
+            if parsed['duplicate'] or parsed['sha256'] in known_hashes:
+                dstr = "skipping file {}, content already ingested".format(fn)
+                logging.info(dstr)
+                recordIngestedFile(dbc, fdetails[fn])
+                continue
+            known_hashes.add(parsed['sha256'])
+        for prepared in getPreparedObservations(parsed):
+            storeObservations(dbc, prepared, watermarks)
+        if persistent:
+            recordIngestedFile(dbc, fdetails[fn])
+        nfiles += 1
+    if persistent:
+        # sketches and rollups are stored with the observations, so are kept
+        # up to date (otherwise they're only made if needed, see main())
+        updateTODSketches(dbc)
+        updateRollups(dbc)
+    conn.commit()
+    dstr = "ingested {} of {} files".format(nfiles, len(filenames))
+    logging.info(dstr)
+    return nfiles
+
+
+# observation columns added since the table was first created, which a
+# persistent database from before then won't have, as (name, type)
+OBSERVATION_ADDED_COLUMNS = [
+        ('rain_trace', 'REAL'),
+        ('rain', 'REAL'),
+        ('wind_dir', 'TEXT'),
+        ('wind_spd_kmh', 'REAL'),
+        ('press_msl', 'REAL'),
+        ('dewpt', 'REAL'),
+        ('minutes', 'INTEGER'),
+        ('report_date', 'TEXT'),
+        ('bucket', 'INTEGER')
+]
+
+# version of the observation table's contents, kept in the metadata table
+# as schema_version, a database without it is version 1:
+#     1: as first created, possibly with OBSERVATION_ADDED_COLUMNS added
+#     2: with the keys from observationKeys() set for all observations
+#     3: with sketches (see updateTODSketches()) for all observations
+#     4: with rollups (see updateRollups()) for all observations
+SCHEMA_VERSION = 4
+
+
+# get the names of a table's columns
+def getTableColumns(dbc, table):
+    dbc.execute("PRAGMA table_info({})".format(table))
+    return [row[1] for row in dbc.fetchall()]
+
+
+# add any of columns (list of (name, type)) missing from a table, so an
+# existing database can be used with a newer schema, values of existing
+# rows for an added column are NULL
+def addMissingColumns(dbc, table, columns):
+    existing = getTableColumns(dbc, table)
+    for name, coltype in columns:
+        if name not in existing:
+            dstr = "adding column {} to {}".format(name, table)
+            logging.info(dstr)
+            dbc.execute("ALTER TABLE {} ADD COLUMN {} {}".format(table, name, coltype))
+
+
+# bring the observations in a database from an earlier SCHEMA_VERSION up
+# to date
+def migrateDB(dbc):
+    version = getMetadata(dbc, 'schema_version')
+    version = 1 if version is None else int(version)
+    if version >= SCHEMA_VERSION:
+        return
+    if version < 2:
+        migrateObservationKeys(dbc)
+    if version < 3:
+        # sketches are made for these dates as files are next ingested
+        dbc.execute("INSERT OR IGNORE INTO sketch_pending(location_id, date) SELECT DISTINCT location_id, report_date FROM observation")
+    if version < 4:
+        # as are rollups
+        dbc.execute("INSERT OR IGNORE INTO rollup_pending(location_id, date) SELECT DISTINCT location_id, report_date FROM observation")
+    setMetadata(dbc, 'schema_version', SCHEMA_VERSION)
+    dbc.connection.commit()
+
+
+# set the keys (see observationKeys()) of observations added before they
+# were stored, in a database from before SCHEMA_VERSION 2
+def migrateObservationKeys(dbc):
+    dbc.execute("SELECT location_id, date, time FROM observation WHERE report_date IS NULL")
+    rows = [observationKeys(row[1], row[2]) + tuple(row) for row in dbc.fetchall()]
+    if rows:
+        dstr = "setting keys of {} observations".format(len(rows))
+        logging.info(dstr)
+        dbc.executemany("UPDATE observation SET minutes = ?, report_date = ?, bucket = ? WHERE location_id = ? AND date = ? AND time = ?", rows)
+
+
+# storage profiles, for the --storage option, as sqlite PRAGMA settings
+# (applied in this order, page_size only to a new database):
+#     fast-ephemeral: bulk ingest into a database that's discarded after
+#         the run (or rebuilt), with a large cache, memory mapping and no
+#         syncing to disk, the rollback journal is kept in memory
+#     durable: a persistent database that's added to and queried
+#         repeatedly, WAL journal, fully synced so committed observations
+#         survive a crash
+#     low-memory: small hosts, with a small cache, no memory mapping and
+#         temporary tables (eg. for sorting) on disk
+# cache_size is in KiB when negative, mmap_size in bytes
+STORAGE_PROFILES = {
+        'fast-ephemeral': collections.OrderedDict([
+            ('page_size', 16384),
+            ('journal_mode', 'MEMORY'),
+            ('synchronous', 'OFF'),
+            ('cache_size', -262144),
+            ('mmap_size', 1 << 30),
+            ('temp_store', 'MEMORY')
+        ]),
+        'durable': collections.OrderedDict([
+            ('page_size', 4096),
+            ('journal_mode', 'WAL'),
+            ('synchronous', 'FULL'),
+            ('cache_size', -65536),
+            ('mmap_size', 1 << 28),
+            ('temp_store', 'DEFAULT')
+        ]),
+        'low-memory': collections.OrderedDict([
+            ('page_size', 4096),
+            ('journal_mode', 'DELETE'),
+            ('synchronous', 'NORMAL'),
+            ('cache_size', -2048),
+            ('mmap_size', 0),
+            ('temp_store', 'FILE')
+        ])
+}
+
+# the settings of a storage profile that apply to each connection, rather
+# than to the database, so are also applied to read-only connections
+STORAGE_CONNECTION_PRAGMAS = ['cache_size', 'mmap_size', 'temp_store']
+
+
+# apply a storage profile (name in STORAGE_PROFILES, or None for sqlite's
+# defaults) to a connection, before any tables are created or read
+# if readonly, only the per connection settings are applied
+def applyStorageProfile(conn, storage, readonly=False):
+    if storage is None:
+        return
+    for pragma, value in STORAGE_PROFILES[storage].items():
+        if readonly and pragma not in STORAGE_CONNECTION_PRAGMAS:
+            continue
+        # the page size of an existing database can't be changed
+        if pragma == 'page_size' and conn.execute("PRAGMA page_count").fetchone()[0] > 0:
+            dstr = "keeping page size {} of existing database".format(conn.execute("PRAGMA page_size").fetchone()[0])
+            logging.info(dstr)
+            continue
+        conn.execute("PRAGMA {} = {}".format(pragma, value))
+
+
+# get the current storage settings of a connection, as set by a storage
+# profile, for reporting
+# returns a string of pragma=value pairs, of those that have a value (eg.
+# a temporary database has no mmap_size)
+def getStorageSettings(conn):
+    settings = []
+    for pragma in STORAGE_PROFILES['durable']:
+        row = conn.execute("PRAGMA {}".format(pragma)).fetchone()
+        if row is not None:
+            settings.append("{}={}".format(pragma, row[0]))
+    return ', '.join(settings)
 
 
 # note use of composite key in observation
 # as json files may overlap (time based) and cause duplication of data
-def initDB(dbc):
+# a persistent database keeps existing data, and also tracks ingested
+# files, the latest observation for each location and the dates
+# observations were added for since materialised stats were refreshed
+def initDB(dbc, persistent=False):
+    if not persistent:
+        dbc.executescript("""
+            DROP TABLE IF EXISTS observation;
+            DROP TABLE IF EXISTS location;
+        """)
     dbc.executescript("""
-        DROP TABLE IF EXISTS observation;
-        DROP TABLE IF EXISTS location;
-        CREATE TABLE location(
+        CREATE TABLE IF NOT EXISTS location(
             id INTEGER PRIMARY KEY NOT NULL,
             name TEXT, UNIQUE(id, name)
         );
-        CREATE TABLE observation(
+        CREATE TABLE IF NOT EXISTS observation(
             location_id INTEGER REFERENCES location(id) NOT NULL,
             date TEXT,
             time TEXT,
@@ -500,29 +1543,3718 @@ def initDB(dbc):
             relative_humidity REAL,
             -- cloud TEXT,
             cloud_oktas INTEGER,
+            rain_trace REAL,
+            rain REAL,
+            wind_dir TEXT,
+            wind_spd_kmh REAL,
+            press_msl REAL,
+            dewpt REAL,
+            minutes INTEGER,
+            report_date TEXT,
+            bucket INTEGER,
             PRIMARY KEY(location_id, date, time)
         );
-    """)
+        CREATE TABLE IF NOT EXISTS ingested_file(
+            path TEXT PRIMARY KEY NOT NULL,
+            size INTEGER,
+            mtime REAL,
+            sha256 TEXT,
+            ingested TEXT
+        );
+        CREATE INDEX IF NOT EXISTS ingested_file_sha256 ON ingested_file(sha256);
+        CREATE TABLE IF NOT EXISTS watermark(
+            location_id INTEGER PRIMARY KEY REFERENCES location(id) NOT NULL,
+            date_time_full TEXT
+        );
+        CREATE TABLE IF NOT EXISTS refresh_pending(
+            location_id INTEGER NOT NULL,
+            date TEXT,
+            PRIMARY KEY(location_id, date)
+        );
+        CREATE TABLE IF NOT EXISTS metadata(
+            key TEXT PRIMARY KEY NOT NULL,
+            value TEXT
+        );
+        CREATE TABLE IF NOT EXISTS tod_sketch(
+            location_id INTEGER NOT NULL,
+            bucket INTEGER,
+            date TEXT,
+            n INTEGER,
+            sketch BLOB,
+            PRIMARY KEY(location_id, bucket, date)
+        );
+        CREATE TABLE IF NOT EXISTS sketch_pending(
+            location_id INTEGER NOT NULL,
+            date TEXT,
+            PRIMARY KEY(location_id, date)
+        );
+        CREATE TABLE IF NOT EXISTS rollup_pending(
+            location_id INTEGER NOT NULL,
+            date TEXT,
+            PRIMARY KEY(location_id, date)
+        );
+    """)
+    createRollupTables(dbc)
+    addMissingColumns(dbc, 'observation', OBSERVATION_ADDED_COLUMNS)
+    migrateDB(dbc)
+    # covering index for queries by location, time of day and report date,
+    # see dateNormalisedSelect() and dailyTODStatsSelect()
+    dbc.execute("""
+        CREATE INDEX IF NOT EXISTS observation_bucket
+        ON observation(location_id, bucket, report_date, time, air_temp, relative_humidity, cloud_oktas)
+        """)
+
+    #dbc.execute(".tables")
+    #rows = dbc.fetchall()
+    #for row in rows:
+    #    logging.debug(row)
+
+
+
+
+##############################################################
+# streaming json observations, for files too big to load at once (eg. bulk
+# exports), gzipped files, and files of more than one json document, either
+# concatenated (eg. dumps of many stations) or newline delimited (of
+# documents or of observation records)
+# records are decoded one at a time from a buffer of the file, as read in
+# chunks, and the wrapping objects (observations and its header) are
+# skipped over rather than decoded, so memory use doesn't depend on the
+# size of the file
+# records are grouped into batches (of a location each) and prepared and
+# added a batch at a time, see streamObservationBatches()
+
+# files larger than this are streamed, rather than loaded at once
+STREAM_MIN_BYTES = 16 * 1024 * 1024
+
+# characters read from a file at a time
+STREAM_CHUNK_CHARS = 256 * 1024
+
+# observation records in a batch, not counting those to complete the rain
+# day of the last (see getObservationBatches())
+STREAM_BATCH_RECORDS = 4096
+
+# gzip files start with these bytes
+GZIP_MAGIC = b'\x1f\x8b'
+
+# json whitespace, as skipped between values
+STREAM_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+# characters that can continue a number (eg. 12. or 1e of 12.5 or 1e-3)
+STREAM_NUMBER_TAIL = re.compile(r'[0-9.eE+-]*')
+
+
+# open a json observation file for streaming, as text, decompressing it if
+# it's gzipped
+def openObservationStream(fn):
+    with open(fn, 'rb') as f:
+        gzipped = f.read(len(GZIP_MAGIC)) == GZIP_MAGIC
+    if gzipped:
+        return gzip.open(fn, 'rt', encoding='utf-8')
+    return open(fn, 'r', encoding='utf-8')
+
+
+# generate the observation records of a json file (f, opened as text), from
+# the observations.data of each document, or the records themselves if
+# the file has records (as objects, or arrays of them) rather than
+# documents, decoding a record at a time
+# None is generated after each document's records, as documents (eg. the
+# downloaded files in a dump) are prepared separately, see
+# getObservationBatches()
+def getObservationRecords(f):
+    decoder = json.JSONDecoder()
+    # buffer of text read from f, and the position of the next value in it
+    state = {'buf': '', 'pos': 0, 'eof': False}
+
+    # read more of f into the buffer, dropping what's been decoded, at least
+    # as much as is already buffered, so a long value takes few reads
+    def fill():
+        unread = state['buf'][state['pos']:]
+        chunk = f.read(max(STREAM_CHUNK_CHARS, len(unread)))
+        state['buf'] = unread + chunk
+        state['pos'] = 0
+        state['eof'] = not chunk
+        return bool(chunk)
+
+    # skip whitespace, returns the next character ('' at the end of f)
+    def peek():
+        while True:
+            state['pos'] = STREAM_WHITESPACE.match(state['buf'], state['pos']).end()
+            if state['pos'] < len(state['buf']):
+                return state['buf'][state['pos']]
+            if not fill():
+                return ''
+
+    # skip the next character, which must be one of chars, returns it
+    def expect(chars):
+        char = peek()
+        if not char or char not in chars:
+            raise ValueError("Expecting one of {} at {!r}".format(chars, state['buf'][state['pos']:state['pos']+40]))
+        state['pos'] += 1
+        return char
+
+    # decode the next value, reading more of f until it's complete
+    def decode():
+        while True:
+            peek()
+            try:
+                value, end = decoder.raw_decode(state['buf'], state['pos'])
+            except json.JSONDecodeError:
+                if state['eof'] or not fill():
+                    raise
+                continue
+            # a number at the end of the buffer may continue in the next chunk
+            if (state['eof'] or not isinstance(value, (int, float))
+                    or not STREAM_NUMBER_TAIL.fullmatch(state['buf'], end) or not fill()):
+                state['pos'] = end
+                return value
+
+    # generate the values of the array that's next, a value at a time
+    def arrayValues():
+        expect('[')
+        if peek() == ']':
+            state['pos'] += 1
+            return
+        while True:
+            yield decode()
+            if expect(',]') == ']':
+                return
+
+    # generate the keys of the object that's next, leaving each key's value
+    # next, to be decoded (or descended into) before the following key
+    def objectKeys():
+        expect('{')
+        if peek() == '}':
+            state['pos'] += 1
+            return
+        while True:
+            key = decode()
+            expect(':')
+            yield key
+            if expect(',}') == '}':
+                return
+
+    # the records of a decoded document (and None), or the record itself
+    def valueRecords(value):
+        if isinstance(value, dict) and 'observations' in value:
+            return value['observations']['data'] + [None]
+        return [value]
+
+    while peek():
+        if peek() == '[':
+            for value in arrayValues():
+                yield from valueRecords(value)
+            continue
+        record = {}
+        for key in objectKeys():
+            if key == 'observations' and not record:
+                # a document, its records are decoded one at a time
+                for obs_key in objectKeys():
+                    if obs_key == 'data':
+                        yield from arrayValues()
+                    else:
+                        decode()
+                yield None
+                record = None
+            elif record is None:
+                decode()
+            else:
+                record[key] = decode()
+        if record is not None:
+            yield from valueRecords(record)
+
+
+# group observation records (from getObservationRecords()) into batches for
+# prepareObservations(), each of a single location and document (as is
+# each file) and of about size records
+# as rain is calculated over each 9am to 9am rain day (see
+# calcRainDeltas()), batches are only split between rain days, and the
+# records either side of the split are in both batches, so rain is known
+# as it would be in a single batch (the records are added again, as for
+# overlapping files)
+# a document's records are expected in order of time (either way), as in
+# BoM files
+# generates lists of records
+def getObservationBatches(records, size=STREAM_BATCH_RECORDS):
+    batch = []
+    for obs in records:
+        if obs is None:
+            if batch:
+                yield batch
+            batch = []
+            continue
+        if batch and obs['wmo'] != batch[-1]['wmo']:
+            yield batch
+            batch = []
+        elif len(batch) >= size and (getRainDayStart(obs['local_date_time_full'])
+                != getRainDayStart(batch[-1]['local_date_time_full'])):
+            yield batch + [obs]
+            batch = batch[-1:]
+        batch.append(obs)
+    if batch:
+        yield batch
+
+
+# stream a json observation file (see getObservationRecords()), preparing
+# its observations in batches, as per prepareObservations() with the same
+# watermarks and filters
+# generates prepared observations, for each batch with observations to add
+def streamObservationBatches(fn, watermarks=None, filters=None):
+    dstr = "streaming file {}".format(fn)
+    logging.debug(dstr)
+    nrecords = 0
+    nbatches = 0
+    with openObservationStream(fn) as f:
+        for batch in getObservationBatches(getObservationRecords(f)):
+            nrecords += len(batch)
+            nbatches += 1
+            prepared = prepareObservations(batch, watermarks, filters)
+            if prepared is not None and prepared['rows']:
+                yield prepared
+    dstr = "streamed {} records from {} in {} batches".format(nrecords, fn, nbatches)
+    logging.debug(dstr)
+
+
+
+
+##############################################################
+# restricting the report to a range of dates and to stations, see the
+# --from, --to and --station options
+# dates are those observations are reported for, so the evening before the
+# first date (from OVERNIGHT_HOUR_START) is kept for its overnight period
+# files that can't have any selected observations are skipped before being
+# parsed, judged by their name (<Loc>-YYYY-MM-DD.json, as downloaded on that
+# date) or their first and last observations, and observations that aren't
+# selected are dropped before they're added
+# with a persistent database, files are still ingested in full, and the
+# report is restricted by temporary views over the database instead
+
+# days of observations before its download date a json file can have
+# (72 hours, with a day to spare)
+FILTER_FILE_DAYS = 4
+
+# bytes read from each end of a json file, for its first and last observations
+FILTER_PEEK_BYTES = 8192
+
+# downloaded json file names, as written by getweatherobs.sh and fetch
+FILTER_FILENAME = re.compile(r'^(.+)-(\d{4}-\d{2}-\d{2})\.json$')
+
+
+# make the filters for the given dates (YYYY-MM-DD, inclusive, None for no
+# limit) and stations (wmo ids, names in the station table or location
+# names, which are matched ignoring case)
+# returns dict of from and to dates, first and last local_date_time_full
+# (YYYYMMDDHHMMSS) of selected observations, and stations (set of ids)
+# and names, with the station table (name -> wmo) for file names
+def makeObservationFilters(from_date=None, to_date=None, stations=(), station_table=None):
+    filters = {
+            'from': from_date,
+            'to': to_date,
+            'first': None,
+            'last': None,
+            'stations': set(),
+            'names': set(),
+            'table': {}
+    }
+    if from_date is not None:
+        prev_date = datetime.date.fromisoformat(from_date) - datetime.timedelta(days=1)
+        filters['first'] = prev_date.strftime('%Y%m%d') + OVERNIGHT_HOUR_START.replace(':', '') + '00'
+    if to_date is not None:
+        filters['last'] = to_date.replace('-', '') + '235959'
+    if station_table is not None:
+        filters['table'] = {row['name']: int(row['wmo']) for row in station_table}
+    for station in stations:
+        if station.isdigit():
+            filters['stations'].add(int(station))
+        elif station in filters['table']:
+            filters['stations'].add(filters['table'][station])
+        else:
+            filters['names'].add(station.lower())
+    return filters
+
+
+# check if a location is selected by filters
+def isStationSelected(filters, locid, name):
+    if not filters['stations'] and not filters['names']:
+        return True
+    return int(locid) in filters['stations'] or (name or '').lower() in filters['names']
+
+
+# read the location and first and last observation times of a file,
+# without parsing all of it
+# returns tuple of location id, name, and first and last
+# local_date_time_full, or None if they can't be found
+def peekObservationFile(fn):
+    with open(fn, 'rb') as f:
+        head = f.read(FILTER_PEEK_BYTES)
+        if head[:len(ARCHIVE_MAGIC)] == ARCHIVE_MAGIC:
+            archive = openArchive(fn)
+            if archive['nrows'] < 1:
+                return None
+            seconds = archive['columns']['seconds']
+            return (archive['id'], archive['name'], secondsToDateTimeFull(seconds[0]),
+                    secondsToDateTimeFull(seconds[archive['nrows']-1]))
+        # files that are streamed may have many stations (see parseObservationFile())
+        size = os.fstat(f.fileno()).st_size
+        if size > STREAM_MIN_BYTES:
+            return None
+        f.seek(max(0, size - FILTER_PEEK_BYTES))
+        tail = f.read()
+    # observations are in order of time (newest first), after the header
+    data_start = head.find(b'"data"')
+    if data_start < 0:
+        return None
+    head = head[data_start:]
+    wmo = re.search(rb'"wmo":\s*(\d+)', head)
+    name = re.search(rb'"name":\s*("(?:[^"\\]|\\.)*")', head)
+    times = re.findall(rb'"local_date_time_full":\s*"(\d{14})"', head)[:1]
+    times += re.findall(rb'"local_date_time_full":\s*"(\d{14})"', tail)[-1:]
+    if wmo is None or name is None or len(times) < 2:
+        return None
+    # concatenated documents may end with another station's observations
+    if re.findall(rb'"wmo":\s*(\d+)', tail)[-1:] not in ([], [wmo.group(1)]):
+        return None
+    times = [t.decode('ascii') for t in times]
+    return int(wmo.group(1)), json.loads(name.group(1)), min(times), max(times)
+
+
+# check if a file might have observations selected by filters
+def isFileSelected(fn, filters):
+    match = FILTER_FILENAME.match(os.path.basename(fn))
+    if match:
+        prefix, download_date = match.groups()
+        if not filters['names'] and prefix in filters['table']:
+            if not isStationSelected(filters, filters['table'][prefix], None):
+                return False
+        if filters['first'] is not None and download_date.replace('-', '') + '235959' < filters['first']:
+            return False
+        earliest = datetime.date.fromisoformat(download_date) - datetime.timedelta(days=FILTER_FILE_DAYS)
+        if filters['last'] is not None and earliest.strftime('%Y%m%d') + '000000' > filters['last']:
+            return False
+    peek = peekObservationFile(fn)
+    if peek is None:
+        return True
+    locid, name, first, last = peek
+    if not isStationSelected(filters, locid, name):
+        return False
+    if filters['first'] is not None and last < filters['first']:
+        return False
+    if filters['last'] is not None and first > filters['last']:
+        return False
+    return True
+
+
+# skip files that can't have observations selected by filters
+# returns list of remaining filenames, in the same order
+def pruneFiles(filenames, filters):
+    selected = [fn for fn in filenames if isFileSelected(fn, filters)]
+    dstr = "{} of {} files have selected observations".format(len(selected), len(filenames))
+    logging.info(dstr)
+    return selected
+
+
+# get the ids of the locations in the database (or attached schema)
+# selected by filters, which are given as ids or names
+# returns set of location ids, None if filters don't restrict locations
+def getFilteredLocationIds(dbc, filters, schema='main'):
+    if not filters['stations'] and not filters['names']:
+        return None
+    locids = set(filters['stations'])
+    if filters['names']:
+        dbc.execute("SELECT id, name FROM {}.location".format(schema))
+        locids.update(row[0] for row in dbc.fetchall() if row[1].lower() in filters['names'])
+    return locids
+
+
+# get the sql conditions for the observations, and for the dates (of
+# daily stats) selected by filters, for the database (or attached schema)
+# returns tuple of observation conditions, date conditions
+def getFilterConditions(dbc, filters, schema='main'):
+    locids = getFilteredLocationIds(dbc, filters, schema)
+    obs_conditions = ['1']
+    date_conditions = ['1']
+    if filters['first'] is not None:
+        # observations from filters['first'] are those reported from filters['from']
+        obs_conditions.append("report_date >= '{}'".format(filters['from']))
+        date_conditions.append("date >= '{}'".format(filters['from']))
+    if filters['last'] is not None:
+        obs_conditions.append("date <= '{}'".format(filters['to']))
+        date_conditions.append("date <= '{}'".format(filters['to']))
+    if filters['stations'] or filters['names']:
+        station_condition = "location_id IN ({})".format(', '.join(str(locid) for locid in sorted(locids)))
+        obs_conditions.append(station_condition)
+        date_conditions.append(station_condition)
+    return ' AND '.join(obs_conditions), ' AND '.join(date_conditions)
+
+
+# restrict the report to the observations selected by filters, with
+# temporary views that take the place of observation, location and the
+# views (or materialised tables) of daily stats, for this connection only
+# as the (non-temporary) views and tables are over all observations
+def createFilteredViews(dbc, filters, materialised=False):
+    obs_conditions, date_conditions = getFilterConditions(dbc, filters)
+
+    # unqualified names within temporary views are of temporary views first
+    if materialised:
+        view_str = """
+        CREATE TEMP VIEW observation AS SELECT * FROM main.observation WHERE {obs};
+        CREATE TEMP VIEW datenorm_observation AS SELECT * FROM main.datenorm_observation WHERE {dates};
+        CREATE TEMP VIEW daily_tod_stats AS SELECT * FROM main.daily_tod_stats WHERE {dates};
+        """
+    else:
+        view_str = """
+        CREATE TEMP VIEW observation AS SELECT * FROM main.observation WHERE {obs};
+        CREATE TEMP VIEW datenorm_observation AS {datenorm};
+        CREATE TEMP VIEW daily_tod_stats AS {daily};
+        """
+    # sketches of the selected dates, and locations with observations on them
+    view_str += """
+        CREATE TEMP VIEW tod_sketch AS SELECT * FROM main.tod_sketch WHERE {dates};
+        CREATE TEMP VIEW location AS SELECT * FROM main.location
+            WHERE id IN (SELECT location_id FROM observation WHERE {dates});
+        """
+    view_str = view_str.format(obs=obs_conditions, dates=date_conditions,
+            datenorm=dateNormalisedSelect(), daily=dailyTODStatsSelect())
+
+    dstr = "createFilteredViews() creating views with: {}".format(view_str)
+    logging.debug(dstr)
+
+    dbc.executescript(view_str)
+    calcDayToDayTODAvgTempDiffs(dbc, temp=True)
+
+
+
+
+##############################################################
+# quantile sketches of temperatures, for the percentiles of the -p option
+# a sketch is kept for each location, period of day (bucket) and report
+# date, of its observations' air temps, in the tod_sketch table, so that
+# percentiles over any range of dates are found by merging the sketches of
+# its dates, rather than sorting all of the observations
+# sketches are KLL sketches (Karnin, Lang & Liberty, 2016), made
+# deterministic, so that the same sketches merged in the same order (by
+# date) always give the same percentiles, whichever engine is used:
+#     levels: lists of sorted values, each value at level h stands for 2^h
+#         values, level 0 being the values themselves
+#     n: the number of values added
+# when a level has more values than its capacity (which is SKETCH_K for
+# the top level, and 2/3 of the level above's for lower levels), its values
+# are compacted, every second one of them being promoted to the next level
+# a day's sketch (about 8 to 16 values) is the values themselves, and a
+# merged sketch has a rank error of around 1% of n
+
+# capacity of a sketch's top level
+SKETCH_K = 200
+
+# ratio of a level's capacity to that of the level above
+SKETCH_CAPACITY_RATIO = 2.0 / 3.0
+
+# serialised sketch, see dumpSketch(), version, number of levels and n,
+# followed by the values of each level as a count and little endian doubles
+SKETCH_VERSION = 1
+SKETCH_HEADER = struct.Struct('<BBQ')
+SKETCH_LEVEL = struct.Struct('<I')
+
+# percentiles of the -p option, and the keys of their summary results (see
+# calcLocationSummaries()), each a dict by time of day, None for no readings
+SUMMARY_PERCENTILES = [10, 50, 90]
+PERCENTILE_SUMMARY_KEYS = ['p10', 'median', 'p90']
+
+
+# make a sketch of values (any iterable of floats)
+def newSketch(values=()):
+    sketch = {
+            'levels': [sorted(values)],
+            'n': 0
+    }
+    sketch['n'] = len(sketch['levels'][0])
+    compactSketch(sketch)
+    return sketch
+
+
+# get the capacity of level h of a sketch with nlevels levels
+def getSketchCapacity(h, nlevels):
+    return max(2, int(SKETCH_K * SKETCH_CAPACITY_RATIO ** (nlevels - h - 1)))
+
+
+# compact the levels of a sketch that are over capacity
+# of an odd number of values, the largest stays at its level, and every
+# second one of the rest is promoted, from the first or the second
+# (alternating with n), so that the total weight is unchanged
+def compactSketch(sketch):
+    levels = sketch['levels']
+    compacted = True
+    while compacted:
+        compacted = False
+        for h in range(len(levels)):
+            if len(levels[h]) <= getSketchCapacity(h, len(levels)):
+                continue
+            if h + 1 == len(levels):
+                levels.append([])
+            values = levels[h]
+            keep = values[-1:] if len(values) % 2 else []
+            pairs = values[:len(values) - len(keep)]
+            offset = (sketch['n'] >> h) & 1
+            levels[h+1] = sorted(levels[h+1] + pairs[offset::2])
+            levels[h] = keep
+            compacted = True
+            break
+
+
+# merge other (a sketch) into sketch, which is returned
+def mergeSketches(sketch, other):
+    levels = sketch['levels']
+    for h, values in enumerate(other['levels']):
+        if h == len(levels):
+            levels.append([])
+        levels[h] = sorted(levels[h] + values)
+    sketch['n'] += other['n']
+    compactSketch(sketch)
+    return sketch
+
+
+# get percentiles (list of integer percentages, in increasing order) of a
+# sketch, as the first value with at least that percentage of the total
+# weight at or below it (nearest rank)
+# returns list of values, None if the sketch is empty
+def getSketchPercentiles(sketch, percentiles):
+    weighted = sorted((value, 1 << h) for h, values in enumerate(sketch['levels']) for value in values)
+    total = sum(weight for value, weight in weighted)
+    if total == 0:
+        return [None] * len(percentiles)
+    results = []
+    i = 0
+    cumulative = weighted[0][1]
+    for pct in percentiles:
+        rank = max(1, -(-pct * total // 100))
+        while cumulative < rank:
+            i += 1
+            cumulative += weighted[i][1]
+        results.append(weighted[i][0])
+    return results
+
+
+# serialise a sketch, for storing as a blob, see SKETCH_HEADER
+def dumpSketch(sketch):
+    parts = [SKETCH_HEADER.pack(SKETCH_VERSION, len(sketch['levels']), sketch['n'])]
+    for values in sketch['levels']:
+        parts.append(SKETCH_LEVEL.pack(len(values)))
+        parts.append(struct.pack('<{}d'.format(len(values)), *values))
+    return b''.join(parts)
+
+
+# deserialise a sketch, as from dumpSketch()
+def loadSketch(blob):
+    version, nlevels, n = SKETCH_HEADER.unpack_from(blob)
+    if version != SKETCH_VERSION:
+        raise ValueError("unsupported sketch version {}".format(version))
+    sketch = {'levels': [], 'n': n}
+    offset = SKETCH_HEADER.size
+    for h in range(nlevels):
+        count, = SKETCH_LEVEL.unpack_from(blob, offset)
+        offset += SKETCH_LEVEL.size
+        sketch['levels'].append(list(struct.unpack_from('<{}d'.format(count), blob, offset)))
+        offset += count * 8
+    return sketch
+
+
+# set the percentile results of a location summary (as from
+# calcLocationSummaries()) for a time of day, from a merged sketch
+def setSketchPercentiles(summary, tod, sketch):
+    values = getSketchPercentiles(sketch, SUMMARY_PERCENTILES)
+    for key, value in zip(PERCENTILE_SUMMARY_KEYS, values):
+        summary[key][tod] = value
+
+
+# (re)make the sketches of the location and report dates that observations
+# have been added for since they were last made (see sketch_pending),
+# from all of their observations, so that duplicated observations (from
+# overlapping files) are only counted once
+# returns the number of sketches made
+def updateTODSketches(dbc):
+    dbc.execute("""
+        SELECT location_id, bucket, report_date, air_temp
+        FROM observation
+        WHERE (location_id, report_date) IN (SELECT location_id, date FROM sketch_pending)
+            AND bucket IS NOT NULL AND air_temp IS NOT NULL
+        ORDER BY location_id, bucket, report_date
+        """)
+    sketches = []
+    for key, rows in itertools.groupby(fetchRows(dbc), lambda row: (row[0], row[1], row[2])):
+        sketch = newSketch(row[3] for row in rows)
+        sketches.append(key + (sketch['n'], dumpSketch(sketch)))
+    dbc.executemany("INSERT OR REPLACE INTO tod_sketch(location_id, bucket, date, n, sketch) VALUES(?, ?, ?, ?, ?)", sketches)
+    dbc.execute("DELETE FROM sketch_pending")
+    dstr = "made {} sketches".format(len(sketches))
+    logging.info(dstr)
+    return len(sketches)
+
+
+# set the percentiles of each location and time of day in summaries (from
+# calcLocationSummaries()), by merging the sketches of the dates of
+# datenorm_observation, in order of date
+# obs_condition and obs_params restrict the sketches, as for
+# calcLocationSummaries()
+def calcTODPercentiles(dbc, summaries, obs_condition='', obs_params=()):
+    qrystr = """
+    SELECT location_id, {} AS tod, sketch
+    FROM tod_sketch
+    WHERE date <= (SELECT MAX(date) FROM observation) {}
+    ORDER BY location_id, bucket, date
+    """.format(buildBucketTODExpr(), obs_condition)
+
+    dstr = "calcTODPercentiles() executing query string: {}".format(qrystr)
+    logging.debug(dstr)
+
+    dbc.execute(qrystr, obs_params)
+    for key, rows in itertools.groupby(fetchRows(dbc), lambda row: (row[0], row[1])):
+        sketch = newSketch()
+        for row in rows:
+            mergeSketches(sketch, loadSketch(row[2]))
+        if key[0] in summaries:
+            setSketchPercentiles(summaries[key[0]], TOD_KEYS[key[1]], sketch)
+
+
+
+
+##############################################################
+# rollups of temperatures, for the reports of the --rollup option
+# for each location and period of day (bucket), the count, sum, sum of
+# squares, min and max of air temps are kept for each day, month, season
+# and year, in tables rollup_day, rollup_month, rollup_season and
+# rollup_year, so that the mean, standard deviation and range over any
+# dates can be combined exactly from the coarsest rollups that cover them
+# (see decomposeDateRange()), rather than from the observations
+# rollups are keyed by period, the first date of the day, month, season or
+# year (YYYY-MM-DD), days by report date (see dateNormalisedSelect())
+# days are rolled up into months, and months into seasons and years
+# seasons are as for the southern hemisphere, summer being December to
+# February, so summer spans two years, and a year isn't made of seasons
+
+# rollup levels, coarsest first, as level -> dict of:
+#     months: length of a period, in months (0 for a day)
+#     child: the level periods are rolled up from
+#     key: sql expression of the period containing a date ({} for the date)
+ROLLUP_LEVELS = collections.OrderedDict([
+        ('year', {'months': 12, 'child': 'month', 'key': "DATE({}, 'start of year')"}),
+        ('season', {'months': 3, 'child': 'month',
+            'key': "DATE({0}, 'start of month', '-' || (CAST(STRFTIME('%m', {0}) AS INTEGER) % 3) || ' months')"}),
+        ('month', {'months': 1, 'child': 'day', 'key': "DATE({}, 'start of month')"}),
+        ('day', {'months': 0, 'child': None, 'key': "{}"})
+])
+
+# names of seasons, by their first month
+SEASON_NAMES = {12: 'summer', 3: 'autumn', 6: 'winter', 9: 'spring'}
+
+# reports of the --rollup option, a date range or a comparison of seasons
+ROLLUP_REPORTS = ('range', 'seasons')
+
+# csv and jsonl fields of rollup records, as well as REPORT_FIELDS (see
+# writeRollupReport())
+ROLLUP_FIELDS = ['season', 'sd', 'n', 'change']
+
+
+# add a number of months to the first date of a month (a datetime.date)
+def addMonths(date, months):
+    month = date.month - 1 + months
+    return datetime.date(date.year + month // 12, month % 12 + 1, 1)
+
+
+# get the rollup period of a level containing a date (a datetime.date)
+# returns tuple of the first date of the period, and the date after it
+def getRollupSpan(level, date):
+    months = ROLLUP_LEVELS[level]['months']
+    if months == 0:
+        return date, date + datetime.timedelta(days=1)
+    if level == 'year':
+        start = date.replace(month=1, day=1)
+    elif level == 'season':
+        start = addMonths(date.replace(day=1), -(date.month % 3))
+    else:
+        start = date.replace(day=1)
+    return start, addMonths(start, months)
+
+
+# get the name of a season, by its first date (a datetime.date), eg.
+# summer 2017-18 or autumn 2018
+def getSeasonName(start):
+    if start.month == 12:
+        return "{} {}-{:02d}".format(SEASON_NAMES[12], start.year, (start.year + 1) % 100)
+    return "{} {}".format(SEASON_NAMES[start.month], start.year)
+
+
+# split the dates from first to last (datetime.date, inclusive) into the
+# coarsest rollup periods that cover them, the whole periods of the
+# coarsest level within the range, with the dates before and after them
+# split into periods of the finer levels, eg. whole years, then seasons,
+# months and days either side
+# levels is the list of levels to use, coarsest first (default all)
+# returns list of (level, period) tuples, in order of date
+def decomposeDateRange(first, last, levels=None):
+    if levels is None:
+        levels = list(ROLLUP_LEVELS)
+    if first > last:
+        return []
+    level = levels[0]
+    start, end = getRollupSpan(level, first)
+    if start != first:
+        start = end
+    periods = []
+    date = start
+    while True:
+        period_start, period_end = getRollupSpan(level, date)
+        if period_end > last + datetime.timedelta(days=1):
+            break
+        periods.append((level, period_start.isoformat()))
+        date = period_end
+    if not periods:
+        return decomposeDateRange(first, last, levels[1:])
+    return (decomposeDateRange(first, start - datetime.timedelta(days=1), levels[1:]) + periods
+            + decomposeDateRange(date, last, levels[1:]))
+
+
+# create the rollup tables, if they don't already exist
+def createRollupTables(dbc):
+    for level in ROLLUP_LEVELS:
+        dbc.execute("""
+            CREATE TABLE IF NOT EXISTS rollup_{}(
+                location_id INTEGER NOT NULL,
+                period TEXT,
+                bucket INTEGER,
+                n INTEGER,
+                total REAL,
+                total_sq REAL,
+                min_temp REAL,
+                max_temp REAL,
+                PRIMARY KEY(location_id, period, bucket)
+            )""".format(level))
+
+
+# recalculate the rollups of the location and report dates observations
+# have been added for since they were last updated (see rollup_pending),
+# and of the months, seasons and years containing them
+# as with datenorm_observation, dates after the last date observed aren't
+# included, and are left pending until it is
+def updateRollups(dbc):
+    update_str = """
+        DROP TABLE IF EXISTS temp.rollup_date;
+        CREATE TEMP TABLE rollup_date(
+            location_id INTEGER NOT NULL,
+            date TEXT,
+            PRIMARY KEY(location_id, date)
+        );
+        INSERT INTO temp.rollup_date
+            SELECT location_id, date FROM rollup_pending
+            WHERE date <= (SELECT MAX(date) FROM observation);
+        DELETE FROM rollup_pending
+            WHERE (location_id, date) IN (SELECT location_id, date FROM temp.rollup_date);
+        INSERT OR REPLACE INTO rollup_day
+            SELECT location_id, report_date, bucket, COUNT(*), SUM(air_temp), SUM(air_temp * air_temp),
+                   MIN(air_temp), MAX(air_temp)
+            FROM observation
+            WHERE (location_id, report_date) IN (SELECT location_id, date FROM temp.rollup_date)
+                AND bucket IS NOT NULL AND air_temp IS NOT NULL
+            GROUP BY location_id, report_date, bucket;
+        """
+    # finer levels first, as coarser ones are rolled up from them
+    for level in reversed(ROLLUP_LEVELS):
+        child = ROLLUP_LEVELS[level]['child']
+        if child is None:
+            continue
+        update_str += """
+        INSERT OR REPLACE INTO rollup_{level}
+            SELECT child.location_id, parent.period, child.bucket, SUM(child.n), SUM(child.total),
+                   SUM(child.total_sq), MIN(child.min_temp), MAX(child.max_temp)
+            FROM (SELECT DISTINCT location_id, {key} AS period FROM temp.rollup_date) AS parent
+            JOIN rollup_{child} AS child ON child.location_id = parent.location_id
+                AND child.period >= parent.period AND child.period < DATE(parent.period, '+{months} months')
+            GROUP BY child.location_id, parent.period, child.bucket;
+        """.format(level=level, child=child, months=ROLLUP_LEVELS[level]['months'],
+                key=ROLLUP_LEVELS[level]['key'].format('date'))
+
+    dstr = "updateRollups() updating rollups with: {}".format(update_str)
+    logging.debug(dstr)
+
+    dbc.executescript(update_str)
+    dbc.execute("SELECT COUNT(*) FROM temp.rollup_date")
+    dstr = "rolled up {} location dates".format(dbc.fetchone()[0])
+    logging.info(dstr)
+
+
+# combine the rollups of periods (list of (level, period), as from
+# decomposeDateRange()), for each location and time of day
+# if locids (set of location ids) is given, only for those locations
+# returns dict of (location id, time of day key) -> dict of n, mean, sd
+# (population standard deviation), min and max
+def combineRollups(dbc, periods, locids=None):
+    totals = {}
+    for level in reversed(ROLLUP_LEVELS):
+        level_periods = [period for period_level, period in periods if period_level == level]
+        if not level_periods:
+            continue
+        qrystr = """
+        SELECT location_id, {} AS tod, n, total, total_sq, min_temp, max_temp
+        FROM rollup_{}
+        WHERE period IN ({})
+        """.format(buildBucketTODExpr(), level, ', '.join('?' * len(level_periods)))
+        if locids is not None:
+            qrystr += "AND location_id IN ({})\n".format(', '.join(str(locid) for locid in sorted(locids)))
+        qrystr += "ORDER BY location_id, bucket, period"
+        dbc.execute(qrystr, level_periods)
+        for row in dbc.fetchall():
+            key = (row[0], TOD_KEYS[row[1]])
+            if key not in totals:
+                totals[key] = [0, 0.0, 0.0, row[5], row[6]]
+            total = totals[key]
+            total[0] += row[2]
+            total[1] += row[3]
+            total[2] += row[4]
+            total[3] = min(total[3], row[5])
+            total[4] = max(total[4], row[6])
+    results = {}
+    for key, (n, total, total_sq, min_temp, max_temp) in totals.items():
+        mean = total / n
+        results[key] = {
+                'n': n,
+                'mean': mean,
+                'sd': max(0.0, total_sq / n - mean * mean) ** 0.5,
+                'min': min_temp,
+                'max': max_temp
+        }
+    return results
+
+
+# calculate a rollup report (see ROLLUP_REPORTS), over the dates and
+# locations selected by filters (from makeObservationFilters(), or None for
+# all of them), limited to the dates rolled up
+#     range: a result for each location and time of day
+#     seasons: a result for each location, time of day and season, with the
+#         change in mean from the same season the year before
+# returns tuple of date range (as per getObservationDateRange()), and
+# list of results (in order of location, time of day and season), each
+# a dict of location (name), tod, season (name, None for range), first
+# and last (dates covered), change and prev_season (the season before,
+# None if no results for it), and as per combineRollups()
+def calcRollupReport(dbc, report, filters=None):
+    locids = None if filters is None else getFilteredLocationIds(dbc, filters)
+    qrystr = "SELECT MIN(period), MAX(period) FROM rollup_day"
+    if locids is not None:
+        qrystr += " WHERE location_id IN ({})".format(', '.join(str(locid) for locid in sorted(locids)))
+    dbc.execute(qrystr)
+    first, last = dbc.fetchone()
+    if filters is not None:
+        if filters['from'] is not None and (first is None or filters['from'] > first):
+            first = filters['from']
+        if filters['to'] is not None and (last is None or filters['to'] < last):
+            last = filters['to']
+    results = []
+    if first is None or last is None or first > last:
+        return {'first': None, 'last': None, 'days': None}, results
+    first = datetime.date.fromisoformat(first)
+    last = datetime.date.fromisoformat(last)
+    obs_range = {
+            'first': first.isoformat(),
+            'last': last.isoformat(),
+            'days': (last - first).days
+    }
+
+    # the start and dates of each season in the range, or the whole range
+    spans = []
+    if report == 'seasons':
+        start = getRollupSpan('season', first)[0]
+        while start <= last:
+            end = addMonths(start, 3) - datetime.timedelta(days=1)
+            spans.append((start, max(start, first), min(end, last)))
+            start = addMonths(start, 3)
+    else:
+        spans.append((None, first, last))
+    stats = []
+    for start, span_first, span_last in spans:
+        periods = decomposeDateRange(span_first, span_last)
+        dstr = "rollup periods for {} to {}: {}".format(span_first, span_last, periods)
+        logging.debug(dstr)
+        stats.append(combineRollups(dbc, periods, locids))
+
+    for loc in getLocations(dbc):
+        for tod in ('night', 'morn', 'day', 'eve'):
+            key = (loc['id'], tod)
+            seasons = {}
+            for (start, span_first, span_last), span_stats in zip(spans, stats):
+                if key not in span_stats:
+                    continue
+                result = dict(span_stats[key])
+                result.update({
+                        'location': loc['name'],
+                        'tod': tod,
+                        'season': None if start is None else getSeasonName(start),
+                        'first': span_first.isoformat(),
+                        'last': span_last.isoformat(),
+                        'change': None,
+                        'prev_season': None
+                })
+                # compared with the same season the year before
+                if start is not None:
+                    prev = seasons.get(addMonths(start, -12))
+                    if prev is not None:
+                        result['change'] = result['mean'] - prev['mean']
+                        result['prev_season'] = prev['season']
+                    seasons[start] = result
+                results.append(result)
+    return obs_range, results
+
+
+# write a rollup report, as from calcRollupReport(), as text or records
+# (with a record of range or season, and unrounded values)
+def writeRollupReport(writer, obs_range, results):
+    tod_strs = {
+            'morn': 'morning',
+            'day': 'daytime',
+            'eve': 'evening',
+            'night': 'overnight'
+    }
+    if writer['format'] == 'text':
+        printObservationDatesSummary(obs_range, writer['out'])
+        for result in results:
+            season = ''
+            if result['season'] is not None:
+                season = " {} ({} to {})".format(result['season'], result['first'], result['last'])
+            line = "{}: {}{} mean {:.1f}, sd {:.1f} [range {:.1f} - {:.1f}] from {} observations".format(
+                    result['location'], tod_strs[result['tod']], season,
+                    result['mean'], result['sd'], result['min'], result['max'], result['n'])
+            if result['change'] is not None:
+                line += "; {:+.1f} on {}".format(result['change'], result['prev_season'])
+            print(line, file=writer['out'])
+        return
+
+    for result in results:
+        record = {
+                'record': 'range' if result['season'] is None else 'season',
+                'period': PERIOD_NAMES[result['tod']],
+                'location': result['location'],
+                'temp': result['mean'],
+                'temp_min': result['min'],
+                'temp_max': result['max'],
+                'first': result['first'],
+                'last': result['last'],
+                'days': (datetime.date.fromisoformat(result['last']) - datetime.date.fromisoformat(result['first'])).days,
+                'season': result['season'],
+                'sd': result['sd'],
+                'n': result['n'],
+                'change': result['change']
+        }
+        writeReportRecord(writer, record)
+
+
+
+
+##############################################################
+# compact columnar archive of observations, see the compact command
+# each archive file holds one location's observations for one month,
+# without duplicates, as fixed width column arrays following a header:
+#     magic, format version, number of columns, number of rows, location id
+#     location name (utf-8, nul padded)
+#     for each column: name (nul padded), array typecode
+# version 1 archives don't have the rain, wind, pressure and dew point
+# columns, which are read as missing
+# columns are in native byte order and 8 byte aligned, so can be used
+# directly from a memory map
+
+ARCHIVE_MAGIC = b'BOMC'
+ARCHIVE_VERSION = 2
+ARCHIVE_SUFFIX = '.bomc'
+ARCHIVE_HEADER = struct.Struct('<4sHHIq')
+ARCHIVE_NAME = struct.Struct('<64s')
+ARCHIVE_COLUMN = struct.Struct('<24sc7x')
+
+# archive columns and their array typecodes, in order
+# seconds are since the epoch, in local time, as per local_date_time_full
+ARCHIVE_COLUMNS = [
+        ('seconds', 'q'),
+        ('air_temp', 'd'),
+        ('apparent_temp', 'd'),
+        ('relative_humidity', 'd'),
+        ('cloud_oktas', 'q'),
+        ('rain_trace', 'd'),
+        ('rain', 'd'),
+        ('wind_dir', 'b'),
+        ('wind_spd_kmh', 'd'),
+        ('press_msl', 'd'),
+        ('dewpt', 'd')
+]
+
+# values of missing readings in archive columns, by typecode (wind_dir is
+# stored as its code, see WIND_DIR_CODES)
+ARCHIVE_MISSING = {
+        'd': float('nan'),
+        'b': -1,
+        'q': -1
+}
+
+EPOCH = datetime.datetime(1970, 1, 1)
+EPOCH_ORDINAL = EPOCH.toordinal()
+
+
+# check if a file is an observation archive, rather than json
+def isArchiveFile(fn):
+    with open(fn, 'rb') as f:
+        return f.read(len(ARCHIVE_MAGIC)) == ARCHIVE_MAGIC
+
+
+# round up to a multiple of 8 bytes
+def _align8(size):
+    return (size + 7) & ~7
+
+
+# convert observation row date and time strings to seconds since the epoch
+def dateTimeToSeconds(obs_date, obs_time):
+    obsdatetime = datetime.datetime.fromisoformat(obs_date + 'T' + obs_time)
+    return (obsdatetime - EPOCH) // datetime.timedelta(seconds=1)
+
+
+# convert a local_date_time_full string to seconds since the epoch
+def dateTimeFullToSeconds(date_time_full):
+    obsdatetime = datetime.datetime.strptime(date_time_full, '%Y%m%d%H%M%S')
+    return (obsdatetime - EPOCH) // datetime.timedelta(seconds=1)
+
+
+# convert seconds since the epoch to a local_date_time_full string
+def secondsToDateTimeFull(seconds):
+    return (EPOCH + datetime.timedelta(seconds=seconds)).strftime('%Y%m%d%H%M%S')
+
+
+# read an archive's header and columns from a buffer (bytes or mmap),
+# columns are views of the buffer, so no data is copied
+# returns dict of id, name, nrows and columns (dict of name -> memoryview)
+def readArchive(buf, fn=''):
+    magic, version, ncols, nrows, locid = ARCHIVE_HEADER.unpack_from(buf, 0)
+    if magic != ARCHIVE_MAGIC or version > ARCHIVE_VERSION:
+        raise ValueError("{} is not a supported observation archive".format(fn))
+    offset = ARCHIVE_HEADER.size
+    name = ARCHIVE_NAME.unpack_from(buf, offset)[0].rstrip(b'\0').decode('utf-8')
+    offset += ARCHIVE_NAME.size
+    coldefs = []
+    for i in range(ncols):
+        colname, typecode = ARCHIVE_COLUMN.unpack_from(buf, offset)
+        coldefs.append((colname.rstrip(b'\0').decode('ascii'), typecode.decode('ascii')))
+        offset += ARCHIVE_COLUMN.size
+    offset = _align8(offset)
+    view = memoryview(buf)
+    columns = {}
+    for colname, typecode in coldefs:
+        size = nrows * array.array(typecode).itemsize
+        columns[colname] = view[offset:offset + size].cast(typecode)
+        offset = _align8(offset + size)
+    archive = {
+            'id': locid,
+            'name': name,
+            'nrows': nrows,
+            'columns': columns
+    }
+    return archive
+
+
+# open an archive file, memory mapping its columns, see readArchive()
+def openArchive(fn):
+    with open(fn, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise ValueError("{} is not a supported observation archive".format(fn))
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return readArchive(mm, fn)
+
+
+# convert an observation row (as per observationRow()) to an archive
+# record, a tuple of values for each of ARCHIVE_COLUMNS
+def observationRowToRecord(row):
+    seconds = dateTimeToSeconds(row[1], row[2])
+    readings = [ARCHIVE_MISSING['d'] if value is None else value for value in row[7:13]]
+    readings[2] = WIND_DIR_CODES.get(row[9], ARCHIVE_MISSING['b'])
+    return (seconds,) + row[3:7] + tuple(readings)
+
+
+# get an archive's column values (of rows start to end, default all) as a
+# list, with missing readings (and columns not in the archive's version)
+# as None, wind_dir as text
+def getArchiveColumnValues(archive, colname, start=0, end=None):
+    if end is None:
+        end = archive['nrows']
+    column = archive['columns'].get(colname)
+    if column is None:
+        return [None] * max(0, end - start)
+    column = column[start:end]
+    if colname == 'wind_dir':
+        return [WIND_DIRS[code] if code >= 0 else None for code in column]
+    if column.format == 'd':
+        return [value if value == value else None for value in column.tolist()]
+    return column.tolist()
+
+
+# write an archive file, from a list of tuples of values for each of
+# ARCHIVE_COLUMNS (see observationRowToRecord()), sorted by seconds
+# the file is written to a temporary file then renamed, so never partial
+def writeArchive(fn, locid, locname, records):
+    header = ARCHIVE_HEADER.pack(ARCHIVE_MAGIC, ARCHIVE_VERSION, len(ARCHIVE_COLUMNS), len(records), locid)
+    header += ARCHIVE_NAME.pack(locname.encode('utf-8'))
+    for colname, typecode in ARCHIVE_COLUMNS:
+        header += ARCHIVE_COLUMN.pack(colname.encode('ascii'), typecode.encode('ascii'))
+    tmpfn = fn + '.tmp'
+    with open(tmpfn, 'wb') as f:
+        f.write(header)
+        f.write(b'\0' * (_align8(len(header)) - len(header)))
+        fields = list(zip(*records)) if records else [()]*len(ARCHIVE_COLUMNS)
+        for (colname, typecode), values in zip(ARCHIVE_COLUMNS, fields):
+            data = array.array(typecode, values).tobytes()
+            f.write(data)
+            f.write(b'\0' * (_align8(len(data)) - len(data)))
+    os.replace(tmpfn, fn)
+
+
+# get the range of an archive's rows that are selected by filters (from
+# makeObservationFilters(), or None for all rows)
+# returns tuple of start and end (exclusive) row
+def getArchiveSlice(archive, filters=None):
+    seconds = archive['columns']['seconds']
+    if filters is None:
+        return 0, archive['nrows']
+    if not isStationSelected(filters, archive['id'], archive['name']):
+        return 0, 0
+    start = 0
+    end = archive['nrows']
+    # sorted by time, so bisect for the first and last selected
+    if filters['first'] is not None:
+        start = bisect.bisect_left(seconds, dateTimeFullToSeconds(filters['first']))
+    if filters['last'] is not None:
+        end = bisect.bisect_right(seconds, dateTimeFullToSeconds(filters['last']))
+    return start, max(start, end)
+
+
+# read an archive's observations, as prepared by prepareObservations()
+# observations at or before the location's watermark (if any), and those
+# not selected by filters (if any) are skipped
+def prepareArchiveObservations(archive, watermarks=None, filters=None):
+    columns = archive['columns']
+    start, end = getArchiveSlice(archive, filters)
+    if end <= start:
+        return None
+    seconds = columns['seconds']
+    latest = secondsToDateTimeFull(seconds[end-1])
+    if watermarks is not None and archive['id'] in watermarks:
+        watermark = dateTimeFullToSeconds(watermarks[archive['id']])
+        # sorted by time, so skip to the first after the watermark
+        start = max(start, bisect.bisect_right(seconds, watermark))
+    # convert times to date and time strings, dates only once per day
+    dates = {}
+    rows = []
+    values = [getArchiveColumnValues(archive, colname, start, end) for colname, typecode in ARCHIVE_COLUMNS[1:]]
+    for i in range(start, end):
+        day, secs = divmod(seconds[i], 86400)
+        if day not in dates:
+            dates[day] = datetime.date.fromordinal(EPOCH_ORDINAL + day).isoformat()
+        obs_time = "{:02d}:{:02d}:{:02d}".format(secs // 3600, secs // 60 % 60, secs % 60)
+        rows.append((archive['id'], dates[day], obs_time) + tuple(column[i - start] for column in values)
+                + observationKeys(dates[day], obs_time))
+    prepared = {
+            'id': archive['id'],
+            'name': archive['name'],
+            'latest': latest,
+            'nobs': len(rows),
+            'rows': rows
+    }
+    return prepared
+
+
+# get the archive filename for a location and month (YYYY-MM)
+def getArchiveFilename(archivedir, locid, month):
+    return os.path.join(archivedir, "{}-{}{}".format(locid, month, ARCHIVE_SUFFIX))
+
+
+# compact observation files into per location, per month archives
+# observations are merged into any existing archives, where those already
+# in an archive are kept, as for INSERT OR IGNORE
+# returns the number of archive files written
+def compactFiles(filenames, archivedir, jobs=1):
+    locations = {}
+    months = {}
+    for fn, parsed in parseFiles(filenames, jobs=jobs):
+        for prepared in getPreparedObservations(parsed):
+            if prepared['nobs'] < 1:
+                continue
+            locations.setdefault(prepared['id'], prepared['name'])
+            for row in prepared['rows']:
+                key = (row[0], row[1][:7])
+                if key not in months:
+                    months[key] = {}
+                # first of any duplicates is kept, with its rain filled in
+                # if unknown, as per INSERT_OBSERVATION
+                kept = months[key].setdefault(row[1] + row[2], row)
+                if kept[8] is None and row[8] is not None:
+                    months[key][row[1] + row[2]] = kept[:8] + (row[8],) + kept[9:]
+
+    for (locid, month), rows in sorted(months.items()):
+        fn = getArchiveFilename(archivedir, locid, month)
+        records = {}
+        if os.path.exists(fn):
+            archive = openArchive(fn)
+            columns = archive['columns']
+            for i in range(archive['nrows']):
+                records[columns['seconds'][i]] = tuple(columns[colname][i] if colname in columns else ARCHIVE_MISSING[typecode]
+                        for colname, typecode in ARCHIVE_COLUMNS)
+            del archive, columns
+        nexisting = len(records)
+        for row in rows.values():
+            record = observationRowToRecord(row)
+            kept = records.setdefault(record[0], record)
+            # rain is the 7th column
+            if kept[6] != kept[6] and record[6] == record[6]:
+                records[record[0]] = kept[:6] + (record[6],) + kept[7:]
+        writeArchive(fn, locid, locations[locid], [records[s] for s in sorted(records)])
+        dstr = "archive {}: {} existing, {} added observations".format(fn, nexisting, len(records) - nexisting)
+        logging.info(dstr)
+    return len(months)
+
+
+def compactMain(argv):
+    debug = 0
+    jobs = 1
+    archivedir = '.'
+    paramstr = "compact [-h] [-d] [-j jobs] [-o archivedir] jsonfile1 [jsonfile 2 ...]"
+    usagestr = "Usage: {} {}".format(sys.argv[0], paramstr)
+
+    try:
+        options, remainder = getopt.gnu_getopt(argv[2:], "hdj:o:")
+    except getopt.GetoptError:
+        print(usagestr, file=sys.stderr)
+        sys.exit(2)
+
+    for opt, arg in options:
+        if opt == '-h':
+            print(__doc__, file=sys.stderr)
+            sys.exit()
+        elif opt == '-d':
+            debug = 1
+        elif opt == '-j':
+            jobs = getIntOption(arg, usagestr)
+        elif opt == '-o':
+            archivedir = arg
+        else:
+            assert False, "unhandled option"
+
+    if debug>0:
+        logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.DEBUG)
+    else:
+        logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.WARNING)
+
+    if len(remainder) < 1:
+        print(usagestr, file=sys.stderr)
+        sys.exit(2)
+
+    os.makedirs(archivedir, exist_ok=True)
+    narchives = compactFiles(remainder, archivedir, jobs)
+    print("compacted {} files into {} archives in {}".format(len(remainder), narchives, archivedir), file=sys.stderr)
+
+
+
+
+##############################################################
+# reading observation fields from files, see the read command
+# for each observation, as readweatherobs.sh does with jq, prints:
+#     <name> <local_date_time> : <air_temp> feels like <apparent_t>
+# followed by the fields of each field option given, in order, eg:
+#     Cairns 18/02:00pm : 31.2 feels like 33.9 humidity: 61
+# values are printed as jq would, missing values as null
+# archives and the database don't keep the cloud description (so it's
+# null), and observations from them are in order of time, rather than
+# newest first as in json files
+
+# field options (other than t and a, which are always printed) as label
+# and observation keys, in readweatherobs.sh order
+READ_FIELDS = collections.OrderedDict([
+        ('h', ('humidity', ['rel_hum'])),
+        ('d', ('dewpoint', ['dewpt'])),
+        ('w', ('wind', ['wind_dir', 'wind_spd_kmh'])),
+        ('r', ('rain', ['rain_trace'])),
+        ('c', ('cloud', ['cloud'])),
+        ('p', ('barometer', ['press_msl']))
+])
+
+
+# convert a json value to text as jq string interpolation does
+def jqValue(value):
+    if value is None:
+        return 'null'
+    if value is True or value is False:
+        return 'true' if value else 'false'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+# get the format string and observation keys of lines for fields (a string
+# of field options, see READ_FIELDS)
+# returns tuple of format string and list of keys, one per {}
+def getReadFormat(fields):
+    fmt = "{} {} : {} feels like {}"
+    keys = ['name', 'local_date_time', 'air_temp', 'apparent_t']
+    for opt in fields:
+        if opt in READ_FIELDS:
+            label, fkeys = READ_FIELDS[opt]
+            fmt += " {}:".format(label) + " {}" * len(fkeys)
+            keys.extend(fkeys)
+    return fmt, keys
+
+
+# generate lines of fields (ending in newlines) for observation
+# dictionaries
+def formatObservationLines(data, fields):
+    fmt, keys = getReadFormat(fields)
+    fmt += '\n'
+    for obs in data:
+        yield fmt.format(*[jqValue(obs.get(key)) for key in keys])
+
+
+# format observation dictionaries as lines of fields
+# returns the lines as a single string
+def formatObservationFields(data, fields):
+    return ''.join(formatObservationLines(data, fields))
+
+
+# convert a date (YYYY-MM-DD) and time (HH:MM:SS) to the local_date_time
+# of json observations (eg. 18/02:00pm)
+def toLocalDateTime(obs_date, obs_time):
+    hours = int(obs_time[0:2])
+    return "{}/{:02d}:{}{}".format(obs_date[8:10], (hours - 1) % 12 + 1, obs_time[3:5], 'am' if hours < 12 else 'pm')
+
+
+# convert observation values as stored (in the database or an archive) to
+# an observation dictionary, with keys as in json files
+def storedObservation(name, obs_date, obs_time, air_temp, apparent_temp, relative_humidity,
+        dewpt, wind_dir, wind_spd_kmh, rain_trace, press_msl):
+    obs = {
+            'name': name,
+            'local_date_time': toLocalDateTime(obs_date, obs_time),
+            'air_temp': air_temp,
+            'apparent_t': apparent_temp,
+            'rel_hum': None if relative_humidity is None or relative_humidity < 0 else relative_humidity,
+            'dewpt': dewpt,
+            'wind_dir': wind_dir,
+            'wind_spd_kmh': wind_spd_kmh,
+            # rain_trace is text in json files, eg. 0.0 and - for missing
+            'rain_trace': '-' if rain_trace is None else '{:.1f}'.format(rain_trace),
+            'press_msl': press_msl
+    }
+    return obs
+
+
+# generate an archive's observations as observation dictionaries
+def getArchiveObservations(archive):
+    values = {colname: getArchiveColumnValues(archive, colname) for colname, typecode in ARCHIVE_COLUMNS}
+    for i, seconds in enumerate(values['seconds']):
+        obs_date, obs_time = dateTimeFullToRowKey(secondsToDateTimeFull(seconds))
+        yield storedObservation(archive['name'], obs_date, obs_time, values['air_temp'][i],
+                values['apparent_temp'][i], values['relative_humidity'][i], values['dewpt'][i],
+                values['wind_dir'][i], values['wind_spd_kmh'][i], values['rain_trace'][i],
+                values['press_msl'][i])
+
+
+# read a json observation file (or compacted archive, or - for standard
+# input) and format its observations' fields, see formatObservationFields()
+# json files are streamed, so can be gzipped, newline delimited or have
+# several documents, as when reporting (see getObservationRecords())
+# this is run in worker processes when reading files in parallel
+def readObservationFields(fn, fields):
+    dstr = "reading file {}".format(fn)
+    logging.debug(dstr)
+    if fn == '-':
+        content = sys.stdin.buffer.read()
+    else:
+        with open(fn, 'rb') as f:
+            content = f.read(len(ARCHIVE_MAGIC))
+            if content == ARCHIVE_MAGIC:
+                content += f.read()
+    if content[:len(ARCHIVE_MAGIC)] == ARCHIVE_MAGIC:
+        return formatObservationFields(getArchiveObservations(readArchive(content, fn)), fields)
+    if fn == '-':
+        f = io.BytesIO(content)
+        if content[:len(GZIP_MAGIC)] == GZIP_MAGIC:
+            f = gzip.GzipFile(fileobj=f)
+        f = io.TextIOWrapper(f, encoding='utf-8')
+    else:
+        f = openObservationStream(fn)
+    with f:
+        records = (obs for obs in getObservationRecords(f) if obs is not None)
+        return formatObservationFields(records, fields)
+
+
+# field options, as passed to each reading worker process
+_read_worker_state = {}
+
+
+# initialise a reading worker process, see readObservationFields()
+def _initReadWorker(fields):
+    _read_worker_state['fields'] = fields
+
+
+# as per readObservationFields(), for use with Pool.imap()
+def _readObservationFieldsWorker(fn):
+    return readObservationFields(fn, _read_worker_state['fields'])
+
+
+# read files with readObservationFields()
+# with more than one job, files are read by a pool of worker processes,
+# results are still generated in order of filenames
+# standard input (-) can only be read without workers
+def readFiles(filenames, fields, jobs=1):
+    if jobs > 1 and len(filenames) > 1 and '-' not in filenames:
+        dstr = "reading {} files with {} worker processes".format(len(filenames), jobs)
+        logging.info(dstr)
+        pool = multiprocessing.Pool(jobs, _initReadWorker, (fields,))
+        results = pool.imap(_readObservationFieldsWorker, filenames, chunksize=4)
+    else:
+        pool = None
+        results = (readObservationFields(fn, fields) for fn in filenames)
+    try:
+        yield from results
+    finally:
+        # stop workers early if the output is closed (eg. piped to head)
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+
+# generate the observations in a database, as observation dictionaries,
+# in order of location and time
+def getStoredObservations(dbc):
+    dbc.execute("""
+    SELECT name, date, time, air_temp, apparent_temp, relative_humidity,
+           dewpt, wind_dir, wind_spd_kmh, rain_trace, press_msl
+    FROM observation
+    INNER JOIN location
+    ON location.id = observation.location_id
+    ORDER BY location_id, date, time
+    """)
+    for row in fetchRows(dbc):
+        yield storedObservation(*row)
+
+
+def readMain(argv):
+    debug = 0
+    jobs = 1
+    dbfile = None
+    fields = ''
+    paramstr = "read [--help] [--debug] [-tahdwrcp] [-j jobs] [--db dbfile] [file ...]"
+    usagestr = "Usage: {} {}".format(sys.argv[0], paramstr)
+
+    # -h and -d are field options, as in readweatherobs.sh
+    try:
+        options, remainder = getopt.gnu_getopt(argv[2:], "tahdwrcpj:", ["help", "debug", "db="])
+    except getopt.GetoptError:
+        print(usagestr, file=sys.stderr)
+        sys.exit(2)
+
+    for opt, arg in options:
+        if opt == '--help':
+            print(__doc__, file=sys.stderr)
+            sys.exit()
+        elif opt == '--debug':
+            debug = 1
+        elif opt in ('-t', '-a'):
+            pass # always printed
+        elif opt[1] in READ_FIELDS:
+            fields += opt[1]
+        elif opt == '-j':
+            jobs = getIntOption(arg, usagestr)
+        elif opt == '--db':
+            dbfile = arg
+        else:
+            assert False, "unhandled option"
+
+    if debug>0:
+        logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.DEBUG)
+    else:
+        logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.WARNING)
+
+    if dbfile is not None and len(remainder) > 0:
+        print(usagestr, file=sys.stderr)
+        sys.exit(2)
+
+    try:
+        with openReportOutput() as out:
+            if dbfile is not None:
+                uri = 'file:{}?mode=ro'.format(urllib.request.pathname2url(os.path.abspath(dbfile)))
+                conn = sqlite3.connect(uri, uri=True)
+                out.writelines(formatObservationLines(getStoredObservations(conn.cursor()), fields))
+                conn.close()
+            else:
+                # standard input if no files are given, as for jq
+                for text in readFiles(remainder or ['-'], fields, jobs):
+                    out.write(text)
+    except BrokenPipeError:
+        # output closed early, don't complain about it on exit either
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
+
+
+
+##############################################################
+# downloading observations from BoM, see the fetch command
+# each station's json file is downloaded (by a pool of threads, each
+# keeping its connection open between requests) and written to
+# <name>-YYYY-MM-DD.json as getweatherobs.sh does
+# the ETag and Last-Modified of each download are kept (in FETCH_STATE_FILE
+# in the output directory) and sent back, so unchanged files aren't resent
+
+FETCH_BASE_URL = 'http://www.bom.gov.au'
+FETCH_STATE_FILE = '.fetch_state.json'
+FETCH_TIMEOUT = 30
+# BoM refuses requests without a browser-like user agent
+FETCH_HEADERS = {
+        'User-Agent': 'Mozilla/5.0 (compatible; bomreader)',
+        'Accept': 'application/json',
+        'Accept-Encoding': 'gzip'
+}
+
+# default station table, of name, product (eg. IDQ60801) and wmo id
+DEFAULT_STATION_TABLE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stations.csv')
+
+
+# read a station table, a csv file with name, product and wmo columns
+# returns list of station dicts, in file order
+def readStationTable(fn):
+    with open(fn, newline='') as f:
+        stations = [row for row in csv.DictReader(f) if row['name']]
+    return stations
+
+
+# get the url path of a station's observation json file
+def getStationPath(station):
+    return "/fwo/{0}/{0}.{1}.json".format(station['product'], station['wmo'])
+
+
+# per thread (persistent) connection, see getFetchConnection()
+_fetch_worker_state = threading.local()
+
+
+# get this thread's connection to baseurl, opening it if need be
+# connections are kept open (http/1.1 keep-alive) for following requests
+def getFetchConnection(baseurl, reconnect=False):
+    conn = getattr(_fetch_worker_state, 'conn', None)
+    if conn is not None and reconnect:
+        conn.close()
+        conn = None
+    if conn is None:
+        url = urllib.parse.urlsplit(baseurl)
+        if url.scheme == 'https':
+            conn = http.client.HTTPSConnection(url.netloc, timeout=FETCH_TIMEOUT)
+        else:
+            conn = http.client.HTTPConnection(url.netloc, timeout=FETCH_TIMEOUT)
+        _fetch_worker_state.conn = conn
+    return conn
+
+
+# write content to fn, via a temporary file in the same directory and a
+# rename, so fn is never left partially written
+def writeFileAtomically(fn, content):
+    fd, tmpfn = tempfile.mkstemp(dir=os.path.dirname(fn) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        os.replace(tmpfn, fn)
+    except BaseException:
+        os.unlink(tmpfn)
+        raise
+
+
+# download a station's observations to outdir, if changed since the last
+# download (as per validators, a dict of etag and last_modified, or None)
+# returns a dict of station name, path, http status, filename (None if
+# not downloaded) and the new validators
+def fetchStation(baseurl, station, outdir, validators=None):
+    path = getStationPath(station)
+    headers = dict(FETCH_HEADERS)
+    if validators:
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+    result = {
+            'name': station['name'],
+            'path': path,
+            'status': None,
+            'filename': None,
+            'validators': validators
+    }
+    # a kept open connection may have been closed by the server, so retry
+    # once on a new connection
+    for attempt in range(2):
+        conn = getFetchConnection(baseurl, reconnect=attempt > 0)
+        try:
+            conn.request('GET', path, headers=headers)
+            response = conn.getresponse()
+            content = response.read()
+            break
+        except (http.client.HTTPException, OSError) as e:
+            dstr = "fetching {} failed: {}".format(path, e)
+            logging.debug(dstr)
+            if attempt > 0:
+                dstr = "Unable to download {}: {}".format(path, e)
+                logging.warning(dstr)
+                getFetchConnection(baseurl, reconnect=True)
+                return result
+    result['status'] = response.status
+    if response.status == 304:
+        dstr = "{} not modified".format(path)
+        logging.info(dstr)
+    elif response.status == 200:
+        if response.getheader('Content-Encoding') == 'gzip':
+            content = gzip.decompress(content)
+        result['filename'] = os.path.join(outdir, "{}-{}.json".format(station['name'], time.strftime('%Y-%m-%d')))
+        writeFileAtomically(result['filename'], content)
+        result['validators'] = {
+                'etag': response.getheader('ETag'),
+                'last_modified': response.getheader('Last-Modified')
+        }
+        dstr = "downloaded {} to {}".format(path, result['filename'])
+        logging.info(dstr)
+    else:
+        dstr = "Unable to download {}: {} {}".format(path, response.status, response.reason)
+        logging.warning(dstr)
+    return result
+
+
+# load the validators of previous downloads, from the fetch state file
+# returns dict of url path -> validators dict
+def readFetchState(outdir):
+    try:
+        with open(os.path.join(outdir, FETCH_STATE_FILE), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+# save the validators of downloads, to the fetch state file
+def writeFetchState(outdir, state):
+    writeFileAtomically(os.path.join(outdir, FETCH_STATE_FILE), json.dumps(state, indent=1).encode('utf-8'))
+
+
+# download stations' observations to outdir, with a pool of jobs threads
+# returns list of fetchStation() results, in order of stations
+def fetchStations(stations, outdir, baseurl=FETCH_BASE_URL, jobs=4):
+    state = readFetchState(outdir)
+    def fetch(station):
+        return fetchStation(baseurl, station, outdir, state.get(getStationPath(station)))
+    with multiprocessing.pool.ThreadPool(max(1, min(jobs, len(stations)))) as pool:
+        results = pool.map(fetch, stations)
+    for result in results:
+        if result['validators']:
+            state[result['path']] = result['validators']
+    writeFetchState(outdir, state)
+    return results
+
+
+def fetchMain(argv):
+    debug = 0
+    jobs = 4
+    outdir = '.'
+    station_table = DEFAULT_STATION_TABLE
+    baseurl = FETCH_BASE_URL
+    dbfile = None
+    paramstr = "fetch [-h] [-d] [-j jobs] [-o outdir] [-t stations.csv] [-u baseurl] [--db dbfile] [station ...]"
+    usagestr = "Usage: {} {}".format(sys.argv[0], paramstr)
+
+    try:
+        options, remainder = getopt.gnu_getopt(argv[2:], "hdj:o:t:u:", ["db="])
+    except getopt.GetoptError:
+        print(usagestr, file=sys.stderr)
+        sys.exit(2)
+
+    for opt, arg in options:
+        if opt == '-h':
+            print(__doc__, file=sys.stderr)
+            sys.exit()
+        elif opt == '-d':
+            debug = 1
+        elif opt == '-j':
+            jobs = getIntOption(arg, usagestr)
+        elif opt == '-o':
+            outdir = arg
+        elif opt == '-t':
+            station_table = arg
+        elif opt == '-u':
+            baseurl = arg
+        elif opt == '--db':
+            dbfile = arg
+        else:
+            assert False, "unhandled option"
+
+    if debug>0:
+        logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.DEBUG)
+    else:
+        logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.WARNING)
+
+    stations = readStationTable(station_table)
+    if remainder:
+        names = set(remainder)
+        unknown = names - {station['name'] for station in stations}
+        if unknown:
+            print("Unknown stations: {}".format(' '.join(sorted(unknown))), file=sys.stderr)
+            sys.exit(2)
+        stations = [station for station in stations if station['name'] in names]
+
+    os.makedirs(outdir, exist_ok=True)
+    results = fetchStations(stations, outdir, baseurl, jobs)
+    filenames = [result['filename'] for result in results if result['filename'] is not None]
+    nunchanged = sum(1 for result in results if result['status'] == 304)
+    print("downloaded {} files, {} unchanged, {} failed".format(len(filenames), nunchanged,
+        len(results) - len(filenames) - nunchanged), file=sys.stderr)
+
+    # add the downloaded observations to the persistent database
+    if dbfile and filenames:
+        conn = sqlite3.connect(dbfile)
+        with conn:
+            dbc = conn.cursor()
+            initDB(dbc, True)
+            ingestFiles(conn, dbc, filenames, True)
+        conn.close()
+
+    if len(filenames) + nunchanged < len(results):
+        return 1
+
+
+
+
+##############################################################
+# watching a directory for new observation files, see the watch command
+# new files are ingested into the database as they appear, with the daily
+# stats kept up to date as materialised tables (refreshing only the dates
+# with new observations), and reports are served over http (on a tcp port
+# or unix socket) from an LRU cache of rendered reports, where a location's
+# reports are dropped from the cache when it has new observations:
+#     /summary[?station=name or id][&format=text|csv|jsonl]
+#     /daily[?station=name or id][&format=text|csv|jsonl]
+#     /stations
+
+WATCH_INTERVAL = 60
+WATCH_PORT = 8765
+WATCH_CACHE_SIZE = 256
+# files modified within this many seconds may still be being written, so
+# are left until the next poll
+WATCH_SETTLE_SECONDS = 5
+
+WATCH_CONTENT_TYPES = {
+        'text': 'text/plain; charset=utf-8',
+        'csv': 'text/csv; charset=utf-8',
+        'jsonl': 'application/x-ndjson'
+}
+
+
+# get a cached report, moving it to the most recently used end of the cache
+# returns None if not cached
+def cacheGet(cache, key):
+    if key not in cache['entries']:
+        return None
+    cache['entries'].move_to_end(key)
+    return cache['entries'][key]
+
+
+# add a report to the cache, dropping the least recently used if full
+def cachePut(cache, key, value):
+    cache['entries'][key] = value
+    cache['entries'].move_to_end(key)
+    while len(cache['entries']) > cache['size']:
+        cache['entries'].popitem(last=False)
+
+
+# drop cached reports for locations (an iterable of location ids), and
+# reports for all locations (with a location id of None)
+def cacheInvalidate(cache, locids):
+    locids = set(locids)
+    locids.add(None)
+    for key in [key for key in cache['entries'] if key[1] in locids]:
+        del cache['entries'][key]
+
+
+# get observation files in a directory, which aren't still being written
+def getWatchedFiles(watchdir):
+    settled = time.time() - WATCH_SETTLE_SECONDS
+    filenames = []
+    for entry in os.scandir(watchdir):
+        if entry.name.endswith(('.json', '.json.gz', ARCHIVE_SUFFIX)) and entry.is_file() and entry.stat().st_mtime < settled:
+            filenames.append(entry.path)
+    return sorted(filenames)
+
+
+# check if a file has failed to be ingested (see ingestWatchedFiles()),
+# and hasn't changed since
+def isFailedFile(state, fn):
+    if fn not in state['failed']:
+        return False
+    try:
+        fdetails = getFileDetails(fn)
+    except OSError:
+        return True
+    return state['failed'][fn] == (fdetails['size'], fdetails['mtime'])
+
+
+# ingest files from the watched directory, returns the number ingested
+# files are ingested together, unless one can't be (eg. it isn't observation
+# json), then each is ingested on its own, so the others are still added,
+# and those that can't be are recorded as failed, so they aren't tried
+# again until they change
+def ingestWatchedFiles(state, filenames):
+    conn = state['conn']
+    dbc = state['dbc']
+    try:
+        return ingestFiles(conn, dbc, filenames, True, state['jobs'])
+    except (OSError, ValueError, KeyError) as e:
+        conn.rollback()
+        dstr = "Unable to ingest files from {} together, ingesting each: {}".format(state['dir'], e)
+        logging.info(dstr)
+    nfiles = 0
+    for fn in filenames:
+        try:
+            nfiles += ingestFiles(conn, dbc, [fn], True)
+        except (OSError, ValueError, KeyError) as e:
+            conn.rollback()
+            dstr = "Unable to ingest {}, skipping until it changes: {}".format(fn, e)
+            logging.warning(dstr)
+            try:
+                fdetails = getFileDetails(fn)
+                state['failed'][fn] = (fdetails['size'], fdetails['mtime'])
+            except OSError:
+                pass
+    return nfiles
+
+
+# ingest any new files in the watched directory, refreshing the daily stats
+# and dropping cached reports of locations with new observations (or all,
+# if the range of dates observed has changed)
+# returns the number of files ingested
+def watchIngest(state):
+    conn = state['conn']
+    dbc = state['dbc']
+    filenames = [fn for fn in getWatchedFiles(state['dir']) if not isFailedFile(state, fn)]
+    nfiles = ingestWatchedFiles(state, filenames)
+    if nfiles == 0 and state['obs_range'] is not None:
+        return 0
+    dbc.execute("SELECT DISTINCT location_id FROM refresh_pending")
+    changed = [row[0] for row in dbc.fetchall()]
+    materialiseDailyStats(dbc)
+    calcDayToDayTODAvgTempDiffs(dbc)
+    conn.commit()
+    obs_range = getObservationDateRange(dbc)
+    if obs_range != state['obs_range']:
+        # the date range is part of every summary, and the last date
+        # affects every location's overnight observations
+        state['cache']['entries'].clear()
+    else:
+        cacheInvalidate(state['cache'], changed)
+    state['obs_range'] = obs_range
+    state['locations'] = [dict(loc) for loc in getLocations(dbc)]
+    dstr = "ingested {} files, {} locations with new observations".format(nfiles, len(changed))
+    logging.info(dstr)
+    return nfiles
+
+
+# find a location by name or id, returns None if not found
+def findLocation(locations, station):
+    for loc in locations:
+        if station == loc['name'] or station == str(loc['id']):
+            return loc
+    return None
+
+
+# render a report (summary, daily, or the date range line of the text
+# summary) for a location (or all locations if loc is None) in fmt, as per
+# the main report, for a location's text summary the date range line is
+# left out, so it can be included in the summary of all locations
+# returns the report as a string
+def renderWatchReport(state, kind, loc, fmt, header=True):
+    out = io.StringIO()
+    writer = openReportWriter(fmt, out, header)
+    locid = loc['id'] if loc is not None else None
+    if kind == 'range':
+        printObservationDatesSummary(state['obs_range'], out)
+    elif kind == 'daily':
+        writeDailyObservations(writer, getDailyObservations(state['dbc'], locid))
+    elif loc is not None:
+        summaries = calcLocationSummaries(state['dbc'], locid)
+        if locid not in summaries:
+            pass
+        elif fmt == 'text':
+            summary = summaries[locid]
+            printLocationSummary(loc['name'], summary['temps'], summary['tranges'], summary['spread'], summary['diffs'], summary['humidity'], summary['cloud'], out)
+        else:
+            writeReportSummary(writer, state['obs_range'], [loc], summaries)
+    else:
+        # all locations, from each location's (cached) summary
+        if fmt == 'text':
+            out.write(getWatchReport(state, 'range', None, fmt))
+        for each in state['locations']:
+            out.write(getWatchReport(state, kind, each, fmt, header=False))
+    return out.getvalue()
+
+
+# get a report from the cache, or render (see renderWatchReport()) and
+# cache it
+def getWatchReport(state, kind, loc, fmt, header=True):
+    key = (kind, loc['id'] if loc is not None else None, fmt, header)
+    report = cacheGet(state['cache'], key)
+    if report is None:
+        report = renderWatchReport(state, kind, loc, fmt, header)
+        cachePut(state['cache'], key, report)
+    return report
+
+
+class WatchRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        state = self.server.state
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        fmt = query.get('format', ['text'])[0]
+        station = query.get('station', [None])[0]
+        path = url.path.rstrip('/')
+        if path == '/stations':
+            body = ''.join("{} {}\n".format(loc['id'], loc['name']) for loc in state['locations'])
+            return self.sendReport(200, body, 'text')
+        if path not in ('/summary', '/daily') or fmt not in REPORT_FORMATS:
+            return self.sendReport(404, "Unknown report\n", 'text')
+        if state['obs_range'] is None or state['obs_range']['first'] is None:
+            # nothing ingested yet (or the first files couldn't be)
+            return self.sendReport(503, "No observations yet\n", 'text')
+        loc = None
+        if station is not None:
+            loc = findLocation(state['locations'], station)
+            if loc is None:
+                return self.sendReport(404, "Unknown station {}\n".format(station), 'text')
+        kind = path[1:]
+        body = getWatchReport(state, kind, loc, fmt)
+        if kind == 'summary' and loc is not None and fmt == 'text':
+            body = getWatchReport(state, 'range', None, fmt) + body
+        self.sendReport(200, body, fmt)
+
+    def sendReport(self, status, body, fmt):
+        content = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', WATCH_CONTENT_TYPES[fmt])
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    # unix socket clients have no address
+    def address_string(self):
+        return str(self.client_address[0]) if self.client_address else 'local'
+
+    def log_message(self, format, *args):
+        dstr = "{} {}".format(self.address_string(), format % args)
+        logging.debug(dstr)
+
+
+class WatchUnixServer(socketserver.UnixStreamServer):
+    # as for http.server.HTTPServer, which expects a host and port
+    def server_bind(self):
+        socketserver.UnixStreamServer.server_bind(self)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+
+def watchMain(argv):
+    debug = 0
+    jobs = 1
+    interval = WATCH_INTERVAL
+    port = WATCH_PORT
+    socket_path = None
+    dbfile = None
+    storage = None
+    paramstr = "watch [-h] [-d] [-j jobs] [-i interval] [-p port | -u socket] [--db dbfile] [--storage fast-ephemeral|durable|low-memory] directory"
+    usagestr = "Usage: {} {}".format(sys.argv[0], paramstr)
+
+    try:
+        options, remainder = getopt.gnu_getopt(argv[2:], "hdj:i:p:u:", ["db=", "storage="])
+    except getopt.GetoptError:
+        print(usagestr, file=sys.stderr)
+        sys.exit(2)
+
+    for opt, arg in options:
+        if opt == '-h':
+            print(__doc__, file=sys.stderr)
+            sys.exit()
+        elif opt == '-d':
+            debug = 1
+        elif opt == '-j':
+            jobs = getIntOption(arg, usagestr)
+        elif opt == '-i':
+            try:
+                interval = float(arg)
+            except ValueError:
+                interval = 0
+            if not 0 < interval < float('inf'):
+                print(usagestr, file=sys.stderr)
+                sys.exit(2)
+        elif opt == '-p':
+            port = getIntOption(arg, usagestr, 1, 65535)
+        elif opt == '-u':
+            socket_path = arg
+        elif opt == '--db':
+            dbfile = arg
+        elif opt == '--storage':
+            if arg not in STORAGE_PROFILES:
+                print(usagestr, file=sys.stderr)
+                sys.exit(2)
+            storage = arg
+        else:
+            assert False, "unhandled option"
+
+    if debug>0:
+        logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.DEBUG)
+    else:
+        logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.WARNING)
+
+    if len(remainder) != 1 or not os.path.isdir(remainder[0]):
+        print(usagestr, file=sys.stderr)
+        sys.exit(2)
+
+    # without a database file, observations are kept in a temporary database
+    conn = sqlite3.connect(dbfile or '')
+    applyStorageProfile(conn, storage)
+    conn.row_factory = sqlite3.Row
+    dbc = conn.cursor()
+    initDB(dbc, True)
+    state = {
+            'dir': remainder[0],
+            'jobs': jobs,
+            'conn': conn,
+            'dbc': dbc,
+            'obs_range': None,
+            'locations': [],
+            'failed': {},
+            'cache': {
+                'entries': collections.OrderedDict(),
+                'size': WATCH_CACHE_SIZE
+            }
+    }
+    watchIngest(state)
+
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        server = WatchUnixServer(socket_path, WatchRequestHandler)
+        print("serving reports on {}".format(socket_path), file=sys.stderr)
+    else:
+        server = http.server.HTTPServer(('127.0.0.1', port), WatchRequestHandler)
+        print("serving reports on http://127.0.0.1:{}/".format(server.server_port), file=sys.stderr)
+    server.state = state
+
+    # on being stopped (eg. by a service manager) clean up as per ctrl-c
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    # requests are handled between polls of the directory, in this thread,
+    # so there's only one database connection
+    next_poll = time.monotonic() + interval
+    try:
+        while True:
+            server.timeout = max(0, next_poll - time.monotonic())
+            server.handle_request()
+            if time.monotonic() >= next_poll:
+                watchIngest(state)
+                next_poll = time.monotonic() + interval
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if socket_path:
+            os.unlink(socket_path)
+        conn.close()
+
+
+
+
+##############################################################
+# sharded storage, see the --shards option and the partial and merge commands
+# observations are kept in a directory of databases (shards), one for each
+# station and year by default (see SHARD_KEYS), each as for --db, with a
+# manifest (SHARD_MANIFEST) of the shards' locations and dates, and of the
+# files ingested and each location's watermark
+# observations are sharded by report date, so all of a date's observations
+# (including the evening before's overnight ones) are in the same shard,
+# and only the shards with new observations are opened when ingesting
+# reports attach each shard needed (going by the manifest) to an in-memory
+# database in turn, calculate its partial results (see calcShardPartial())
+# and merge them (see mergeShardPartials()), partial results can also be
+# calculated elsewhere (eg. on other hosts, with the partial command) and
+# merged afterwards (with the merge command)
+# day to day diffs across shards are matched by location name (as in
+# daytoday_avgt_diffs), so names are taken to be unique to locations
+
+SHARD_MANIFEST = 'manifest.json'
+SHARD_MANIFEST_VERSION = 1
+SHARD_SUFFIX = '.sqlite'
+
+# shard keys, by name, as functions of location id and report date
+# (YYYY-MM-DD), the first is the default
+SHARD_KEYS = collections.OrderedDict([
+        ('station-year', lambda locid, date: '{}-{}'.format(locid, date[:4])),
+        ('station', lambda locid, date: str(locid)),
+        ('year', lambda locid, date: date[:4]),
+        ('station-month', lambda locid, date: '{}-{}'.format(locid, date[:7]))
+])
+
+# shards kept open while ingesting, the least recently used are closed first
+SHARD_OPEN_MAX = 16
+
+# version of partial results, see calcShardPartial()
+SHARD_PARTIAL_VERSION = 1
+
+# fields of the day by day rows of partial results, as from
+# getDailyObservations()
+SHARD_DAILY_FIELDS = ('date', 'tod', 'name', 'ava', 'tdiff', 'tspread', 'avr')
+
+
+# read the manifest of the shards in sharddir, a new (empty) manifest if
+# there isn't one yet, with shards keyed by key (default SHARD_KEYS' first)
+# returns manifest dict, or None if it has shards keyed by another key
+def readShardManifest(sharddir, key=None):
+    try:
+        with open(os.path.join(sharddir, SHARD_MANIFEST), 'r') as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        manifest = {
+                'version': SHARD_MANIFEST_VERSION,
+                'key': key or next(iter(SHARD_KEYS)),
+                'shards': {},
+                'files': {},
+                'watermarks': {}
+        }
+    if key is not None and manifest['key'] != key:
+        return None
+    return manifest
+
+
+# save the manifest of the shards in sharddir
+def writeShardManifest(sharddir, manifest):
+    writeFileAtomically(os.path.join(sharddir, SHARD_MANIFEST), json.dumps(manifest, indent=1, sort_keys=True).encode('utf-8'))
+
+
+# open a shard's database (creating it if needed) for ingesting, keeping
+# it in shards (an OrderedDict of name -> connection and cursor), if there
+# are already SHARD_OPEN_MAX open the least recently used is closed
+# returns cursor of the shard's connection
+def openShard(sharddir, manifest, shards, name, storage=None):
+    if name in shards:
+        shards.move_to_end(name)
+        return shards[name][1]
+    if len(shards) >= SHARD_OPEN_MAX:
+        oldest = next(iter(shards))
+        closeShard(manifest, oldest, *shards.pop(oldest))
+    conn = sqlite3.connect(os.path.join(sharddir, name + SHARD_SUFFIX))
+    applyStorageProfile(conn, storage)
+    dbc = conn.cursor()
+    initDB(dbc, True)
+    dbc.execute("BEGIN")
+    shards[name] = (conn, dbc)
+    return dbc
+
+
+# update the sketches and rollups of a shard opened by openShard(), and
+# its entry in the manifest, then commit and close it
+def closeShard(manifest, name, conn, dbc):
+    updateTODSketches(dbc)
+    updateRollups(dbc)
+    conn.commit()
+    dbc.execute("""
+        SELECT location_id, name, MIN(date), MAX(date), COUNT(*)
+        FROM observation
+        INNER JOIN location ON location.id = observation.location_id
+        GROUP BY location_id
+        ORDER BY location_id
+        """)
+    locations = [list(row) for row in dbc.fetchall()]
+    manifest['shards'][name] = {
+            'file': name + SHARD_SUFFIX,
+            'locations': locations,
+            'first': min((loc[2] for loc in locations), default=None),
+            'last': max((loc[3] for loc in locations), default=None),
+            'observations': sum(loc[4] for loc in locations)
+    }
+    conn.close()
+    dstr = "closed shard {} with {} observations".format(name, manifest['shards'][name]['observations'])
+    logging.debug(dstr)
+
+
+# read json files (and archives) and add their observations to the shards
+# in sharddir, as ingestFiles() does for a persistent database, with files
+# and watermarks recorded in the manifest rather than the database
+# each file's observations are split by shard key, only the shards with
+# new observations are opened (and created as needed), and each shard is
+# committed once it's no longer needed, the manifest is saved last, so
+# if interrupted files are ingested again (and their observations replace
+# the same ones)
+# returns the number of files ingested
+def ingestShardFiles(sharddir, manifest, filenames, jobs=1, storage=None):
+    shardKey = SHARD_KEYS[manifest['key']]
+    files = manifest['files']
+    # taken once, so files within a run can be in any order
+    watermarks = {int(locid): wm for locid, wm in manifest['watermarks'].items()}
+    known_hashes = {fdetails['sha256'] for fdetails in files.values()}
+    fdetails = {}
+    changed = []
+    for fn in filenames:
+        fdetails[fn] = getFileDetails(fn)
+        recorded = files.get(fdetails[fn]['path'])
+        if recorded is not None and recorded['size'] == fdetails[fn]['size'] and recorded['mtime'] == fdetails[fn]['mtime']:
+            dstr = "skipping file {}, already ingested".format(fn)
+            logging.info(dstr)
+        else:
+            changed.append(fn)
+
+    os.makedirs(sharddir, exist_ok=True)
+    shards = collections.OrderedDict()
+    nfiles = 0
+    try:
+        for fn, parsed in parseFiles(changed, watermarks, known_hashes, jobs):
+            fdetails[fn]['sha256'] = parsed['sha256']
+            path = fdetails[fn].pop('path')
+            files[path] = fdetails[fn]
+            # also catches duplicates within this run
+            if parsed['duplicate'] or parsed['sha256'] in known_hashes:
+                dstr = "skipping file {}, content already ingested".format(fn)
+                logging.info(dstr)
+                continue
+            known_hashes.add(parsed['sha256'])
+            for prepared in getPreparedObservations(parsed):
+                shard_rows = collections.defaultdict(list)
+                for row in prepared['rows']:
+                    shard_rows[shardKey(row[0], row[14])].append(row)
+                for name, rows in shard_rows.items():
+                    storeObservations(openShard(sharddir, manifest, shards, name, storage), dict(prepared, rows=rows))
+                locid = str(prepared['id'])
+                manifest['watermarks'][locid] = max(manifest['watermarks'].get(locid, ''), prepared['latest'])
+            nfiles += 1
+    finally:
+        while shards:
+            name, (conn, dbc) = shards.popitem(last=False)
+            closeShard(manifest, name, conn, dbc)
+    writeShardManifest(sharddir, manifest)
+    dstr = "ingested {} of {} files into {} shards".format(nfiles, len(changed), len(manifest['shards']))
+    logging.info(dstr)
+    return nfiles
+
+
+# select the shards in the manifest with observations selected by filters
+# (all shards if None), in order of their first dates
+# returns tuple of list of shard names, and the last date of the selected
+# observations, which is the last date of every shard's partial results
+def selectShards(manifest, filters=None):
+    prev_date = None
+    if filters is not None and filters['first'] is not None:
+        prev_date = '{}-{}-{}'.format(filters['first'][:4], filters['first'][4:6], filters['first'][6:8])
+    names = []
+    max_date = None
+    for name, shard in sorted(manifest['shards'].items(), key=lambda item: (item[1]['first'] or '', item[0])):
+        selected = False
+        for locid, locname, first, last, nobs in shard['locations']:
+            if filters is not None:
+                if not isStationSelected(filters, locid, locname):
+                    continue
+                if prev_date is not None and last < prev_date:
+                    continue
+                if filters['to'] is not None:
+                    if first > filters['to']:
+                        continue
+                    last = min(last, filters['to'])
+            selected = True
+            max_date = last if max_date is None else max(max_date, last)
+        if selected:
+            names.append(name)
+    dstr = "selected {} of {} shards, to {}".format(len(names), len(manifest['shards']), max_date)
+    logging.info(dstr)
+    return names, max_date
+
+
+# calculate a shard's partial results for the report, of the observations
+# selected by filters (all if None) up to max_date (the last date of all
+# the shards, see selectShards())
+# the shard is attached, read only, to an in-memory database, with
+# temporary views of it taking the place of observation, location and the
+# views of daily stats, as for createFilteredViews()
+# if daily, the day by day rows (as from getDailyObservations()) are included
+# returns a dict (which can be saved as json) of the shard name, date range,
+# locations, sums of observations (temps) and of daily stats (days) for
+# each location and time of day, the first and last daily average temps
+# for each location and time of day (ends), for the day to day diffs
+# between shards, and the day by day rows
+def calcShardPartial(sharddir, name, filters=None, max_date=None, daily=True):
+    conn = sqlite3.connect(':memory:', uri=True)
+    dbc = conn.cursor()
+    uri = 'file:{}?mode=ro'.format(urllib.request.pathname2url(os.path.abspath(os.path.join(sharddir, name + SHARD_SUFFIX))))
+    dbc.execute("ATTACH DATABASE ? AS shard", (uri,))
+    obs_conditions = '1'
+    if filters is not None:
+        obs_conditions = getFilterConditions(dbc, filters, 'shard')[0]
+    view_str = """
+    CREATE TEMP VIEW observation AS SELECT * FROM shard.observation WHERE {obs};
+    CREATE TEMP VIEW location AS SELECT * FROM shard.location;
+    CREATE TEMP VIEW datenorm_observation AS {datenorm};
+    CREATE TEMP VIEW daily_tod_stats AS {daily};
+    """.format(obs=obs_conditions, datenorm=dateNormalisedSelect(max_date=max_date), daily=dailyTODStatsSelect())
+    dstr = "calcShardPartial() creating views with: {}".format(view_str)
+    logging.debug(dstr)
+    dbc.executescript(view_str)
+    calcDayToDayTODAvgTempDiffs(dbc, temp=True)
+
+    obs_range = getObservationDateRange(dbc)
+    # sums rather than averages, summed in the same order as for
+    # calcLocationSummaries()
+    dbc.execute("""
+    SELECT location_id, {} AS tod,
+           COUNT(air_temp), SUM(air_temp),
+           COUNT(CASE WHEN relative_humidity >= 0 THEN 1 END),
+           SUM(CASE WHEN relative_humidity >= 0 THEN relative_humidity END),
+           COUNT(CASE WHEN cloud_oktas >= 0 THEN 1 END),
+           SUM(CASE WHEN cloud_oktas >= 0 THEN cloud_oktas END)
+    FROM (
+        SELECT location_id, bucket, date, air_temp, relative_humidity, cloud_oktas
+        FROM datenorm_observation
+        WHERE bucket IS NOT NULL
+        ORDER BY location_id, bucket, date, time
+    )
+    GROUP BY location_id, bucket
+    """.format(buildBucketTODExpr()))
+    temps = [list(row) for row in dbc.fetchall()]
+    dbc.execute("""
+    SELECT daily_tod_stats.location_id, daily_tod_stats.tod,
+           MIN(ava), MAX(ava),
+           COUNT(tspread), SUM(tspread),
+           COUNT(tdiff), SUM(ABS(tdiff))
+    FROM daily_tod_stats
+    NATURAL LEFT OUTER JOIN daytoday_avgt_diffs
+    GROUP BY daily_tod_stats.location_id, daily_tod_stats.tod
+    """)
+    days = [list(row) for row in dbc.fetchall()]
+    locids = {row[0] for row in temps + days}
+    dbc.execute("SELECT id, name FROM location ORDER BY id")
+    locations = [list(row) for row in dbc.fetchall() if row[0] in locids]
+
+    rows = []
+    ends = collections.OrderedDict()
+    for row in getDailyObservations(dbc):
+        key = (row[2], row[1])
+        if key not in ends:
+            ends[key] = [row[2], row[1], row[0], row[3], row[0], row[3]]
+        else:
+            ends[key][4:] = [row[0], row[3]]
+        if daily:
+            rows.append(list(row))
+    conn.close()
+
+    partial = {
+            'version': SHARD_PARTIAL_VERSION,
+            'shard': name,
+            'max_date': max_date,
+            'first': obs_range['first'],
+            'last': obs_range['last'],
+            'locations': locations,
+            'temps': temps,
+            'days': days,
+            'ends': list(ends.values()),
+            'daily': rows if daily else None
+    }
+    dstr = "calculated partial results of shard {}, {} locations and {} daily rows".format(name, len(locations), len(rows))
+    logging.debug(dstr)
+    return partial
+
 
-    #dbc.execute(".tables")
-    #rows = dbc.fetchall()
-    #for row in rows:
-    #    logging.debug(row)
+# calculate the partial results of shards (list of names) with
+# calcShardPartial(), with more than one job, in a pool of threads, each
+# attaching its own shards (sqlite releases the GIL while running queries)
+# returns list of partial results, in order of names
+def calcShardPartials(sharddir, names, filters=None, max_date=None, daily=True, jobs=1):
+    def calcPartial(name):
+        return calcShardPartial(sharddir, name, filters, max_date, daily)
+    if jobs > 1 and len(names) > 1:
+        dstr = "calculating partial results of {} shards with {} threads".format(len(names), jobs)
+        logging.info(dstr)
+        with multiprocessing.pool.ThreadPool(jobs) as pool:
+            return pool.map(calcPartial, names)
+    return [calcPartial(name) for name in names]
+
+
+# sum a partial result's sums into totals, None (no values) counting as 0
+def addShardSums(totals, sums):
+    return [(total or 0) + (value or 0) for total, value in zip(totals, sums)]
+
+
+# merge the partial results of shards (from calcShardPartial(), each for the
+# same max_date) into the report, the date range, locations and summaries
+# are as from getObservationDateRange(), getLocations() and
+# calcLocationSummaries(), and the day by day rows are merged in order
+# (with the diffs between the last date of a shard and the first of the
+# next added)
+# returns tuple of day by day rows (a generator of dicts, None if the
+# partial results don't have them), date range, locations and summaries
+def mergeShardPartials(partials):
+    partials = sorted(partials, key=lambda partial: (partial['first'] or '', partial['shard']))
+    names = {}
+    temps = {}
+    days = {}
+    prev_ava = {}
+    fills = [{} for partial in partials]
+    for i, partial in enumerate(partials):
+        locids = {}
+        for locid, name in partial['locations']:
+            names.setdefault(locid, name)
+            locids[name] = locid
+        for row in partial['temps']:
+            key = (row[0], row[1])
+            temps[key] = addShardSums(temps.get(key, [0] * 6), row[2:])
+        for row in partial['days']:
+            key = (row[0], row[1])
+            if key in days:
+                total = days[key]
+                days[key] = [min(total[0], row[2]), max(total[1], row[3])] + addShardSums(total[2:], row[4:])
+            else:
+                days[key] = row[2:]
+        # diffs from the last daily average of the previous shard
+        for name, tod, first_date, first_ava, last_date, last_ava in partial['ends']:
+            if (name, tod) in prev_ava:
+                tdiff = first_ava - prev_ava[(name, tod)]
+                fills[i][(first_date, tod, name)] = tdiff
+                total = days[(locids[name], tod)]
+                total[4:] = addShardSums(total[4:], [1, abs(tdiff)])
+            prev_ava[(name, tod)] = last_ava
+
+    def ratio(total, n):
+        return total / n if n else None
+
+    summaries = {}
+    for key in sorted(set(temps) | set(days)):
+        locid, tod = key
+        summary = summaries.setdefault(locid, {
+                'temps': {},
+                'tranges': {},
+                'spread': {},
+                'diffs': {},
+                'humidity': {},
+                'cloud': {}
+        })
+        tod = TOD_KEYS[tod]
+        if key in temps:
+            nt, st, nr, sr, nc, sc = temps[key]
+            summary['temps'][tod] = ratio(st, nt)
+            summary['humidity'][tod] = ratio(sr, nr)
+            summary['cloud'][tod] = int(sc / nc) if nc else -1
+        if key in days:
+            min_ava, max_ava, ns, ss, nd, sd = days[key]
+            summary['tranges'][tod] = {
+                    'min': min_ava,
+                    'max': max_ava
+            }
+            summary['spread'][tod] = ratio(ss, ns)
+            summary['diffs'][tod] = ratio(sd, nd)
+    locations = [{'id': locid, 'name': names[locid]} for locid in sorted(summaries)]
+
+    firsts = [partial['first'] for partial in partials if partial['first'] is not None]
+    lasts = [partial['last'] for partial in partials if partial['last'] is not None]
+    obs_range = {
+            'first': min(firsts, default=None),
+            'last': max(lasts, default=None),
+            'days': None
+    }
+    if firsts:
+        obs_range['days'] = (datetime.date.fromisoformat(obs_range['last']) - datetime.date.fromisoformat(obs_range['first'])).days
+
+    def dailyRows(i, partial):
+        for row in partial['daily']:
+            if fills[i]:
+                tdiff = fills[i].get((row[0], row[1], row[2]))
+                if tdiff is not None:
+                    row = row[:4] + [tdiff] + row[5:]
+            yield dict(zip(SHARD_DAILY_FIELDS, row))
+
+    daily = None
+    if all(partial['daily'] is not None for partial in partials):
+        daily = heapq.merge(*[dailyRows(i, partial) for i, partial in enumerate(partials)],
+                key=lambda row: (row['date'], row['tod'], row['name']))
+    return daily, obs_range, locations, summaries
+
+
+# write the report merged from partial results (see mergeShardPartials())
+# with writer (from openReportWriter()), without the day by day rows if
+# summary_only
+def writeShardReport(writer, partials, summary_only=False):
+    daily, obs_range, locations, summaries = mergeShardPartials(partials)
+    if not summary_only and daily is not None:
+        with profilePhase('daily') as phase:
+            phase['rows'] = writeDailyObservations(writer, daily)
+    with profilePhase('print'):
+        writeReportSummary(writer, obs_range, locations, summaries)
+
+
+def partialMain(argv):
+    debug = 0
+    jobs = 1
+    outfile = None
+    summary_only = False
+    from_date = None
+    to_date = None
+    stations = []
+    paramstr = "partial [-h] [-d] [-s] [-j jobs] [-o file] [--from date] [--to date] [--station station] sharddir [shard ...]"
+    usagestr = "Usage: {} {}".format(sys.argv[0], paramstr)
+
+    try:
+        options, remainder = getopt.gnu_getopt(argv[2:], "hdsj:o:", ["from=", "to=", "station="])
+    except getopt.GetoptError:
+        print(usagestr, file=sys.stderr)
+        sys.exit(2)
+
+    for opt, arg in options:
+        if opt == '-h':
+            print(__doc__, file=sys.stderr)
+            sys.exit()
+        elif opt == '-d':
+            debug = 1
+        elif opt == '-s':
+            summary_only = True
+        elif opt == '-j':
+            jobs = getIntOption(arg, usagestr)
+        elif opt == '-o':
+            outfile = arg
+        elif opt in ('--from', '--to'):
+            try:
+                datetime.date.fromisoformat(arg)
+            except ValueError:
+                print(usagestr, file=sys.stderr)
+                sys.exit(2)
+            if opt == '--from':
+                from_date = arg
+            else:
+                to_date = arg
+        elif opt == '--station':
+            stations.extend(station for station in arg.split(',') if station)
+        else:
+            assert False, "unhandled option"
+
+    if debug>0:
+        logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.DEBUG)
+    else:
+        logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.WARNING)
+
+    if len(remainder) < 1:
+        print(usagestr, file=sys.stderr)
+        sys.exit(2)
+
+    sharddir = remainder[0]
+    manifest = readShardManifest(sharddir)
+    filters = None
+    if from_date or to_date or stations:
+        try:
+            station_table = readStationTable(DEFAULT_STATION_TABLE)
+        except OSError:
+            station_table = None
+        filters = makeObservationFilters(from_date, to_date, stations, station_table)
+    # the last date is of all selected shards, whichever are calculated here
+    names, max_date = selectShards(manifest, filters)
+    if len(remainder) > 1:
+        unknown = [name for name in remainder[1:] if name not in manifest['shards']]
+        if unknown:
+            print("Unknown shards: {}".format(', '.join(unknown)), file=sys.stderr)
+            sys.exit(2)
+        names = [name for name in names if name in remainder[1:]]
+
+    partials = calcShardPartials(sharddir, names, filters, max_date, not summary_only, jobs)
+    content = json.dumps({'partials': partials}).encode('utf-8')
+    if outfile:
+        writeFileAtomically(outfile, content)
+    else:
+        sys.stdout.buffer.write(content + b'\n')
+
+
+def mergeMain(argv):
+    debug = 0
+    summary_only = False
+    report_format = 'text'
+    paramstr = "merge [-h] [-d] [-s] [--format text|csv|jsonl] partialfile1 [partialfile 2 ...]"
+    usagestr = "Usage: {} {}".format(sys.argv[0], paramstr)
+
+    try:
+        options, remainder = getopt.gnu_getopt(argv[2:], "hds", ["format="])
+    except getopt.GetoptError:
+        print(usagestr, file=sys.stderr)
+        sys.exit(2)
+
+    for opt, arg in options:
+        if opt == '-h':
+            print(__doc__, file=sys.stderr)
+            sys.exit()
+        elif opt == '-d':
+            debug = 1
+        elif opt == '-s':
+            summary_only = True
+        elif opt == '--format':
+            if arg not in REPORT_FORMATS:
+                print(usagestr, file=sys.stderr)
+                sys.exit(2)
+            report_format = arg
+        else:
+            assert False, "unhandled option"
+
+    if debug>0:
+        logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.DEBUG)
+    else:
+        logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.WARNING)
+
+    if len(remainder) < 1:
+        print(usagestr, file=sys.stderr)
+        sys.exit(2)
+
+    partials = []
+    for fn in remainder:
+        with open(fn, 'rb') as f:
+            partials.extend(json.load(f)['partials'])
+    if len({partial['max_date'] for partial in partials}) > 1:
+        print("Partial results are of different dates, calculate them from the same shards and options", file=sys.stderr)
+        sys.exit(2)
+    if not summary_only and any(partial['daily'] is None for partial in partials):
+        print("Partial results were calculated with -s, so merge them with -s", file=sys.stderr)
+        sys.exit(2)
+
+    with openReportOutput() as out:
+        writer = openReportWriter(report_format, out)
+        writeShardReport(writer, partials, summary_only)
+
+
+
+
+##############################################################
+# result cache, of rendered reports, see --no-cache
+# reports are cached in files named by a hash of everything that affects
+# them: the contents of the input files (in order), the period of day
+# boundaries, the report options, this script and the sqlite version
+# (which affects how averages are summed)
+# warnings logged while making a report (eg. of invalid observations) are
+# kept with it, and logged again when the cached report is used
+# entries not used for RESULT_CACHE_MAX_AGE are evicted, as are the least
+# recently used if the cache is larger than RESULT_CACHE_MAX_BYTES
+
+RESULT_CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'bomreader')
+RESULT_CACHE_MAX_AGE = 7 * 24 * 3600
+RESULT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+RESULT_CACHE_SUFFIX = '.report'
+RESULT_CACHE_WARNINGS_SUFFIX = '.warnings'
+
+
+# hash the contents of a file, returns the hex digest
+def hashFile(fn):
+    digest = hashlib.sha256()
+    with open(fn, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# get the result cache key for a report of filenames, with options (a dict
+# of the report options that affect its output)
+# returns the hex digest key
+def getResultCacheKey(filenames, options):
+    key = {
+            'files': [hashFile(fn) for fn in filenames],
+            'periods': [MORNING_HOUR_START, MORNING_HOUR_END, DAYTIME_HOUR_START, DAYTIME_HOUR_END,
+                EVENING_HOUR_START, EVENING_HOUR_END, OVERNIGHT_HOUR_START, OVERNIGHT_HOUR_END],
+            'options': options,
+            'script': hashFile(os.path.abspath(__file__)),
+            'sqlite': sqlite3.sqlite_version
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+# copy a cached report to stdout, if there is one for the key, after
+# copying the warnings logged while making it to stderr
+# returns True if the report was cached
+def writeCachedReport(cachedir, key):
+    fn = os.path.join(cachedir, key + RESULT_CACHE_SUFFIX)
+    try:
+        f = open(fn, 'rb')
+    except OSError:
+        return False
+    with f:
+        try:
+            with open(os.path.join(cachedir, key + RESULT_CACHE_WARNINGS_SUFFIX), 'rb') as wf:
+                sys.stderr.flush()
+                shutil.copyfileobj(wf, sys.stderr.buffer)
+                sys.stderr.buffer.flush()
+        except FileNotFoundError:
+            pass
+        sys.stdout.flush()
+        shutil.copyfileobj(f, sys.stdout.buffer)
+        sys.stdout.buffer.flush()
+    # mark as recently used, for eviction
+    os.utime(fn)
+    dstr = "report from result cache {}".format(fn)
+    logging.info(dstr)
+    return True
+
+
+# a report output writing to stdout and a file in the cache at once
+class TeeOutput:
+
+    def __init__(self, *outs):
+        self.outs = outs
+
+    def write(self, s):
+        for out in self.outs:
+            out.write(s)
+        return len(s)
+
+    def flush(self):
+        for out in self.outs:
+            out.flush()
+
+
+# write the report to stdout as per openReportOutput(), and to a file in the
+# cache, which is kept once complete (or dropped if not completed)
+# warnings logged meanwhile (including by parse workers, which share the
+# log file) are kept in the cache with it
+# if key is None, the report is only written to stdout
+@contextlib.contextmanager
+def cachedReportOutput(cachedir, key):
+    if key is None:
+        with openReportOutput() as out:
+            yield out
+        return
+    os.makedirs(cachedir, exist_ok=True)
+    fd, tmpfn = tempfile.mkstemp(dir=cachedir, suffix='.tmp')
+    wfd, tmpwfn = tempfile.mkstemp(dir=cachedir, suffix='.tmp')
+    os.close(wfd)
+    handler = logging.FileHandler(tmpwfn, encoding='utf-8')
+    handler.setLevel(logging.WARNING)
+    handler.setFormatter(logging.Formatter('%(levelname)s:%(message)s'))
+    logging.getLogger().addHandler(handler)
+    try:
+        with openReportOutput() as stdout, open(fd, 'w', buffering=REPORT_BUFFER_SIZE,
+                encoding=sys.stdout.encoding, newline='') as f:
+            yield TeeOutput(stdout, f)
+    except BaseException:
+        logging.getLogger().removeHandler(handler)
+        handler.close()
+        os.unlink(tmpfn)
+        os.unlink(tmpwfn)
+        raise
+    logging.getLogger().removeHandler(handler)
+    handler.close()
+    wfn = os.path.join(cachedir, key + RESULT_CACHE_WARNINGS_SUFFIX)
+    if os.path.getsize(tmpwfn) > 0:
+        os.replace(tmpwfn, wfn)
+    else:
+        os.unlink(tmpwfn)
+        removeCacheFile(wfn)
+    os.replace(tmpfn, os.path.join(cachedir, key + RESULT_CACHE_SUFFIX))
+    evictResultCache(cachedir)
+
+
+# remove a file from the cache, if it's there
+def removeCacheFile(fn):
+    try:
+        os.unlink(fn)
+    except FileNotFoundError:
+        pass
+
+
+# evict reports not used for max_age seconds, then the least recently
+# used reports until the cache is no larger than max_bytes
+def evictResultCache(cachedir, max_age=RESULT_CACHE_MAX_AGE, max_bytes=RESULT_CACHE_MAX_BYTES):
+    entries = []
+    oldest = time.time() - max_age
+    for entry in os.scandir(cachedir):
+        if not entry.name.endswith(RESULT_CACHE_SUFFIX):
+            continue
+        st = entry.stat()
+        if st.st_mtime < oldest:
+            os.unlink(entry.path)
+            removeCacheFile(entry.path[:-len(RESULT_CACHE_SUFFIX)] + RESULT_CACHE_WARNINGS_SUFFIX)
+        else:
+            entries.append((st.st_mtime, st.st_size, entry.path))
+    total = sum(size for mtime, size, path in entries)
+    for mtime, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        os.unlink(path)
+        removeCacheFile(path[:-len(RESULT_CACHE_SUFFIX)] + RESULT_CACHE_WARNINGS_SUFFIX)
+        total -= size
+        dstr = "evicted {} from result cache".format(path)
+        logging.debug(dstr)
+
+
+
+
+##############################################################
+# profiling, see --profile
+# phases of processing are timed, and when enabled, every query run
+# through a ProfilingCursor is timed (including fetching its results)
+
+_profile = {
+        'enabled': False,
+        'phases': [],
+        'queries': {}
+}
+
+# number of slowest queries to report, with their query plans
+PROFILE_TOP_QUERIES = 10
+
+
+# record time spent on (and rows from) a query, for the profile report
+def recordQuery(sql, seconds, rows=0, parameters=None):
+    key = ' '.join(sql.split())
+    if key not in _profile['queries']:
+        _profile['queries'][key] = {
+                'sql': sql,
+                'parameters': parameters,
+                'calls': 0,
+                'seconds': 0.0,
+                'rows': 0
+        }
+    stats = _profile['queries'][key]
+    stats['calls'] += 1
+    stats['seconds'] += seconds
+    stats['rows'] += rows
+
+
+# a cursor that records execution and fetch times of each query
+class ProfilingCursor(sqlite3.Cursor):
+
+    def execute(self, sql, parameters=()):
+        self._sql = sql
+        start = time.perf_counter()
+        super().execute(sql, parameters)
+        recordQuery(sql, time.perf_counter() - start, max(self.rowcount, 0), parameters)
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        self._sql = sql
+        start = time.perf_counter()
+        super().executemany(sql, seq_of_parameters)
+        recordQuery(sql, time.perf_counter() - start, max(self.rowcount, 0))
+        return self
+
+    def executescript(self, sql_script):
+        self._sql = None
+        start = time.perf_counter()
+        super().executescript(sql_script)
+        recordQuery(sql_script, time.perf_counter() - start)
+        return self
+
+    # time spent fetching is added to the query that produced the rows
+    def _recordFetch(self, start, nrows):
+        if getattr(self, '_sql', None) is not None:
+            stats = _profile['queries'][' '.join(self._sql.split())]
+            stats['seconds'] += time.perf_counter() - start
+            stats['rows'] += nrows
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self._recordFetch(start, 0 if row is None else 1)
+        return row
 
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._recordFetch(start, len(rows))
+        return rows
 
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self._recordFetch(start, len(rows))
+        return rows
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._recordFetch(start, 0)
+            raise
+        self._recordFetch(start, 1)
+        return row
+
+
+# time a phase of processing, recorded for the profile report if enabled
+# the caller can set the number of rows the phase produced, eg:
+#     with profilePhase('daily') as phase:
+#         rows = getDailyObservations(dbc)
+#         phase['rows'] = len(rows)
+@contextlib.contextmanager
+def profilePhase(name):
+    phase = {
+            'name': name,
+            'seconds': 0.0,
+            'rows': None
+    }
+    start = time.perf_counter()
+    try:
+        yield phase
+    finally:
+        phase['seconds'] = time.perf_counter() - start
+        if _profile['enabled']:
+            _profile['phases'].append(phase)
+
+
+# get the query plans of the slowest queries, for the profile report
+# only select queries are explained, with a plain cursor so not profiled
+# returns list of query stats dicts, each with a list of plan lines
+def explainSlowestQueries(conn, top=PROFILE_TOP_QUERIES):
+    queries = sorted(_profile['queries'].values(), key=lambda q: q['seconds'], reverse=True)[:top]
+    dbc = conn.cursor()
+    for query in queries:
+        query['plan'] = []
+        sql = query['sql'].strip()
+        if not sql.upper().startswith(('SELECT', 'WITH')):
+            continue
+        try:
+            dbc.execute("EXPLAIN QUERY PLAN " + sql, query['parameters'] or ())
+            # indent plan lines by their depth in the plan tree
+            depths = {0: 0}
+            for row in dbc.fetchall():
+                depths[row[0]] = depths.get(row[1], 0) + 1
+                query['plan'].append('  '*(depths[row[0]]-1) + row[3])
+        except sqlite3.Error as e:
+            query['plan'] = ["(unable to explain: {})".format(e)]
+    return queries
+
+
+# print the profile report to stderr: phase times, and slowest queries
+# with their query plans (queries are from explainSlowestQueries())
+def printProfile(queries, settings=None):
+    print("Profile:", file=sys.stderr)
+    if settings:
+        for key in settings:
+            print("    {}: {}".format(key, settings[key]), file=sys.stderr)
+    total = 0.0
+    for phase in _profile['phases']:
+        total += phase['seconds']
+        ratestr = ''
+        if phase['rows'] is not None:
+            rate = phase['rows'] / phase['seconds'] if phase['seconds'] > 0 else 0
+            ratestr = ", {} rows ({:.0f} rows/s)".format(phase['rows'], rate)
+        print("    phase {}: {:.3f}s{}".format(phase['name'], phase['seconds'], ratestr), file=sys.stderr)
+    print("    total: {:.3f}s".format(total), file=sys.stderr)
+    if queries:
+        print("Slowest queries:", file=sys.stderr)
+    for query in queries:
+        sqlstr = ' '.join(query['sql'].split())
+        if len(sqlstr) > 200:
+            sqlstr = sqlstr[:197] + '...'
+        print("    {:.3f}s, {} calls, {} rows: {}".format(query['seconds'], query['calls'], query['rows'], sqlstr), file=sys.stderr)
+        for line in query.get('plan', []):
+            print("        {}".format(line), file=sys.stderr)
+
+
+# write the profile as json, phases and all queries (slowest first)
+def writeProfileJSON(fn, queries, settings=None):
+    allqueries = sorted(_profile['queries'].values(), key=lambda q: q['seconds'], reverse=True)
+    plans = {id(query): query.get('plan') for query in queries}
+    trace = {
+            'settings': settings or {},
+            'phases': _profile['phases'],
+            'queries': [{
+                'sql': ' '.join(query['sql'].split()),
+                'calls': query['calls'],
+                'seconds': query['seconds'],
+                'rows': query['rows'],
+                'plan': plans.get(id(query))
+            } for query in allqueries]
+    }
+    with open(fn, 'w') as f:
+        json.dump(trace, f, indent=1)
+
+
+
+
+##############################################################
+# columnar (numpy) engine, an in-memory equivalent of the views and
+# queries above, used instead of sqlite with --engine numpy
+# results are calculated in the same order as sqlite would, so that
+# output is identical
+
+# sqlite sums REAL values with Kahan-Babuska-Neumaier compensation from
+# version 3.43, and simply sequentially before that
+SQLITE_HAS_COMPENSATED_SUM = sqlite3.sqlite_version_info >= (3, 43, 0)
+
+# tod values as used in daily_tod_stats, indexed by columnar tod code
+TOD_NAMES = ['0-night', '1-morn', '2-day', '3-eve']
+
+
+# convert a HH:MM interval boundary to minutes since midnight
+def hourToMinutes(hhmm):
+    hours, minutes = hhmm.split(':')
+    return int(hours)*60 + int(minutes)
+
+
+# get the time of day intervals as start and end minutes since midnight
+# observations from start up to (but not including) end are within an
+# interval, as per the BETWEEN comparisons of HH:MM:SS times in queries
+# returns list of (start, end) tuples, indexed by columnar tod code
+def getTODIntervalMinutes():
+    intervals = [
+            (OVERNIGHT_HOUR_START, OVERNIGHT_HOUR_END),
+            (MORNING_HOUR_START, MORNING_HOUR_END),
+            (DAYTIME_HOUR_START, DAYTIME_HOUR_END),
+            (EVENING_HOUR_START, EVENING_HOUR_END)
+    ]
+    return [(hourToMinutes(start), hourToMinutes(end)) for start, end in intervals]
+
+
+# get the index of the first value of each group, in values sorted by keys
+# keys is a list of equal length arrays
+def getGroupStarts(keys):
+    if len(keys[0]) == 0:
+        return np.zeros(0, dtype=np.int64)
+    changed = np.zeros(len(keys[0]), dtype=bool)
+    changed[0] = True
+    for key in keys:
+        changed[1:] |= key[1:] != key[:-1]
+    return np.flatnonzero(changed)
+
+
+# sum values within groups, in the same order and manner as sqlite's SUM
+# (and so AVG) does, so results are identical
+# values are sorted by group, starts are the index of each group's first
+# value (as for numpy reduceat), groups must not be empty
+def sumGroupsAsSqlite(values, starts):
+    counts = np.diff(np.append(starts, len(values)))
+    # longest groups first, so active groups are always a leading slice
+    order = np.argsort(-counts, kind='stable')
+    neg_counts = -counts[order]
+    group_starts = starts[order]
+    sums = np.zeros(len(starts))
+    errs = np.zeros(len(starts))
+    for i in range(int(counts.max()) if len(counts) else 0):
+        nactive = np.searchsorted(neg_counts, -i, side='left')
+        r = values[group_starts[:nactive] + i]
+        s = sums[:nactive]
+        t = s + r
+        if SQLITE_HAS_COMPENSATED_SUM:
+            errs[:nactive] += np.where(np.abs(s) > np.abs(r), (s - t) + r, (r - t) + s)
+        sums[:nactive] = t
+    result = np.empty(len(starts))
+    result[order] = sums + errs
+    return result
+
+
+# convert observation rows (as per INSERT_OBSERVATION) to a columnar chunk
+# returns dict of arrays: locid, seconds (since the epoch, local time),
+# air_temp, rel_hum, cloud_oktas, rain, wind_dir (code, see WIND_DIR_CODES),
+# wind_spd, press_msl, dewpt (missing readings are nan, and wind_dir -1)
+def rowsToColumnarChunk(rows):
+    fields = list(zip(*rows)) if len(rows) else [()]*16
+    timestamps = ['{}T{}'.format(d, t) for d, t in zip(fields[1], fields[2])]
+    chunk = {
+            'locid': np.array(fields[0], dtype=np.int64),
+            'seconds': np.array(timestamps, dtype='datetime64[s]').astype(np.int64),
+            'air_temp': np.array(fields[3], dtype=np.float64),
+            'rel_hum': np.array(fields[5], dtype=np.float64),
+            'cloud_oktas': np.array(fields[6], dtype=np.int64),
+            'rain': np.array(fields[8], dtype=np.float64),
+            'wind_dir': np.array([WIND_DIR_CODES.get(d, -1) for d in fields[9]], dtype=np.int8),
+            'wind_spd': np.array(fields[10], dtype=np.float64),
+            'press_msl': np.array(fields[11], dtype=np.float64),
+            'dewpt': np.array(fields[12], dtype=np.float64)
+    }
+    return chunk
+
+
+# get a compacted archive's observations as a columnar chunk, as per
+# rowsToColumnarChunk(), the arrays are views of the archive's columns
+def archiveToColumnarChunk(archive):
+    columns = archive['columns']
+    nrows = archive['nrows']
+    def column(colname, dtype, missing):
+        if colname not in columns:
+            return np.full(nrows, missing, dtype=dtype)
+        return np.frombuffer(columns[colname], dtype=dtype)
+    chunk = {
+            'locid': np.full(nrows, archive['id'], dtype=np.int64),
+            'seconds': column('seconds', np.int64, 0),
+            'air_temp': column('air_temp', np.float64, np.nan),
+            'rel_hum': column('relative_humidity', np.float64, -1),
+            'cloud_oktas': column('cloud_oktas', np.int64, -1),
+            'rain': column('rain', np.float64, np.nan),
+            'wind_dir': column('wind_dir', np.int8, -1),
+            'wind_spd': column('wind_spd_kmh', np.float64, np.nan),
+            'press_msl': column('press_msl', np.float64, np.nan),
+            'dewpt': column('dewpt', np.float64, np.nan)
+    }
+    return chunk
+
+
+# load columnar chunks of observations into columnar arrays
+# chunks are in file order, rows for a location, date and time after the
+# first are ignored, except for the first known rain, as for
+# INSERT_OBSERVATION
+# locations is a dict of location id -> name
+# returns dict of arrays, ordered by location then time:
+#     station (index into locations), minutes (since the epoch, local time),
+#     air_temp, rel_hum, cloud_oktas, rain, wind_dir, wind_spd, press_msl,
+#     dewpt
+# and locations, a list of (id, name) tuples ordered by id
+def loadColumnarObservations(chunks, locations):
+    locids = sorted(locations)
+    cols = {
+            'locations': [(locid, locations[locid]) for locid in locids]
+    }
+    if len(chunks) < 1:
+        chunks = [rowsToColumnarChunk([])]
+    fields = {key: np.concatenate([chunk[key] for chunk in chunks]) for key in chunks[0]}
+    station = np.searchsorted(np.array(locids, dtype=np.int64), fields['locid'])
+    seconds = fields['seconds']
+    # stable sort, so the first of any duplicates is kept
+    order = np.lexsort((seconds, station))
+    starts = getGroupStarts([station[order], seconds[order]])
+    # and with known rain first, so the first known rain is kept
+    rain_order = np.lexsort((np.isnan(fields['rain']), seconds, station))
+    cols['rain'] = fields['rain'][rain_order[starts]]
+    order = order[starts]
+    cols['station'] = station[order]
+    cols['minutes'] = seconds[order] // 60
+    for key in ('air_temp', 'rel_hum', 'cloud_oktas', 'wind_dir', 'wind_spd', 'press_msl', 'dewpt'):
+        cols[key] = fields[key][order]
+    return cols
+
+
+# read json observation files and compacted archives into columnar arrays,
+# without a database, archives are memory mapped rather than parsed
+# if filters (from makeObservationFilters()) are given, only selected
+# observations are read
+# returns columnar observations as per loadColumnarObservations()
+def readColumnarObservations(filenames, jobs=1, filters=None):
+    # chunks and location names of each file (for each batch if streamed)
+    chunks = [[] for fn in filenames]
+    names = [[] for fn in filenames]
+    json_files = []
+    for i, fn in enumerate(filenames):
+        if isArchiveFile(fn):
+            dstr = "mapping archive {}".format(fn)
+            logging.debug(dstr)
+            archive = openArchive(fn)
+            start, end = getArchiveSlice(archive, filters)
+            if end <= start:
+                continue
+            chunk = archiveToColumnarChunk(archive)
+            chunks[i].append({key: values[start:end] for key, values in chunk.items()})
+            names[i].append((archive['id'], archive['name']))
+        else:
+            json_files.append(i)
+    parsed_files = parseFiles([filenames[i] for i in json_files], jobs=jobs, filters=filters)
+    for i, (fn, parsed) in zip(json_files, parsed_files):
+        for prepared in getPreparedObservations(parsed):
+            chunks[i].append(rowsToColumnarChunk(prepared['rows']))
+            names[i].append((prepared['id'], prepared['name']))
+    # location names are taken from the first file for each location
+    locations = {}
+    for name in itertools.chain.from_iterable(names):
+        locations.setdefault(*name)
+    chunks = list(itertools.chain.from_iterable(chunks))
+    dstr = "read {} observations for {} locations".format(sum(len(chunk['seconds']) for chunk in chunks), len(locations))
+    logging.debug(dstr)
+    return loadColumnarObservations(chunks, locations)
+
+
+# columnar equivalent of create_date_normalised_observations()
+# adds arrays to cols: day (report date, as days since the epoch), tod
+# (index into TOD_NAMES, -1 if not in an interval) and included (if in
+# datenorm_observation, ie. not the last date's late observations)
+def normaliseColumnarDates(cols):
+    minutes = cols['minutes']
+    day = minutes // 1440
+    mod = minutes % 1440
+    max_day = day.max() if len(day) else 0
+    late = mod >= hourToMinutes(OVERNIGHT_HOUR_START)
+    cols['included'] = ~late | (day < max_day)
+    cols['day'] = day + late
+    cols['mod'] = mod
+    tod = np.full(len(minutes), -1, dtype=np.int64)
+    for code, (start, end) in enumerate(getTODIntervalMinutes()):
+        if start < end:
+            tod[(mod >= start) & (mod < end)] = code
+        else: # wraps around midnight
+            tod[(mod >= start) | (mod < end)] = code
+    cols['tod'] = tod
+
+
+# columnar equivalent of daily_tod_stats and daytoday_avgt_diffs
+# returns dict of arrays, one element per location, date & time of day:
+#     station, day, tod, ava, tspread, avr, tdiff (nan for no diff)
+def calcColumnarDailyStats(cols):
+    sel = np.flatnonzero(cols['included'] & (cols['tod'] >= 0))
+    # order within a date by time, as datenorm_observation is
+    order = sel[np.lexsort((cols['mod'][sel], cols['tod'][sel], cols['day'][sel], cols['station'][sel]))]
+    station = cols['station'][order]
+    day = cols['day'][order]
+    tod = cols['tod'][order]
+    air_temp = cols['air_temp'][order]
+    starts = getGroupStarts([station, day, tod])
+    counts = np.diff(np.append(starts, len(order)))
+    daily = {
+            'station': station[starts],
+            'day': day[starts],
+            'tod': tod[starts],
+            'ava': sumGroupsAsSqlite(air_temp, starts) / counts,
+            'avr': sumGroupsAsSqlite(cols['rel_hum'][order], starts) / counts
+    }
+    if len(starts):
+        daily['tspread'] = np.maximum.reduceat(air_temp, starts) - np.minimum.reduceat(air_temp, starts)
+    else:
+        daily['tspread'] = np.zeros(0)
+
+    # diffs from previous date, for each location (by name) and tod
+    name_rank = getColumnarNameRanks(cols)[daily['station']]
+    order = np.lexsort((daily['day'], daily['tod'], name_rank))
+    ava = daily['ava'][order]
+    same = (name_rank[order][1:] == name_rank[order][:-1]) & (daily['tod'][order][1:] == daily['tod'][order][:-1])
+    tdiff = np.full(len(order), np.nan)
+    tdiff[1:][same] = ava[1:][same] - ava[:-1][same]
+    daily['tdiff'] = np.empty(len(order))
+    daily['tdiff'][order] = tdiff
+    return daily
+
+
+# get the rank of each location's name, for ordering locations by name
+# returns array indexed by station
+def getColumnarNameRanks(cols):
+    names = [name for locid, name in cols['locations']]
+    ranks = {name: rank for rank, name in enumerate(sorted(set(names)))}
+    return np.array([ranks[name] for name in names], dtype=np.int64)
+
+
+# convert days since the epoch to date strings (YYYY-MM-DD)
+def daysToDates(days):
+    return np.array(days, dtype='datetime64[D]').astype(str)
+
+
+# columnar equivalent of getDailyObservations()
+# generates dicts, with the same keys and order as the query results
+def getColumnarDailyObservations(cols, daily):
+    name_rank = getColumnarNameRanks(cols)[daily['station']]
+    order = np.lexsort((name_rank, daily['tod'], daily['day']))
+    dates = daysToDates(daily['day'][order])
+    names = [name for locid, name in cols['locations']]
+    for i, date in zip(order.tolist(), dates.tolist()):
+        tdiff = float(daily['tdiff'][i])
+        yield {
+            'date': date,
+            'tod': TOD_NAMES[daily['tod'][i]],
+            'name': names[daily['station'][i]],
+            'ava': float(daily['ava'][i]),
+            'tdiff': None if np.isnan(tdiff) else tdiff,
+            'tspread': float(daily['tspread'][i]),
+            'avr': float(daily['avr'][i])
+        }
+
+
+# columnar equivalent of getObservationDateRange(), for all locations
+def getColumnarObservationDateRange(cols):
+    if len(cols['minutes']) == 0:
+        return {'first': None, 'last': None, 'days': None}
+    first = cols['minutes'].min() // 1440
+    last = cols['minutes'].max() // 1440
+    obs_range = {
+            'first': str(daysToDates(first)),
+            'last': str(daysToDates(last)),
+            'days': int(last - first)
+    }
+    return obs_range
+
+
+# average values within groups of (station, tod), as per AVG
+# returns dict of (station, tod) -> average
+def avgColumnarGroups(station, tod, values):
+    starts = getGroupStarts([station, tod])
+    counts = np.diff(np.append(starts, len(values)))
+    if values.dtype.kind == 'i':
+        # sqlite sums integers exactly
+        sums = np.add.reduceat(values, starts) if len(starts) else np.zeros(0)
+    else:
+        sums = sumGroupsAsSqlite(values, starts)
+    averages = sums / counts
+    return {(s, t): float(avg) for s, t, avg in zip(station[starts].tolist(), tod[starts].tolist(), averages)}
+
+
+# columnar equivalent of calcPrevailingWinds(), for observations sorted
+# by station and tod
+# returns dict of (station, tod) -> wind direction
+def calcColumnarPrevailingWinds(station, tod, wind_dir):
+    valid = wind_dir >= 0
+    station, tod, wind_dir = station[valid], tod[valid], wind_dir[valid].astype(np.int64)
+    keys = (station * len(TOD_NAMES) + tod) * len(WIND_DIRS) + wind_dir
+    keys, counts = np.unique(keys, return_counts=True)
+    wind_dir = keys % len(WIND_DIRS)
+    group = keys // len(WIND_DIRS)
+    # most frequent first, then in alphabetical order
+    alpha_rank = np.argsort(np.argsort(np.array(WIND_DIRS)))
+    order = np.lexsort((alpha_rank[wind_dir], -counts, group))
+    starts = getGroupStarts([group[order]])
+    prevailing = {}
+    for g, code in zip(group[order][starts].tolist(), wind_dir[order][starts].tolist()):
+        prevailing[divmod(g, len(TOD_NAMES))] = WIND_DIRS[code]
+    return prevailing
+
+
+# columnar equivalent of the extra results of calcLocationSummaries(), for
+# observations sorted by station, tod, day and time (as selected by order)
+# sets the extra results of summaries (from calcColumnarLocationSummaries())
+def calcColumnarExtraSummaries(cols, order, locationSummary):
+    station = cols['station'][order]
+    tod = cols['tod'][order]
+    # rain for each day, with days counted whether or not rain is known
+    day_starts = getGroupStarts([station, tod, cols['day'][order]])
+    day_station, day_tod = station[day_starts], tod[day_starts]
+    group_starts = getGroupStarts([day_station, day_tod])
+    ndays = np.diff(np.append(group_starts, len(day_starts)))
+    ndays = {(s, t): int(n) for s, t, n in zip(day_station[group_starts].tolist(), day_tod[group_starts].tolist(), ndays)}
+    extras = {}
+    for key in ('rain', 'wind_spd', 'press_msl', 'dewpt'):
+        values = cols[key][order]
+        valid = ~np.isnan(values)
+        if key == 'rain':
+            starts = getGroupStarts([station[valid], tod[valid]])
+            sums = sumGroupsAsSqlite(values[valid], starts)
+            extras[key] = {(s, t): float(total) / ndays[(s, t)] for s, t, total in
+                    zip(station[valid][starts].tolist(), tod[valid][starts].tolist(), sums)}
+        else:
+            extras[key] = avgColumnarGroups(station[valid], tod[valid], values[valid])
+    winds = calcColumnarPrevailingWinds(station, tod, cols['wind_dir'][order])
+    for key in ndays:
+        summary, todkey = locationSummary(*key)
+        summary['rain'][todkey] = extras['rain'].get(key)
+        summary['wind_dir'][todkey] = winds.get(key)
+        summary['wind_spd'][todkey] = extras['wind_spd'].get(key)
+        summary['pressure'][todkey] = extras['press_msl'].get(key)
+        summary['dewpt'][todkey] = extras['dewpt'].get(key)
+
+
+# columnar equivalent of calcTODPercentiles(), for the observations of
+# datenorm_observation, a sketch is made for each station, tod and day,
+# and merged in order of day, as the sqlite version merges stored sketches
+# sets the percentile results of summaries (from calcColumnarLocationSummaries())
+def calcColumnarPercentiles(cols, locationSummary):
+    sel = np.flatnonzero(cols['included'] & (cols['tod'] >= 0) & ~np.isnan(cols['air_temp']))
+    order = sel[np.lexsort((cols['day'][sel], cols['tod'][sel], cols['station'][sel]))]
+    station = cols['station'][order]
+    tod = cols['tod'][order]
+    air_temp = cols['air_temp'][order].tolist()
+    day_starts = getGroupStarts([station, tod, cols['day'][order]])
+    day_ends = np.append(day_starts[1:], len(order)).tolist()
+    sketches = {}
+    for s, t, start, end in zip(station[day_starts].tolist(), tod[day_starts].tolist(), day_starts.tolist(), day_ends):
+        if (s, t) not in sketches:
+            sketches[(s, t)] = newSketch()
+        mergeSketches(sketches[(s, t)], newSketch(air_temp[start:end]))
+    for key, sketch in sketches.items():
+        summary, todkey = locationSummary(*key)
+        setSketchPercentiles(summary, todkey, sketch)
+
+
+# columnar equivalent of calcLocationSummaries()
+# returns dict of location id -> dict of results, as per the sqlite version
+def calcColumnarLocationSummaries(cols, daily, extras=False, percentiles=False):
+    summaries = {}
+    def locationSummary(station, tod):
+        locid = cols['locations'][station][0]
+        if locid not in summaries:
+            summaries[locid] = {
+                    'temps': {},
+                    'tranges': {},
+                    'spread': {},
+                    'diffs': {},
+                    'humidity': {},
+                    'cloud': {}
+            }
+            if extras:
+                summaries[locid].update({key: {} for key in EXTRA_SUMMARY_KEYS})
+            if percentiles:
+                summaries[locid].update({key: {} for key in PERCENTILE_SUMMARY_KEYS})
+        return summaries[locid], TOD_KEYS[TOD_NAMES[tod]]
+
+    # per observation averages, in order of date & time within each group
+    sel = np.flatnonzero(cols['included'] & (cols['tod'] >= 0))
+    order = sel[np.lexsort((cols['mod'][sel], cols['day'][sel], cols['tod'][sel], cols['station'][sel]))]
+    station = cols['station'][order]
+    tod = cols['tod'][order]
+    temps = avgColumnarGroups(station, tod, cols['air_temp'][order])
+    valid = cols['rel_hum'][order] >= 0
+    humidity = avgColumnarGroups(station[valid], tod[valid], cols['rel_hum'][order][valid])
+    valid = cols['cloud_oktas'][order] >= 0
+    cloud = avgColumnarGroups(station[valid], tod[valid], cols['cloud_oktas'][order][valid])
+    for key in temps:
+        summary, todkey = locationSummary(*key)
+        summary['temps'][todkey] = temps[key]
+        if key in humidity:
+            summary['humidity'][todkey] = humidity[key]
+        summary['cloud'][todkey] = int(cloud.get(key, -1))
+    if extras:
+        calcColumnarExtraSummaries(cols, order, locationSummary)
+    if percentiles:
+        calcColumnarPercentiles(cols, locationSummary)
+
+    # averages and ranges of daily values, in order of date
+    order = np.lexsort((daily['day'], daily['tod'], daily['station']))
+    station = daily['station'][order]
+    tod = daily['tod'][order]
+    starts = getGroupStarts([station, tod])
+    ava = daily['ava'][order]
+    spread = avgColumnarGroups(station, tod, daily['tspread'][order])
+    tdiff = daily['tdiff'][order]
+    valid = ~np.isnan(tdiff)
+    diffs = avgColumnarGroups(station[valid], tod[valid], np.abs(tdiff[valid]))
+    if len(starts):
+        min_ava = np.minimum.reduceat(ava, starts)
+        max_ava = np.maximum.reduceat(ava, starts)
+    for i, start in enumerate(starts.tolist()):
+        key = (int(station[start]), int(tod[start]))
+        summary, todkey = locationSummary(*key)
+        summary['tranges'][todkey] = {
+                'min': float(min_ava[i]),
+                'max': float(max_ava[i])
+        }
+        summary['spread'][todkey] = spread[key]
+        if key in diffs:
+            summary['diffs'][todkey] = diffs[key]
+
+    return summaries
+
+
+# calculate the daily observations, date range and location summaries
+# using the columnar engine, the daily observations are written (with
+# writer, from openReportWriter()) as they're calculated, unless summary_only
+# if extras, summaries include the extra results, and if percentiles, the
+# percentiles (see calcLocationSummaries())
+# returns tuple of (date range, locations, summaries)
+def columnarReport(cols, writer, summary_only=False, extras=False, percentiles=False):
+    with profilePhase('views') as phase:
+        normaliseColumnarDates(cols)
+        daily = calcColumnarDailyStats(cols)
+        phase['rows'] = len(daily['day'])
+    if not summary_only:
+        with profilePhase('daily') as phase:
+            phase['rows'] = writeDailyObservations(writer, getColumnarDailyObservations(cols, daily))
+    with profilePhase('summary') as phase:
+        obs_range = getColumnarObservationDateRange(cols)
+        locations = [{'id': locid, 'name': name} for locid, name in cols['locations']]
+        summaries = calcColumnarLocationSummaries(cols, daily, extras, percentiles)
+        phase['rows'] = len(locations)
+    return obs_range, locations, summaries
+
+
+
+
+# report output formats, see openReportWriter()
+REPORT_FORMATS = ('text', 'csv', 'jsonl')
+
+# buffer size of report output, so it isn't written a line at a time
+REPORT_BUFFER_SIZE = 1 << 16
+
+# fields of csv and jsonl report records, daily records have a date, and
+# summary records the first and last dates (and days) summarised, along
+# with the min and max of daily temps and cloudiness
+# values are unrounded, tspread is the full spread (not +/-)
+REPORT_FIELDS = ['record', 'date', 'period', 'location', 'temp', 'tspread', 'tdiff', 'humidity',
+        'temp_min', 'temp_max', 'cloud', 'first', 'last', 'days']
+
+# names of periods of day, by daily_tod_stats tod and calc*() result keys
+PERIOD_NAMES = {
+        '0-night': 'overnight',
+        '1-morn': 'morning',
+        '2-day': 'daytime',
+        '3-eve': 'evening',
+        'night': 'overnight',
+        'morn': 'morning',
+        'day': 'daytime',
+        'eve': 'evening'
+}
+
+
+# open a buffered report output on stdout
+def openReportOutput():
+    return open(sys.stdout.fileno(), 'w', buffering=REPORT_BUFFER_SIZE, encoding=sys.stdout.encoding,
+            newline='', closefd=False)
+
+
+# prepare to write the report in the given format (text, csv or jsonl)
+# to out (a file, default stdout), a csv header is written straight away
+# (unless header is False, eg. for adding to an existing report)
+# if extras, location summaries include the extra results (see
+# calcLocationSummaries()), as fields named as per EXTRA_SUMMARY_KEYS, and
+# if percentiles, the percentiles, as per PERCENTILE_SUMMARY_KEYS
+# if rollups, the report is of rollups (see writeRollupReport()), with
+# ROLLUP_FIELDS
+# returns a writer dict, for the write*() functions
+def openReportWriter(fmt='text', out=None, header=True, extras=False, percentiles=False, rollups=False):
+    writer = {
+            'format': fmt,
+            'out': out if out is not None else sys.stdout,
+            'csv': None,
+            'extras': extras,
+            'percentiles': percentiles
+    }
+    if fmt == 'csv':
+        fields = REPORT_FIELDS + EXTRA_SUMMARY_KEYS if extras else REPORT_FIELDS
+        if percentiles:
+            fields = fields + PERCENTILE_SUMMARY_KEYS
+        if rollups:
+            fields = fields + ROLLUP_FIELDS
+        writer['csv'] = csv.DictWriter(writer['out'], fields, lineterminator='\n')
+        if header:
+            writer['csv'].writeheader()
+    return writer
+
+
+# write a record (dict of REPORT_FIELDS) as csv or jsonl
+def writeReportRecord(writer, record):
+    if writer['csv'] is not None:
+        writer['csv'].writerow(record)
+    else:
+        writer['out'].write(json.dumps(record))
+        writer['out'].write('\n')
+
+
+# write day by day observations, as from getDailyObservations() (any
+# iterable of rows, which are written as they're generated)
+# returns the number of observations written
+def writeDailyObservations(writer, observations):
+    if writer['format'] == 'text':
+        return printObsByDate(observations, writer['out'])
+    nobs = 0
+    for obs in observations:
+        record = {
+                'record': 'daily',
+                'date': obs['date'],
+                'period': PERIOD_NAMES[obs['tod']],
+                'location': obs['name'],
+                'temp': obs['ava'],
+                'tspread': obs['tspread'],
+                'tdiff': obs['tdiff'],
+                'humidity': obs['avr']
+        }
+        writeReportRecord(writer, record)
+        nobs += 1
+    return nobs
+
+
+# write the date range and the location summaries (as from
+# calcLocationSummaries()), for locations (list of records with id and name)
+def writeReportSummary(writer, obs_range, locations, summaries):
+    if writer['format'] == 'text':
+        # display the date range for the following location summaries
+        printObservationDatesSummary(obs_range, writer['out'])
+        for loc in locations:
+            summary = summaries[loc['id']]
+            printLocationSummary(loc['name'], summary['temps'], summary['tranges'], summary['spread'], summary['diffs'], summary['humidity'], summary['cloud'], writer['out'])
+            if writer['extras']:
+                printLocationExtras(loc['name'], summary, writer['out'])
+            if writer['percentiles']:
+                printLocationPercentiles(loc['name'], summary, writer['out'])
+        return
+
+    for loc in locations:
+        summary = summaries[loc['id']]
+        for tod in ('night', 'morn', 'day', 'eve'):
+            record = {
+                    'record': 'summary',
+                    'period': PERIOD_NAMES[tod],
+                    'location': loc['name'],
+                    'temp': summary['temps'][tod],
+                    'tspread': summary['spread'][tod],
+                    'tdiff': summary['diffs'][tod],
+                    'humidity': summary['humidity'][tod],
+                    'temp_min': summary['tranges'][tod]['min'],
+                    'temp_max': summary['tranges'][tod]['max'],
+                    'cloud': summary['cloud'][tod],
+                    'first': obs_range['first'],
+                    'last': obs_range['last'],
+                    'days': obs_range['days']
+            }
+            if writer['extras']:
+                for key in EXTRA_SUMMARY_KEYS:
+                    record[key] = summary[key][tod]
+            if writer['percentiles']:
+                for key in PERCENTILE_SUMMARY_KEYS:
+                    record[key] = summary[key].get(tod)
+            writeReportRecord(writer, record)
+
+
+# report profiling results, once processing is complete
+# conn is used to explain the slowest queries (None for no database)
+# if profile_out is given, the profile is also written to it, as json if
+# it ends in .json, otherwise as cProfile stats (from profiler)
+def finishProfile(conn, profiler, profile_out, settings):
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(profile_out)
+    queries = []
+    if conn is not None:
+        queries = explainSlowestQueries(conn)
+    printProfile(queries, settings)
+    if profile_out and profile_out.endswith('.json'):
+        writeProfileJSON(profile_out, queries, settings)
 
 
 ##############################################################
 
+# convert an option's argument to an integer from low to high (inclusive,
+# None for no limit), printing usagestr and exiting if it isn't one
+# used for the numeric options of all commands, so they're checked alike
+def getIntOption(arg, usagestr, low=1, high=None):
+    try:
+        value = int(arg)
+    except ValueError:
+        value = None
+    if value is None or value < low or (high is not None and value > high):
+        print(usagestr, file=sys.stderr)
+        sys.exit(2)
+    return value
+
+
+# commands, as the first argument, other than the default of reporting
+COMMANDS = {
+        'compact': compactMain,
+        'read': readMain,
+        'fetch': fetchMain,
+        'watch': watchMain,
+        'partial': partialMain,
+        'merge': mergeMain
+}
+
+
 def main(argv):
 
+    # commands other than reporting have their own options
+    if len(argv) > 1 and argv[1] in COMMANDS:
+        return COMMANDS[argv[1]](argv)
+
     debug = 0
     summary_only = False
-    paramstr = "[-h] [-d] [-s] jsonfile1 [jsonfile 2 ...]"
+    extras = False
+    percentiles = False
+    rollup_report = None
+    dbfile = None
+    jobs = 1
+    materialise = False
+    engine = 'sqlite'
+    profile = False
+    profile_out = None
+    summary_jobs = 1
+    report_format = 'text'
+    use_cache = True
+    cachedir = RESULT_CACHE_DIR
+    from_date = None
+    to_date = None
+    stations = []
+    storage = None
+    sharddir = None
+    shard_key = None
+    paramstr = "[-h] [-d] [-s] [-x] [-p] [-j jobs] [--db dbfile] [--shards sharddir] [--shard-key key] [--materialise] [--engine sqlite|numpy] [--profile] [--profile-out file] [--summary-jobs jobs] [--format text|csv|jsonl] [--no-cache] [--cache-dir dir] [--from date] [--to date] [--station station] [--storage fast-ephemeral|durable|low-memory] [--rollup range|seasons] jsonfile1 [jsonfile 2 ...]"
     usagestr = "Usage: {} {}".format(sys.argv[0], paramstr)
 
     try:
-        options, remainder = getopt.gnu_getopt(argv[1:],"hds")
+        options, remainder = getopt.gnu_getopt(argv[1:],"hdsxpj:", ["db=", "materialise", "engine=", "profile", "profile-out=", "summary-jobs=", "format=", "no-cache", "cache-dir=", "from=", "to=", "station=", "storage=", "rollup=", "shards=", "shard-key="])
     except getopt.GetoptError:
         print(usagestr, file=sys.stderr)
         sys.exit(2)
@@ -535,6 +5267,66 @@ def main(argv):
             debug = 1
         elif opt == '-s':
             summary_only = True
+        elif opt == '-x':
+            extras = True
+        elif opt == '-p':
+            percentiles = True
+        elif opt == '-j':
+            jobs = getIntOption(arg, usagestr)
+        elif opt == '--db':
+            dbfile = arg
+        elif opt == '--materialise':
+            materialise = True
+        elif opt == '--engine':
+            if arg not in ('sqlite', 'numpy'):
+                print(usagestr, file=sys.stderr)
+                sys.exit(2)
+            engine = arg
+        elif opt == '--profile':
+            profile = True
+        elif opt == '--profile-out':
+            profile = True
+            profile_out = arg
+        elif opt == '--summary-jobs':
+            summary_jobs = getIntOption(arg, usagestr)
+        elif opt == '--format':
+            if arg not in REPORT_FORMATS:
+                print(usagestr, file=sys.stderr)
+                sys.exit(2)
+            report_format = arg
+        elif opt == '--no-cache':
+            use_cache = False
+        elif opt == '--cache-dir':
+            cachedir = arg
+        elif opt in ('--from', '--to'):
+            try:
+                datetime.date.fromisoformat(arg)
+            except ValueError:
+                print(usagestr, file=sys.stderr)
+                sys.exit(2)
+            if opt == '--from':
+                from_date = arg
+            else:
+                to_date = arg
+        elif opt == '--station':
+            stations.extend(station for station in arg.split(',') if station)
+        elif opt == '--storage':
+            if arg not in STORAGE_PROFILES:
+                print(usagestr, file=sys.stderr)
+                sys.exit(2)
+            storage = arg
+        elif opt == '--rollup':
+            if arg not in ROLLUP_REPORTS:
+                print(usagestr, file=sys.stderr)
+                sys.exit(2)
+            rollup_report = arg
+        elif opt == '--shards':
+            sharddir = arg
+        elif opt == '--shard-key':
+            if arg not in SHARD_KEYS:
+                print(usagestr, file=sys.stderr)
+                sys.exit(2)
+            shard_key = arg
         else:
             assert False, "unhandled option"
 
@@ -547,15 +5339,100 @@ def main(argv):
     dstr = "number of remaining args = {}; args = {}".format(len(remainder), str(remainder))
     logging.debug(dstr)
 
-    if (len(remainder) < 1):
+    # with a persistent database, previously ingested data can be reported on
+    if (len(remainder) < 1 and dbfile is None and sharddir is None):
         print(usagestr)
         sys.exit(2)
 
     dstr = "{} json files to process".format(len(remainder))
     logging.info(dstr)
 
+    _profile['enabled'] = profile
+
+    filters = None
+    station_table = None
+    if from_date or to_date or stations:
+        try:
+            station_table = readStationTable(DEFAULT_STATION_TABLE)
+        except OSError:
+            station_table = None
+        filters = makeObservationFilters(from_date, to_date, stations, station_table)
+        # a persistent database is restricted by views, after ingesting
+        if dbfile is None and sharddir is None:
+            remainder = pruneFiles(remainder, filters)
+
+    if profile_out and not profile_out.endswith('.json'):
+        profiler = cProfile.Profile()
+        profiler.enable()
+    else:
+        profiler = None
+
+    # reports only depend on the input files when not using a persistent
+    # database, and aren't cached when debugging or profiling processing
+    cache_key = None
+    if use_cache and not (dbfile or sharddir or debug or profile):
+        cache_key = getResultCacheKey(remainder, {'summary_only': summary_only, 'format': report_format, 'extras': extras,
+                'percentiles': percentiles, 'rollup': rollup_report,
+                'from': from_date, 'to': to_date, 'stations': sorted(stations),
+                # stations can be named as in the station table
+                'station_table': hashFile(DEFAULT_STATION_TABLE) if station_table is not None else None})
+        if writeCachedReport(cachedir, cache_key):
+            return
+
+    if engine == 'numpy':
+        if np is None:
+            print("The numpy engine requires numpy to be installed", file=sys.stderr)
+            sys.exit(2)
+        if dbfile or materialise or rollup_report:
+            print("The numpy engine doesn't use a database, --db, --materialise and --rollup can't be used with it", file=sys.stderr)
+            sys.exit(2)
+        with cachedReportOutput(cachedir, cache_key) as out:
+            # process the json files in memory, as columnar arrays
+            with profilePhase('ingest') as phase:
+                cols = readColumnarObservations(remainder, jobs, filters)
+                phase['rows'] = len(cols['minutes'])
+            writer = openReportWriter(report_format, out, extras=extras, percentiles=percentiles)
+            report = columnarReport(cols, writer, summary_only, extras, percentiles)
+            with profilePhase('print'):
+                writeReportSummary(writer, *report)
+        if profile:
+            settings = {'engine': engine, 'jobs': jobs}
+            finishProfile(None, profiler, profile_out, settings)
+        return
+
+    if sharddir is not None:
+        if dbfile or materialise or engine == 'numpy' or extras or percentiles or rollup_report:
+            print("Shards are reported on with the sqlite engine, without a database, --materialise, -x, -p or --rollup", file=sys.stderr)
+            sys.exit(2)
+        manifest = readShardManifest(sharddir, shard_key)
+        if manifest is None:
+            print("The shards in {} have a different shard key".format(sharddir), file=sys.stderr)
+            sys.exit(2)
+        with profilePhase('ingest') as phase:
+            phase['rows'] = ingestShardFiles(sharddir, manifest, remainder, jobs, storage)
+        with openReportOutput() as out:
+            writer = openReportWriter(report_format, out)
+            # partial results of each shard, in parallel with --summary-jobs
+            with profilePhase('summary') as phase:
+                names, max_date = selectShards(manifest, filters)
+                partials = calcShardPartials(sharddir, names, filters, max_date, not summary_only, summary_jobs)
+                phase['rows'] = len(partials)
+            writeShardReport(writer, partials, summary_only)
+        if profile:
+            settings = {'engine': 'sqlite', 'jobs': jobs, 'shards': sharddir, 'shard_key': manifest['key'],
+                    'summary_jobs': summary_jobs, 'storage': storage or 'default'}
+            finishProfile(None, profiler, profile_out, settings)
+        return
+
+    # database file, if any, for parallel location summaries
+    dbpath = None
+    if dbfile:
+        dstr = "using persistent database {}".format(dbfile)
+        logging.info(dstr)
+        conn = sqlite3.connect(dbfile)
+        dbpath = dbfile
     # if running in debug mode, create database file
-    if debug:
+    elif debug:
         # create temporary filename in current working directory
         #pid = os.getpid() 
         cwd = os.getcwd()
@@ -564,56 +5441,103 @@ def main(argv):
         dstr = "using temp file {} for database".format(tempfname)
         logging.info(dstr)
         conn = sqlite3.connect(tempfname) # temp db on file
+        dbpath = tempfname
     else: # otherwise create database in memory
         #conn = sqlite3.connect(':memory:') # create db solely in memory
         conn = sqlite3.connect('') # temp db, in mem but can use swap
+    applyStorageProfile(conn, storage)
+    if dbfile and summary_jobs > 1:
+        # so summary workers can read while this connection is open
+        conn.execute("PRAGMA journal_mode=WAL")
 
-    with conn:
+    with conn, cachedReportOutput(cachedir, cache_key) as out:
+        writer = openReportWriter(report_format, out, extras=extras, percentiles=percentiles,
+                rollups=rollup_report is not None)
         # use a dictionary cursor
         conn.row_factory = sqlite3.Row
-        dbc = conn.cursor()
-        initDB(dbc)
-
-        # TODO: process rainfall readings, wind direction and speed
+        if profile:
+            dbc = conn.cursor(ProfilingCursor)
+        else:
+            dbc = conn.cursor()
+        initDB(dbc, dbfile is not None)
 
         # process the provided json files - extracting observations
-        for fn in remainder:
-            dstr = "processing file {}".format(fn)
-            logging.debug(dstr)
-            # read json file into dictionary
-            with open(fn, 'r') as f:
-                data = json.load(f)
-            processObservations(dbc, data['observations']['data'])
+        # (including rainfall, wind and pressure readings) in a single pass
+        with profilePhase('ingest') as phase:
+            changes = conn.total_changes
+            ingestFiles(conn, dbc, remainder, dbfile is not None, jobs, None if dbfile else filters)
+            if percentiles and not dbfile:
+                # a persistent database's sketches are kept up to date
+                updateTODSketches(dbc)
+                conn.commit()
+            phase['rows'] = conn.total_changes - changes
+
+        if rollup_report is not None:
+            # answered from the rollups, rather than the views of daily stats
+            with profilePhase('summary') as phase:
+                if not dbfile:
+                    # a persistent database's rollups are kept up to date
+                    updateRollups(dbc)
+                    conn.commit()
+                obs_range, results = calcRollupReport(dbc, rollup_report, filters)
+                phase['rows'] = len(results)
+            with profilePhase('print'):
+                writeRollupReport(writer, obs_range, results)
+            if profile:
+                settings = {'engine': 'sqlite', 'jobs': jobs, 'database': dbfile or 'temporary',
+                        'rollup': rollup_report, 'storage': storage or 'default',
+                        'storage_settings': getStorageSettings(conn)}
+                finishProfile(conn, profiler, profile_out, settings)
+            return
 
-        # normalise dates to deal with overnight observations
-        create_date_normalised_observations(dbc)
+        with profilePhase('views'):
+            if materialise:
+                # normalised dates and daily stats as tables, only refreshing
+                # dates with new observations
+                materialiseDailyStats(dbc)
+            else:
+                # normalise dates to deal with overnight observations
+                create_date_normalised_observations(dbc)
 
-        # generate daily stats for each time of day
-        createDailyTODStats(dbc)
-        # and diffs between consecutive days
-        calcDayToDayTODAvgTempDiffs(dbc)
+                # generate daily stats for each time of day
+                createDailyTODStats(dbc)
+            # and diffs between consecutive days
+            calcDayToDayTODAvgTempDiffs(dbc)
+            if filters is not None and dbfile:
+                # the database has observations that weren't filtered
+                createFilteredViews(dbc, filters, materialise)
 
         if not summary_only:
-            # get a day by day observation report for all locations
-            daily_obs_list = getDailyObservations(dbc)
-            printObsByDate(daily_obs_list)
+            # a day by day observation report for all locations, written as
+            # rows are fetched
+            with profilePhase('daily') as phase:
+                phase['rows'] = writeDailyObservations(writer, getDailyObservations(dbc))
 
-        # display the date range for the following location summaries
-        obs_range = getObservationDateRange(dbc)
-        printObservationDatesSummary(obs_range)
+        with profilePhase('summary') as phase:
+            # the date range for the following location summaries
+            obs_range = getObservationDateRange(dbc)
 
-        # calc typical temps, temp spread, cloudiness for each location
-        locations = getLocations(dbc) # list of location records
-        for loc in locations:
-            typical_temps = calcTypicalTemps(dbc, loc['id'], 'AVG')
-            #min_temps = calcTypicalTemps(dbc, loc['id'], 'MIN')
-            #max_temps = calcTypicalTemps(dbc, loc['id'], 'MAX')
-            temp_range = getRangeAvgTemps(dbc, loc['name'])
-            typical_spread = calcTypicalTempSpread(dbc, loc['id'])
-            typical_tdiff = calcTypicalTempDiff(dbc, loc['name'])
-            typical_humidity = calcTypicalHumidity(dbc, loc['id'])
-            typical_cloud = calcCloudiness(dbc, loc['id'])
-            printLocationSummary(loc['name'], typical_temps, temp_range, typical_spread, typical_tdiff, typical_humidity, typical_cloud)
+            # calc typical temps, temp spread, cloudiness for each location
+            locations = getLocations(dbc) # list of location records
+            # (calculated for all locations at once, see calcLocationSummaries()
+            # for the equivalent of the individual calc*() functions)
+            if summary_jobs > 1 and dbpath is not None and not (filters and dbfile):
+                # or for each location in parallel, on their own connections
+                # (which can't see the temporary views of a filtered database)
+                conn.commit()
+                summaries = calcLocationSummariesParallel(dbpath, [loc['id'] for loc in locations], summary_jobs, extras, storage, percentiles)
+            else:
+                summaries = calcLocationSummaries(dbc, extras=extras, percentiles=percentiles)
+            phase['rows'] = len(locations)
+
+        with profilePhase('print'):
+            writeReportSummary(writer, obs_range, locations, summaries)
+
+        if profile:
+            settings = {'engine': 'sqlite', 'jobs': jobs, 'materialise': materialise,
+                    'database': dbfile or 'temporary', 'summary_jobs': summary_jobs,
+                    'storage': storage or 'default', 'storage_settings': getStorageSettings(conn)}
+            finishProfile(conn, profiler, profile_out, settings)
 
 
 if __name__ == "__main__":
@@ -1,15 +1,4 @@
 #!/bin/bash
-getweatherobs.sh brisbane
-getweatherobs.sh rockhampton
-getweatherobs.sh mackay
-getweatherobs.sh proserpine
-getweatherobs.sh bowen
-getweatherobs.sh Townsville_AP
-getweatherobs.sh Townsville_MS
-getweatherobs.sh innisfail
-getweatherobs.sh Cairns_RC
-getweatherobs.sh Cairns
-getweatherobs.sh mareeba
-getweatherobs.sh cooktown
-getweatherobs.sh darwin
-
+# download observations for all stations in stations.csv, concurrently
+# (previously getweatherobs.sh was run for each station in turn)
+exec bomreader.py fetch "$@"